@@ -1,10 +1,11 @@
 import json
+import numpy as np
+import os.path
 from PIL import Image
-import sys
 
 # Local modules
 from constants import *
-import utils
+import normals
 
 
 class App:
@@ -41,9 +42,20 @@ class App:
         height_map_path = f"{ASSETS_DIR}/{chosen_option}/{HEIGHT_MAP_FILENAME}"
         self.height_map = Image.open(height_map_path).convert('L')
 
-        # Load normal map
-        normal_map_path = f"{ASSETS_DIR}/{chosen_option}/{NORMAL_MAP_FILENAME}"
-        self.normal_map = Image.open(normal_map_path).convert('RGB')
+        # Load normal map, the hand-made one or the one baked by builds, and
+        # bake it from the height map if the map has none
+        map_dir = f"{ASSETS_DIR}/{chosen_option}"
+        normal_map_path = (
+            f"{map_dir}/{normals.get_normal_map_filename(map_dir)}"
+        )
+        if os.path.isfile(normal_map_path):
+            self.normal_map = Image.open(normal_map_path).convert('RGB')
+        else:
+            normal_map = normals.bake_normal_map(
+                np.asarray(self.height_map),
+                **normals.get_settings(self.config)
+            )
+            self.normal_map = Image.fromarray(normal_map)
 
         # Load road map
         road_map_path = f"{ASSETS_DIR}/{chosen_option}/{ROAD_MAP_FILENAME}"
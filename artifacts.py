@@ -0,0 +1,203 @@
+from collections import Counter
+import json
+import os.path
+import queue
+import threading
+
+import numpy as np
+from PIL import Image
+
+# Local modules
+import bitmask
+from constants import *
+
+DEFAULT_WORKERS = 2
+# Writes waiting in the queue before the pipeline blocks
+DEFAULT_MAX_PENDING = 32
+# zlib level for PNG files, from 0 (fastest) to 9 (smallest)
+DEFAULT_COMPRESS_LEVEL = 6
+JPEG_EXTENSIONS = (".jpg", ".jpeg")
+
+
+class ArtifactWriter:
+    def __init__(
+            self, workers=DEFAULT_WORKERS, max_pending=DEFAULT_MAX_PENDING,
+            compress_level=DEFAULT_COMPRESS_LEVEL, jpeg_quality=MAX_QUALITY,
+            debug=True
+    ):
+        """
+        Write the outputs of a build in background threads, so that encoding
+        images and serializing JSON overlaps with the next stage. Arrays and
+        objects must not change after they are submitted.
+        Args:
+            workers(int): Writer threads, 0 writes every file right away
+            max_pending(int): Writes that can wait in the queue, submitting
+                more blocks until a writer is free
+            compress_level(int): zlib level for PNG files
+            jpeg_quality(int): Quality for JPEG files
+            debug(bool): Whether to write debug artifacts
+        """
+        self.workers = workers
+        self.compress_level = compress_level
+        self.jpeg_quality = jpeg_quality
+        self.debug = debug
+        self.queue = queue.Queue(max_pending)
+        # Number of writes that haven't finished for each path
+        self.pending = Counter()
+        self.condition = threading.Condition()
+        self.errors = []
+        self.threads = [
+            threading.Thread(target=self.work, daemon=True)
+            for _ in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def submit(self, path, write, debug=False):
+        """
+        Write a file.
+        Args:
+            path(str): Path of the file
+            write(function): Function that receives the path and writes it
+            debug(bool): Whether the file is a debug artifact
+        """
+        if debug and not self.debug:
+            return
+        if self.workers == 0:
+            write(path)
+            return
+        with self.condition:
+            self.pending[path] += 1
+        self.queue.put((path, write))
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            path, write = item
+            try:
+                write(path)
+            except Exception as e:
+                self.errors.append(e)
+            finally:
+                with self.condition:
+                    self.pending[path] -= 1
+                    if self.pending[path] == 0:
+                        del self.pending[path]
+                    self.condition.notify_all()
+                self.queue.task_done()
+
+    def save_image(self, image, path, debug=False, log=True):
+        """
+        Encode an image as PNG or JPEG depending on the extension of path.
+        Args:
+            image(ndarray or Image): The image
+            path(str): Path of the file
+            debug(bool): Whether the file is a debug artifact
+            log(bool): Whether to print the path when it's written
+        """
+        def write(image_path):
+            img = image
+            if isinstance(img, np.ndarray):
+                img = Image.fromarray(img)
+            if os.path.splitext(image_path)[1].lower() in JPEG_EXTENSIONS:
+                img.save(image_path, quality=self.jpeg_quality)
+            else:
+                img.save(image_path, compress_level=self.compress_level)
+            if log:
+                print(f"Image saved in {image_path}")
+
+        self.submit(path, write, debug)
+
+    def save_json(
+            self, obj, path, debug=False, log=True, indent=JSON_INDENT
+    ):
+        """
+        Serialize an object as JSON.
+        Args:
+            obj(object): The object
+            path(str): Path of the file
+            debug(bool): Whether the file is a debug artifact
+            log(bool): Whether to print the path when it's written
+            indent(int): Indent of the file, None for a compact file
+        """
+        def write(json_path):
+            with open(json_path, 'w') as f:
+                json.dump(obj, f, indent=indent)
+            if log:
+                print(f"Finished writing {json_path}")
+
+        self.submit(path, write, debug)
+
+    def save_bytes(self, data, path, debug=False, log=True):
+        """
+        Write binary data, like a GLB file or the bytes of an array.
+        Args:
+            data(bytes or ndarray): The data
+            path(str): Path of the file
+            debug(bool): Whether the file is a debug artifact
+            log(bool): Whether to print the path when it's written
+        """
+        def write(bytes_path):
+            if isinstance(data, np.ndarray):
+                data.tofile(bytes_path)
+            else:
+                with open(bytes_path, 'wb') as f:
+                    f.write(data)
+            if log:
+                print(f"Finished writing {bytes_path}")
+
+        self.submit(path, write, debug)
+
+    def save_mask(self, mask, path, key=b"", debug=False, log=True):
+        """
+        Write a binary map as packed bits, see bitmask.encode_mask.
+        Args:
+            mask(ndarray): The map
+            path(str): Path of the file
+            key(bytes): Key stored with the map
+            debug(bool): Whether the file is a debug artifact
+            log(bool): Whether to print the path when it's written
+        """
+        def write(mask_path):
+            bitmask.save_mask(mask, mask_path, key)
+            if log:
+                print(f"Finished writing {mask_path}")
+
+        self.submit(path, write, debug)
+
+    def wait(self, path):
+        """Wait until the pending writes of a file finish, to read it."""
+        with self.condition:
+            self.condition.wait_for(lambda: path not in self.pending)
+        self.raise_errors()
+
+    def flush(self):
+        """Wait until every submitted file is written."""
+        self.queue.join()
+        self.raise_errors()
+
+    def raise_errors(self):
+        if self.errors:
+            error = self.errors[0]
+            self.errors = []
+            raise error
+
+    def close(self):
+        """Flush and stop the writer threads."""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        # Later files are written right away
+        self.workers = 0
+        self.raise_errors()
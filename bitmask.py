@@ -0,0 +1,118 @@
+import hashlib
+import struct
+
+import numpy as np
+
+MAGIC = b"PMAP"
+VERSION = 1
+# Encodings of the payload
+PACKED = 0  # np.packbits of the rows
+RLE = 1     # Lengths of the runs of equal bits, starting with a run of 0s
+# Magic, version, encoding, length of the key, height and width
+HEADER_FORMAT = "<4sBBHII"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+DIGEST_SIZE = 16
+
+
+def get_digest(arr):
+    """
+    Get a key that identifies the contents of an array, like the density map
+    a placement map was dithered from.
+    Args:
+        arr(ndarray): The array
+    Returns:
+        bytes: The key
+    """
+    digest = hashlib.blake2b(arr.tobytes(), digest_size=DIGEST_SIZE)
+    digest.update(str((arr.shape, arr.dtype.str)).encode())
+    return digest.digest()
+
+
+def encode_runs(mask):
+    flat = mask.ravel()
+    boundaries = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    boundaries = np.concatenate([[0], boundaries, [len(flat)]])
+    runs = np.diff(boundaries)
+    if len(flat) and flat[0]:
+        runs = np.concatenate([[0], runs])
+    dtype = np.uint16 if runs.max(initial=0) <= np.iinfo(np.uint16).max \
+        else np.uint32
+    return np.dtype(dtype).char.encode() + runs.astype(dtype).tobytes()
+
+
+def decode_runs(payload, shape):
+    runs = np.frombuffer(payload[1:], dtype=np.dtype(payload[:1].decode()))
+    values = np.arange(len(runs)) % 2 == 1
+    return np.repeat(values, runs.astype(np.int64)).reshape(shape)
+
+
+def encode_mask(mask, key=b"", rle=None):
+    """
+    Encode a binary map in bits.
+    Args:
+        mask(ndarray): Map where every pixel greater than 0 is set
+        key(bytes): Key stored with the map, like the digest of its source
+        rle(bool): Whether to store the lengths of the runs of equal pixels
+            instead of the bits, the smallest of both if None
+    Returns:
+        bytes: The encoded map
+    """
+    mask = np.asarray(mask) > 0
+    h, w = mask.shape
+    payloads = {}
+    if rle is None or not rle:
+        payloads[PACKED] = np.packbits(mask, axis=1).tobytes()
+    if rle is None or rle:
+        payloads[RLE] = encode_runs(mask)
+    encoding = min(payloads, key=lambda e: len(payloads[e]))
+    header = struct.pack(
+        HEADER_FORMAT, MAGIC, VERSION, encoding, len(key), h, w
+    )
+    return header + key + payloads[encoding]
+
+
+def decode_mask(data, key=None):
+    """
+    Decode a binary map encoded by encode_mask.
+    Args:
+        data(bytes): The encoded map
+        key(bytes): If given, the key that the map must have
+    Returns:
+        ndarray: The map as booleans, None if its key is not the given one
+    """
+    magic, version, encoding, key_length, h, w = struct.unpack_from(
+        HEADER_FORMAT, data
+    )
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Data is not an encoded placement map")
+    stored_key = data[HEADER_SIZE:HEADER_SIZE + key_length]
+    if key is not None and stored_key != key:
+        return None
+    payload = data[HEADER_SIZE + key_length:]
+    if encoding == RLE:
+        return decode_runs(payload, (h, w))
+    packed = np.frombuffer(payload, dtype=np.uint8).reshape(h, -1)
+    return np.unpackbits(packed, axis=1, count=w).astype(bool)
+
+
+def save_mask(mask, path, key=b"", rle=None):
+    with open(path, 'wb') as f:
+        f.write(encode_mask(mask, key, rle))
+
+
+def load_mask(path, key=None):
+    """
+    Load a binary map saved by save_mask.
+    Args:
+        path(str): Path of the file
+        key(bytes): If given, the key that the map must have
+    Returns:
+        ndarray: The map as booleans, None if the file doesn't exist or its
+            key is not the given one
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    return decode_mask(data, key)
@@ -5,6 +5,9 @@ from pyglet.math import Mat4, Vec3, clamp
 from pyglet.window import key
 import weakref
 
+# Local modules
+from profiler import CAMERA_PHASE
+
 
 SENSITIVITY = 0.3
 
@@ -16,7 +19,8 @@ class FPSCamera:
         target=Vec3(0, 0, -1),
         up=Vec3(0, 1, 0),
         pitch=130,
-        yaw=-137
+        yaw=-137,
+        profiler=None
     ):
         self.position = position
         self.target = target
@@ -40,6 +44,11 @@ class FPSCamera:
         self.left = False
         self.right = False
 
+        # Measures the camera update of every frame if given
+        self.profiler = profiler
+        if profiler is not None:
+            profiler.camera = self
+
         self._window = weakref.proxy(window)
         self._window.view = Mat4.look_at(position, target, up)
         self._window.push_handlers(self)
@@ -52,6 +61,13 @@ class FPSCamera:
         return pyglet.event.EVENT_HANDLED
 
     def on_refresh(self, dt):
+        if self.profiler is None:
+            self.update(dt)
+            return
+        with self.profiler.measure(CAMERA_PHASE):
+            self.update(dt)
+
+    def update(self, dt):
         # Movement
         speed = self.speed * dt
         if self.forward:
@@ -77,12 +93,12 @@ class FPSCamera:
         center = glm.vec3(*(self.position + self.target))
         up = glm.vec3(*self.up)
 
-        l = []
+        view = []
         m = glm.lookAt(eye, center, up)
         for c in m:
-            l.extend(c)
+            view.extend(c)
 
-        self._window.view = tuple(l)
+        self._window.view = tuple(view)
 
     # Mouse input
 
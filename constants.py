@@ -6,25 +6,37 @@ FULL_ROTATION = "full"
 RANDOM_ROTATION = "random"
 # Directories
 DEBUG_DIR = "debug"
+CACHE_DIR = "cache"
 ASSETS_DIR = "assets"
 # Maps
 DENSITY_FILENAME = "density_map.png"
-PLACEMENT_MAP_FILENAME = "placement_map.jpg"
+PLACEMENT_MAP_FILENAME = "placement_map.bits"  # packed bits
+PLACEMENT_PREVIEW_FILENAME = "placement_map.png"
 HEIGHT_MAP_FILENAME = "height_map.png"
 ROAD_MAP_FILENAME = "road_map.png"
 DIST_MAP_FILENAME = "dist_map.png"
 ORIENT_MAP_FILENAME = "orient_map.png"
+# Normal map made by hand, builds bake their own one when a map has none
 NORMAL_MAP_FILENAME = "normal_map.png"
+BAKED_NORMAL_MAP_FILENAME = "baked_normal_map.png"
+OCCLUSION_MAP_FILENAME = "occlusion_map.png"
+# Ambient occlusion made by hand, used instead of the baked one
+AMBIENT_OCCLUSION_FILENAME = "ambient_occlusion.PNG"
+ROAD_GRAPH_FILENAME = "road_graph.npz"
 # JSONs
 ASSETS_FILENAME = "js/assets.json"
 SURFACE_FILENAME = "surface.json"
 PLACEMENT_FILENAME = "placement.json"
+INSTANCES_FILENAME = "instances.json"
 ECOTOPES_FILENAME = "ecotopes.json"
 CONFIG_FILENAME = "config.json"
 MAPS_FILENAME = "js/maps.json"
 # Textures
 GROUND_TEXTURE = "ground.png"    # colors for the ground triangles
 SURFACE_TEXTURE = "surface.png"  # colors for surface triangle, counting roads
+# Binaries
+SURFACE_GLB_FILENAME = "surface.glb"
+INSTANCES_BATCH_FILENAME = "instances.bin"  # prefixed by the asset id
 
 MAX_COLOR = 255
 COLOR_CHANNELS = 3
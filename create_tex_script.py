@@ -1,6 +1,5 @@
 import numpy as np
 from PIL import Image
-import json
 
 # Local modules
 from app import App
@@ -0,0 +1,308 @@
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import threading
+import time
+
+# Local modules
+from constants import *
+import main
+from map_context import FILE_DEPENDENTS, MapContext
+
+DEFAULT_PORT = 8001
+DEFAULT_WORKERS = 2
+# Megabytes of cached arrays kept in memory
+DEFAULT_MEMORY_BUDGET = 512
+MEGABYTE = 2 ** 20
+JOBS_PATH = "/jobs"
+STATUS_PATH = "/status"
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+FINISHED_STATUSES = {JOB_DONE, JOB_FAILED}
+# Finished jobs whose results are kept, older ones are forgotten
+DEFAULT_JOB_HISTORY = 100
+
+
+class ContextCache:
+    def __init__(self, memory_budget):
+        """
+        Least recently used cache of map contexts, so that the rasters of a
+        map and the products derived from them stay decoded between builds.
+        Args:
+            memory_budget(int): Maximum bytes of arrays in all the contexts
+        """
+        self.memory_budget = memory_budget
+        self.contexts = OrderedDict()
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, map_name):
+        """
+        Get the context of a map, dropping what changed on disk since the
+        last build.
+        Args:
+            map_name(str): Name of the map
+        Returns:
+            tuple: The context and the list of files that changed
+        """
+        with self.lock:
+            if map_name in self.contexts:
+                self.contexts.move_to_end(map_name)
+                ctx = self.contexts[map_name]
+                return ctx, ctx.refresh()
+        ctx = MapContext(map_name)
+        with self.lock:
+            self.contexts[map_name] = ctx
+        return ctx, []
+
+    def get_lock(self, map_name):
+        """Lock held while a map builds, since a context isn't thread safe."""
+        with self.lock:
+            return self.locks.setdefault(map_name, threading.Lock())
+
+    @property
+    def nbytes(self):
+        return sum(ctx.nbytes for ctx in self.contexts.values())
+
+    def trim(self):
+        """Evict the least recently used contexts until they fit the budget."""
+        with self.lock:
+            while len(self.contexts) > 1 and self.nbytes > self.memory_budget:
+                map_name, _ = self.contexts.popitem(last=False)
+                print(f"Evicted {map_name} from the cache")
+
+
+class BuildDaemon:
+    def __init__(
+            self, memory_budget, workers=DEFAULT_WORKERS,
+            job_history=DEFAULT_JOB_HISTORY
+    ):
+        """
+        Run build jobs on a pool of workers that share warm map contexts.
+        A job is a dict with:
+            map(str): Name of the map, required
+            stages(list): Stages of main.STAGES to run, all of them if missing
+            seed(int): Seed for the placement, the one in the config if missing
+            config(dict): Values that override the config of the map
+            ecotopes(list): Ecotopes to use instead of ecotopes.json
+        Args:
+            memory_budget(int): Maximum bytes of cached arrays
+            workers(int): Number of jobs that can run at the same time
+            job_history(int): Number of finished jobs whose results are kept
+        """
+        self.cache = ContextCache(memory_budget)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.job_history = job_history
+        # States of the jobs by id, in the order they were submitted
+        self.jobs = OrderedDict()
+        self.jobs_lock = threading.Lock()
+        self.ids = itertools.count(1)
+
+    def submit(self, job):
+        """
+        Queue a job.
+        Args:
+            job(dict): The job
+        Returns:
+            int: Id of the job, ValueError is raised if the job isn't valid
+        """
+        if not isinstance(job, dict):
+            raise ValueError("The job is not an object")
+        if 'map' not in job:
+            raise ValueError("The job doesn't have a map")
+        stages = job.get('stages', [])
+        if not isinstance(stages, list) or \
+                not all(isinstance(name, str) for name in stages):
+            raise ValueError("The stages are not a list of names")
+        unknown_stages = set(stages) - set(main.STAGES)
+        if unknown_stages:
+            raise ValueError(f"Unknown stages {sorted(unknown_stages)}")
+        if not isinstance(job.get('config', {}), dict):
+            raise ValueError("The config is not an object")
+        ecotopes = job.get('ecotopes', [])
+        if not isinstance(ecotopes, list):
+            raise ValueError("The ecotopes are not a list")
+        if not all(
+                isinstance(ecotope, dict) and 'priority' in ecotope
+                for ecotope in ecotopes
+        ):
+            raise ValueError("Every ecotope needs a priority")
+        job_id = next(self.ids)
+        state = {"id": job_id, "status": JOB_QUEUED, "job": job}
+        with self.jobs_lock:
+            self.jobs[job_id] = state
+        state["future"] = self.executor.submit(self.run_job, state, job)
+        state["future"].add_done_callback(lambda _: self.trim_jobs())
+        return job_id
+
+    def trim_jobs(self):
+        """Forget the oldest finished jobs past the history."""
+        with self.jobs_lock:
+            finished = [
+                job_id for job_id, state in self.jobs.items()
+                if state["status"] in FINISHED_STATUSES
+            ]
+            for job_id in finished[:max(len(finished) - self.job_history, 0)]:
+                del self.jobs[job_id]
+
+    def run_job(self, state, job):
+        map_name = job['map']
+        with self.cache.get_lock(map_name):
+            state["status"] = JOB_RUNNING
+            start = time.perf_counter()
+            try:
+                ctx, changed = self.cache.get(map_name)
+            except Exception as e:
+                state["error"] = repr(e)
+                state["status"] = JOB_FAILED
+                return state
+            try:
+                ctx.reseed(job.get('seed'))
+                if 'config' in job:
+                    ctx.set_config({**ctx.config, **job['config']})
+                    ctx.invalidate(*FILE_DEPENDENTS[CONFIG_FILENAME])
+                if 'ecotopes' in job:
+                    ctx.ecotopes = sorted(
+                        job['ecotopes'], key=lambda e: e['priority']
+                    )
+                times = {}
+                for name, stage in main.STAGES.items():
+                    if 'stages' not in job or name in job['stages']:
+                        stage_start = time.perf_counter()
+                        stage(ctx)
+                        times[name] = time.perf_counter() - stage_start
+                state["result"] = {
+                    "changedFiles": changed,
+                    "stageTimes": times,
+                    "time": time.perf_counter() - start
+                }
+                state["status"] = JOB_DONE
+            except Exception as e:
+                state["error"] = repr(e)
+                state["status"] = JOB_FAILED
+            finally:
+                # Overrides only last for this job
+                if 'config' in job:
+                    ctx.set_config()
+                    ctx.invalidate(*FILE_DEPENDENTS[CONFIG_FILENAME])
+                if 'ecotopes' in job:
+                    ctx.invalidate('ecotopes')
+        self.cache.trim()
+        return state
+
+    def get_job(self, job_id, wait=False):
+        """
+        Get the state of a job.
+        Args:
+            job_id(int): Id of the job
+            wait(bool): Whether to wait until the job finishes
+        Returns:
+            dict: Status of the job and its result or error if it finished,
+                None if there is no job with that id or it was forgotten
+        """
+        with self.jobs_lock:
+            state = self.jobs.get(job_id)
+        if state is None:
+            return None
+        if wait:
+            state["future"].result()
+        return {k: v for k, v in state.items() if k != "future"}
+
+    def get_status(self):
+        with self.jobs_lock:
+            live_jobs = [
+                job_id for job_id, state in self.jobs.items()
+                if state["status"] not in FINISHED_STATUSES
+            ]
+        return {
+            "maps": list(self.cache.contexts),
+            "cachedBytes": self.cache.nbytes,
+            "memoryBudget": self.cache.memory_budget,
+            "jobs": live_jobs
+        }
+
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /jobs with a JSON job queues it and answers its id, or its result
+    when the job has "wait": true. GET /jobs/<id> answers the state of a job
+    that is queued, running or among the last finished ones, and GET /status
+    the state of the cache and the ids of the jobs that haven't finished.
+    """
+    daemon = None
+
+    def send_json(self, obj, status=HTTPStatus.OK):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path != JOBS_PATH:
+            self.send_json({"error": "Not found"}, HTTPStatus.NOT_FOUND)
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            job = json.loads(self.rfile.read(length))
+            job_id = self.daemon.submit(job)
+        except ValueError as e:
+            self.send_json({"error": str(e)}, HTTPStatus.BAD_REQUEST)
+            return
+        if job.get('wait'):
+            state = self.daemon.get_job(job_id, wait=True)
+            if state is None:
+                self.send_json({"error": "Job forgotten"}, HTTPStatus.GONE)
+                return
+            self.send_json(state)
+        else:
+            self.send_json({"id": job_id}, HTTPStatus.ACCEPTED)
+
+    def do_GET(self):
+        if self.path == STATUS_PATH:
+            self.send_json(self.daemon.get_status())
+            return
+        if self.path.startswith(JOBS_PATH + "/"):
+            job_id = self.path[len(JOBS_PATH) + 1:]
+            state = self.daemon.get_job(int(job_id)) if job_id.isdigit() \
+                else None
+            if state is not None:
+                self.send_json(state)
+                return
+        self.send_json({"error": "Not found"}, HTTPStatus.NOT_FOUND)
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description="Keep maps warm in memory and build them on request"
+    )
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument(
+        '--memory-budget', type=int, default=DEFAULT_MEMORY_BUDGET,
+        help="megabytes of cached arrays"
+    )
+    parser.add_argument(
+        '--job-history', type=int, default=DEFAULT_JOB_HISTORY,
+        help="finished jobs whose results are kept"
+    )
+    args = parser.parse_args()
+    DaemonRequestHandler.daemon = BuildDaemon(
+        args.memory_budget * MEGABYTE, args.workers, args.job_history
+    )
+    server = ThreadingHTTPServer(
+        ('localhost', args.port), DaemonRequestHandler
+    )
+    print(f"Waiting for jobs in http://localhost:{args.port}{JOBS_PATH}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,321 @@
+import io
+import json
+import struct
+
+import numpy as np
+from PIL import Image
+
+# Local modules
+from constants import *
+import normals
+import rtin
+
+# glTF constants
+GLB_MAGIC = 0x46546C67
+GLB_VERSION = 2
+JSON_CHUNK_TYPE = 0x4E4F534A
+BIN_CHUNK_TYPE = 0x004E4942
+ARRAY_BUFFER = 34962
+ELEMENT_ARRAY_BUFFER = 34963
+BYTE = 5120
+UNSIGNED_SHORT = 5123
+UNSIGNED_INT = 5125
+TRIANGLES = 4
+MAX_UINT16 = 65535
+MAX_INT8 = 127
+QUANTIZATION_EXTENSION = "KHR_mesh_quantization"
+
+
+def create_grid_triangles(w, h):
+    """
+    Create two triangles per pixel of a grid of w x h vertices, facing up
+    when rows grow in the +z axis.
+    Args:
+        w(int): Number of vertices in a row
+        h(int): Number of rows
+    Returns:
+        ndarray: Indices of the vertices of each triangle (M x 3)
+    """
+    rows, cols = np.mgrid[0:h - 1, 0:w - 1]
+    a = (rows * w + cols).ravel()
+    b = a + 1
+    c = a + w
+    d = c + 1
+    return np.concatenate([
+        np.stack([a, c, b], axis=1), np.stack([b, c, d], axis=1)
+    ])
+
+
+def quantize(values, max_value):
+    """
+    Quantize values to integers in [0, max_value] with an affine transform.
+    Args:
+        values(ndarray): Values to quantize (N x C)
+        max_value(int): Maximum integer
+    Returns:
+        tuple: Quantized values, offset and step of each component such that
+            values = offset + quantized * step
+    """
+    offset = values.min(axis=0)
+    extent = values.max(axis=0) - offset
+    step = np.where(extent > 0, extent / max_value, 1)
+    quantized = np.round((values - offset) / step)
+    return quantized, offset, step
+
+
+class GLBBuilder:
+    def __init__(self):
+        """
+        Accumulate buffer views and accessors in a single binary buffer and
+        write them as a GLB file.
+        """
+        self.gltf = {
+            "asset": {"version": "2.0", "generator": "pictorial-map"},
+            "bufferViews": [],
+            "accessors": []
+        }
+        self.data = bytearray()
+
+    def add_buffer_view(self, data, target=None, byte_stride=None):
+        # Every buffer view starts aligned to 4 bytes
+        self.data += b'\0' * (-len(self.data) % 4)
+        buffer_view = {
+            "buffer": 0,
+            "byteOffset": len(self.data),
+            "byteLength": len(data)
+        }
+        if target is not None:
+            buffer_view["target"] = target
+        if byte_stride is not None:
+            buffer_view["byteStride"] = byte_stride
+        self.data += data
+        self.gltf["bufferViews"].append(buffer_view)
+        return len(self.gltf["bufferViews"]) - 1
+
+    def add_accessor(
+            self, arr, component_type, accessor_type, target=None,
+            normalized=False, min_max=False
+    ):
+        """
+        Add an accessor for an array, padding each element to 4 bytes for
+        vertex attributes.
+        Args:
+            arr(ndarray): Elements to store (N x C), already in their dtype
+            component_type(int): glTF component type of arr
+            accessor_type(str): glTF type like "VEC3" or "SCALAR"
+            target(int): ARRAY_BUFFER or ELEMENT_ARRAY_BUFFER
+            normalized(bool): Whether integers are normalized to [0, 1]
+            min_max(bool): Whether to add the bounds of the elements
+        Returns:
+            int: Index of the accessor
+        """
+        values = arr.reshape(len(arr), -1)
+        byte_stride = None
+        arr = values
+        if target == ARRAY_BUFFER:
+            element_size = arr.shape[1] * arr.itemsize
+            byte_stride = element_size + (-element_size % 4)
+            padding = (byte_stride - element_size) // arr.itemsize
+            arr = np.pad(arr, [(0, 0), (0, padding)])
+        buffer_view = self.add_buffer_view(
+            arr.astype(arr.dtype.newbyteorder('<')).tobytes(), target,
+            byte_stride
+        )
+        accessor = {
+            "bufferView": buffer_view,
+            "componentType": component_type,
+            "count": len(values),
+            "type": accessor_type
+        }
+        if normalized:
+            accessor["normalized"] = True
+        if min_max:
+            accessor["min"] = values.min(axis=0).tolist()
+            accessor["max"] = values.max(axis=0).tolist()
+        self.gltf["accessors"].append(accessor)
+        return len(self.gltf["accessors"]) - 1
+
+    def to_bytes(self):
+        self.gltf["buffers"] = [{"byteLength": len(self.data)}]
+        json_chunk = json.dumps(self.gltf, separators=(',', ':')).encode()
+        json_chunk += b' ' * (-len(json_chunk) % 4)
+        bin_chunk = bytes(self.data) + b'\0' * (-len(self.data) % 4)
+        length = 12 + 8 + len(json_chunk) + 8 + len(bin_chunk)
+        return b''.join([
+            struct.pack('<III', GLB_MAGIC, GLB_VERSION, length),
+            struct.pack('<II', len(json_chunk), JSON_CHUNK_TYPE),
+            json_chunk,
+            struct.pack('<II', len(bin_chunk), BIN_CHUNK_TYPE),
+            bin_chunk
+        ])
+
+
+def create_terrain_glb(
+        height_map, max_height, pixel_size, texture_bytes=None,
+        normal_map_bytes=None, max_error=None
+):
+    """
+    Create a binary glTF with the terrain of a map using indexed geometry,
+    uint16 quantized positions and uv coordinates and int8 normals. The
+    layout of the terrain is the same as the one built by js/surface.js.
+    Args:
+        height_map(ndarray): Map where each pixel represents a height (uint8)
+        max_height(float): Maximum height for all vertices
+        pixel_size(float): Length of a side of a pixel in the height map
+        texture_bytes(bytes): PNG image for the color of the surface
+        normal_map_bytes(bytes): PNG image for the normal map of the surface
+        max_error(float): If given, use an adaptive mesh whose heights differ
+            at most this value (in world units) from the height map
+    Returns:
+        bytes: The GLB file
+    """
+    height, width = height_map.shape
+    if max_error is not None:
+        vertices, triangles = rtin.RTIN(height_map).get_mesh(
+            max_error / max_height * MAX_COLOR
+        )
+        cols, rows, values = vertices.T
+    else:
+        rows, cols = np.mgrid[0:height, 0:width]
+        cols = cols.ravel()
+        rows = rows.ravel()
+        values = height_map.ravel()
+        triangles = create_grid_triangles(width, height)
+    positions = np.stack([
+        (cols - width / 2) * pixel_size,
+        values / MAX_COLOR * max_height,
+        (rows - height / 2) * pixel_size
+    ], axis=1)
+    # Make every triangle face up
+    normals = rtin.calculate_normals(positions, triangles)
+    a, b, c = (positions[triangles[:, k]] for k in range(3))
+    is_down = np.cross(b - a, c - a)[:, 1] < 0
+    triangles[is_down] = triangles[is_down][:, ::-1]
+    uvs = np.stack([cols / width, rows / height], axis=1)
+
+    builder = GLBBuilder()
+    quantized_positions, offset, step = quantize(positions, MAX_UINT16)
+    position_accessor = builder.add_accessor(
+        quantized_positions.astype(np.uint16), UNSIGNED_SHORT, "VEC3",
+        target=ARRAY_BUFFER, min_max=True
+    )
+    # Renderers transform normals by the inverse transpose of the node scale,
+    # so they are stored scaled by it to get the world normals back
+    normals = normals * step
+    normals /= np.linalg.norm(normals, axis=1, keepdims=True)
+    normal_accessor = builder.add_accessor(
+        np.round(normals * MAX_INT8).astype(np.int8), BYTE, "VEC3",
+        target=ARRAY_BUFFER, normalized=True
+    )
+    uv_accessor = builder.add_accessor(
+        np.round(uvs * MAX_UINT16).astype(np.uint16), UNSIGNED_SHORT, "VEC2",
+        target=ARRAY_BUFFER, normalized=True
+    )
+    if len(positions) <= MAX_UINT16:
+        indices = triangles.astype(np.uint16)
+        index_type = UNSIGNED_SHORT
+    else:
+        indices = triangles.astype(np.uint32)
+        index_type = UNSIGNED_INT
+    index_accessor = builder.add_accessor(
+        indices.reshape(-1, 1), index_type, "SCALAR",
+        target=ELEMENT_ARRAY_BUFFER
+    )
+
+    material = {
+        "pbrMetallicRoughness": {"metallicFactor": 0, "roughnessFactor": 1},
+        "doubleSided": True
+    }
+    gltf = builder.gltf
+    images = []
+    for image_bytes in [texture_bytes, normal_map_bytes]:
+        if image_bytes is not None:
+            images.append({
+                "bufferView": builder.add_buffer_view(image_bytes),
+                "mimeType": "image/png"
+            })
+    if images:
+        gltf["images"] = images
+        gltf["samplers"] = [{}]
+        gltf["textures"] = [
+            {"sampler": 0, "source": k} for k in range(len(images))
+        ]
+        if texture_bytes is not None:
+            material["pbrMetallicRoughness"]["baseColorTexture"] = {
+                "index": 0
+            }
+        if normal_map_bytes is not None:
+            material["normalTexture"] = {"index": len(images) - 1}
+    gltf["materials"] = [material]
+    gltf["meshes"] = [{
+        "primitives": [{
+            "attributes": {
+                "POSITION": position_accessor,
+                "NORMAL": normal_accessor,
+                "TEXCOORD_0": uv_accessor
+            },
+            "indices": index_accessor,
+            "material": 0,
+            "mode": TRIANGLES
+        }]
+    }]
+    # The node dequantizes the positions
+    gltf["nodes"] = [{
+        "mesh": 0,
+        "translation": offset.tolist(),
+        "scale": step.tolist()
+    }]
+    gltf["scenes"] = [{"nodes": [0]}]
+    gltf["scene"] = 0
+    gltf["extensionsUsed"] = [QUANTIZATION_EXTENSION]
+    gltf["extensionsRequired"] = [QUANTIZATION_EXTENSION]
+    return builder.to_bytes()
+
+
+def read_texture(ctx, filename):
+    """
+    Get the PNG of a texture of a map. Chunked builds paint the texture into
+    its store, so it's encoded from the store when it's newer than the image,
+    which would be left from an older build.
+    Args:
+        ctx(MapContext): The map
+        filename(str): Name of the texture inside the map folder
+    Returns:
+        bytes: The PNG file or None if the map doesn't have the texture
+    """
+    store = ctx.raster_store(filename)
+    if store is not None:
+        png = io.BytesIO()
+        Image.fromarray(np.asarray(store)).save(
+            png, format='PNG', compress_level=ctx.writer.compress_level
+        )
+        return png.getvalue()
+    ctx.writer.wait(ctx.path(filename))
+    if not ctx.has_file(filename):
+        return None
+    with open(ctx.path(filename), 'rb') as f:
+        return f.read()
+
+
+def write_terrain_glb(ctx):
+    """
+    Write the terrain of a map as surface.glb, with surface.png and its
+    normal map embedded when the map has them. Unless the map defines
+    meshMaxError, the mesh is allowed to differ one level of the height map
+    from it, which is the precision of the height map itself.
+    Args:
+        ctx(MapContext): The map to export
+    """
+    images = [
+        read_texture(ctx, filename)
+        for filename in [
+            SURFACE_TEXTURE, normals.get_normal_map_filename(ctx.map_dir)
+        ]
+    ]
+    max_error = ctx.config.get('meshMaxError', ctx.max_height / MAX_COLOR)
+    glb = create_terrain_glb(
+        ctx.height_map, ctx.max_height, ctx.height_map_pixel_size,
+        texture_bytes=images[0], normal_map_bytes=images[1],
+        max_error=max_error
+    )
+    ctx.writer.save_bytes(glb, ctx.path(SURFACE_GLB_FILENAME))
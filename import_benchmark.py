@@ -0,0 +1,92 @@
+import argparse
+import json
+import os.path
+import statistics
+import subprocess
+import sys
+
+# Modules that build maps and must start without the viewers' dependencies
+BUILD_MODULES = ["main", "incremental", "tiling", "watch", "daemon", "server"]
+# Third party packages that the build modules can import
+ALLOWED_PACKAGES = {"numpy", "PIL"}
+DEFAULT_REPEATS = 5
+MS_PER_S = 1000
+IMPORT_SCRIPT = """
+import json, sys, time
+baseline = set(sys.modules)
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{
+    "time": elapsed,
+    "packages": sorted({{
+        name.split('.')[0] for name in set(sys.modules) - baseline
+    }})
+}}))
+"""
+
+
+def measure_import(module):
+    """
+    Import a module in a new interpreter, as a build would start.
+    Args:
+        module(str): Name of the module
+    Returns:
+        dict: Seconds that the import took and top level packages it loaded
+    """
+    result = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT.format(module=module)],
+        capture_output=True, text=True, check=True,
+        cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def is_local(package):
+    root = os.path.dirname(os.path.abspath(__file__))
+    return os.path.isfile(os.path.join(root, f"{package}.py"))
+
+
+def get_forbidden(packages):
+    """Get the third party packages that are not allowed in a build."""
+    return [
+        package for package in packages
+        if package not in sys.stdlib_module_names and
+        package not in ALLOWED_PACKAGES and not package.startswith("_") and
+        not is_local(package)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the cold import time of the build modules and "
+                    "check that they only import NumPy and Pillow"
+    )
+    parser.add_argument("modules", nargs="*", default=BUILD_MODULES)
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS)
+    parser.add_argument(
+        "--max-ms", type=float,
+        help="Fail if the median import time of a module is over this"
+    )
+    args = parser.parse_args()
+    failed = False
+    for module in args.modules:
+        measures = [measure_import(module) for _ in range(args.repeats)]
+        median_ms = statistics.median(
+            m["time"] for m in measures
+        ) * MS_PER_S
+        forbidden = get_forbidden(measures[0]["packages"])
+        status = "ok"
+        if forbidden:
+            status = f"imports {', '.join(forbidden)}"
+            failed = True
+        elif args.max_ms is not None and median_ms > args.max_ms:
+            status = f"over {args.max_ms:g} ms"
+            failed = True
+        print(f"{module}: {median_ms:.1f} ms, {status}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,606 @@
+import json
+import os
+import sys
+
+import numpy as np
+from PIL import Image
+
+# Local modules
+import bitmask
+from constants import *
+import gltf
+import instancing
+import kernels
+import main
+from map_context import MapContext
+import normals
+import occlusion
+import roads
+import tiling
+import utils
+
+STATE_ARRAYS_FILENAME = "build_state.npz"
+STATE_JSON_FILENAME = "build_state.json"
+# Pixels around an edited area of a density map that are dithered again, so
+# that the diffused error of the edit settles before reaching old pixels
+DITHER_SPILL = 8
+# Pixels around an edited area of the height map whose normals change
+NORMAL_SPILL = normals.TILE_HALO
+
+
+def get_dirty_box(old, new):
+    """
+    Get the bounding box of the pixels that are different in two rasters.
+    Args:
+        old(ndarray): Raster of the last build, can be None
+        new(ndarray): Raster of this build, can be None
+    Returns:
+        tuple: Box (top, left, bottom, right) with exclusive bottom and right,
+            or None if the rasters are the same
+    """
+    if old is None and new is None:
+        return None
+    if old is None or new is None or old.shape != new.shape:
+        shape = (new if new is not None else old).shape
+        return 0, 0, shape[0], shape[1]
+    diff = old != new
+    if diff.ndim == 3:
+        diff = diff.any(axis=2)
+    rows = np.flatnonzero(diff.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(diff.any(axis=0))
+    return int(rows[0]), int(cols[0]), int(rows[-1]) + 1, int(cols[-1]) + 1
+
+
+def expand_box(box, radius, shape):
+    """Grow a box by radius pixels in every direction, inside the raster."""
+    if box is None:
+        return None
+    top, left, bottom, right = box
+    return (
+        max(top - radius, 0), max(left - radius, 0),
+        min(bottom + radius, shape[0]), min(right + radius, shape[1])
+    )
+
+
+def union_box(*boxes):
+    boxes = [box for box in boxes if box is not None]
+    if not boxes:
+        return None
+    tops, lefts, bottoms, rights = zip(*boxes)
+    return min(tops), min(lefts), max(bottoms), max(rights)
+
+
+def scale_box(box, from_shape, to_shape):
+    """Convert a box to the pixels of a raster with another resolution."""
+    if box is None:
+        return None
+    top, left, bottom, right = box
+    sy = to_shape[0] / from_shape[0]
+    sx = to_shape[1] / from_shape[1]
+    return (
+        int(top * sy), int(left * sx),
+        min(int(np.ceil(bottom * sy)), to_shape[0]),
+        min(int(np.ceil(right * sx)), to_shape[1])
+    )
+
+
+def box_slices(box):
+    top, left, bottom, right = box
+    return slice(top, bottom), slice(left, right)
+
+
+def get_box_distance(shape, box):
+    """Chessboard distance from every pixel of a raster to a box."""
+    top, left, bottom, right = box
+    rows = np.arange(shape[0])
+    cols = np.arange(shape[1])
+    dy = np.maximum(np.maximum(top - rows, rows - (bottom - 1)), 0)
+    dx = np.maximum(np.maximum(left - cols, cols - (right - 1)), 0)
+    return np.maximum(dy[:, np.newaxis], dx[np.newaxis, :])
+
+
+def update_dist_map(
+        old_dist_map, road_map, road_box, flood_kernel=roads.flood
+):
+    """
+    Update the distance map after editing the roads inside a box. Only the
+    pixels that were not closer to another road than to the box can change,
+    and they are flooded again in a window wide enough to contain their
+    nearest road.
+    Args:
+        old_dist_map(ndarray): Distance map of the last build
+        road_map(ndarray): Edited road map
+        road_box(tuple): Box of the edited pixels of the road map
+        flood_kernel(function): Implementation of flood, see kernels.py
+    Returns:
+        tuple: The new distance map and the box of the pixels that changed
+    """
+    shape = road_map.shape
+    is_affected = old_dist_map >= get_box_distance(shape, road_box)
+    affected_box = get_dirty_box(np.zeros_like(is_affected), is_affected)
+    # Start with the distance of the edited pixels to their nearest road
+    margin = int(old_dist_map[box_slices(road_box)].max()) + 1
+    while True:
+        window = expand_box(affected_box, margin, shape)
+        window_dist_map = roads.create_dist_map(
+            road_map[box_slices(window)], flood_kernel
+        )
+        # Roads outside the window are at least as far as its border, except
+        # in the sides where the window reaches the border of the map
+        rows = np.arange(window[0], window[2])[:, np.newaxis]
+        cols = np.arange(window[1], window[3])[np.newaxis, :]
+        border_dist = np.full(window_dist_map.shape, np.inf)
+        if window[0] > 0:
+            border_dist = np.minimum(border_dist, rows - window[0] + 1)
+        if window[1] > 0:
+            border_dist = np.minimum(border_dist, cols - window[1] + 1)
+        if window[2] < shape[0]:
+            border_dist = np.minimum(border_dist, window[2] - rows)
+        if window[3] < shape[1]:
+            border_dist = np.minimum(border_dist, window[3] - cols)
+        inner = (
+            slice(affected_box[0] - window[0], affected_box[2] - window[0]),
+            slice(affected_box[1] - window[1], affected_box[3] - window[1])
+        )
+        if (window_dist_map[inner] <= border_dist[inner]).all():
+            break
+        margin *= 2
+    dist_map = old_dist_map.copy()
+    dist_map[box_slices(affected_box)] = window_dist_map[inner]
+    return dist_map, get_dirty_box(old_dist_map, dist_map)
+
+
+def update_orientation_map(old_orientation_map, dist_map, dist_box):
+    """
+    Update the orientation map in the pixels whose window of
+    ORIENT_SAMPLE_SIZE reaches a box of changed distances.
+    Args:
+        old_orientation_map(ndarray): Orientation map of the last build
+        dist_map(ndarray): New distance map
+        dist_box(tuple): Box of the pixels of the distance map that changed
+    Returns:
+        tuple: The new orientation map and the box of the pixels updated
+    """
+    half = ORIENT_SAMPLE_SIZE // 2
+    shape = dist_map.shape
+    orient_box = expand_box(dist_box, half, shape)
+    window = expand_box(orient_box, half, shape)
+    window_orientation_map = roads.create_orientation_map(
+        dist_map[box_slices(window)]
+    )
+    orientation_map = old_orientation_map.copy()
+    orientation_map[box_slices(orient_box)] = window_orientation_map[
+        orient_box[0] - window[0]:orient_box[2] - window[0],
+        orient_box[1] - window[1]:orient_box[3] - window[1]
+    ]
+    return orientation_map, orient_box
+
+
+def redither(old_placement_map, density_map, density_box, dither):
+    """
+    Dither again the part of a placement map around the edited pixels of its
+    density map.
+    Args:
+        old_placement_map(ndarray): Placement map of the last build
+        density_map(ndarray): Edited density map
+        density_box(tuple): Box of the edited pixels of the density map
+        dither(function): Dithering function
+    Returns:
+        tuple: The new placement map and the box of the pixels that changed
+    """
+    window = expand_box(density_box, DITHER_SPILL, density_map.shape)
+    placement_map = old_placement_map.copy()
+    placement_map[box_slices(window)] = dither(
+        density_map[box_slices(window)]
+    )
+    return placement_map, get_dirty_box(old_placement_map, placement_map)
+
+
+def place_pixels(placement_map, ecotope, ctx, box=None, occupancy=None):
+    """
+    Place the assets of an ecotope keeping the pixel where each one comes
+    from.
+    Args:
+        placement_map(ndarray): Discretized density map of the ecotope
+        ecotope(dict): The ecotope with its assets
+        ctx(MapContext): The map
+        box(tuple): Only place the pixels inside this box if given
+        occupancy(OccupancyGrid): Grid that the assets must not overlap in
+    Returns:
+        list: [row, column, placement dict] for every placed asset
+    """
+    pixels = np.argwhere(placement_map)
+    if box is not None:
+        top, left, bottom, right = box
+        pixels = pixels[
+            (pixels[:, 0] >= top) & (pixels[:, 0] < bottom) &
+            (pixels[:, 1] >= left) & (pixels[:, 1] < right)
+        ]
+    placed = []
+    for pixel in pixels:
+        for placement in main.procedurally_place(
+                placement_map, ecotope, ctx, pixels=[pixel],
+                occupancy=occupancy
+        ):
+            placed.append([int(pixel[0]), int(pixel[1]), placement])
+    return placed
+
+
+class BuildState:
+    def __init__(self, arrays=None, info=None):
+        """
+        Inputs and intermediate products of the last build of a map, which
+        the next build compares against.
+        Args:
+            arrays(dict): Rasters by name
+            info(dict): Config, ecotopes and placements by ecotope
+        """
+        self.arrays = arrays if arrays is not None else {}
+        self.info = info if info is not None else {}
+
+    @staticmethod
+    def get_dir(ctx):
+        return f"{CACHE_DIR}/{ctx.map_name}"
+
+    @classmethod
+    def load(cls, ctx):
+        """Load the state of the last build, None if there isn't one."""
+        state_dir = cls.get_dir(ctx)
+        arrays_path = f"{state_dir}/{STATE_ARRAYS_FILENAME}"
+        json_path = f"{state_dir}/{STATE_JSON_FILENAME}"
+        if not os.path.isfile(arrays_path) or not os.path.isfile(json_path):
+            return None
+        with np.load(arrays_path) as npz:
+            arrays = dict(npz)
+        with open(json_path, 'r') as f:
+            info = json.load(f)
+        return cls(arrays, info)
+
+    def save(self, ctx):
+        state_dir = self.get_dir(ctx)
+        utils.exist_or_create(CACHE_DIR)
+        utils.exist_or_create(state_dir)
+        np.savez(f"{state_dir}/{STATE_ARRAYS_FILENAME}", **self.arrays)
+        with open(f"{state_dir}/{STATE_JSON_FILENAME}", 'w') as f:
+            json.dump(self.info, f)
+
+    def get(self, name):
+        return self.arrays.get(name)
+
+
+def load_ground(ctx):
+    if not ctx.has_file(GROUND_TEXTURE):
+        return None
+    return np.asarray(Image.open(ctx.path(GROUND_TEXTURE)))
+
+
+def write_placement(ctx, placements, landmarks):
+    placement_json = [
+        placement
+        for ecotope in ctx.ecotopes
+        for _, _, placement in placements[ecotope['name']]
+    ]
+    placement_json += landmarks
+    ctx.writer.save_json(placement_json, ctx.path(PLACEMENT_FILENAME))
+    instancing.write_instance_batches(ctx, placement_json)
+
+
+def update_occlusion_map(old_occlusion_map, ctx, height_box):
+    """
+    Bake the occlusion map again in the rows that the horizon of an edited
+    area of the height map can reach.
+    Args:
+        old_occlusion_map(ndarray): Occlusion map of the last build
+        ctx(MapContext): The map
+        height_box(tuple): Box of the height map that changed
+    Returns:
+        tuple: New occlusion map and box where it changed, or None
+    """
+    settings = occlusion.get_settings(ctx.config)
+    top, _, bottom, _ = expand_box(
+        height_box, occlusion.get_reach(settings['radius']),
+        ctx.height_map.shape
+    )
+    occlusion_map = old_occlusion_map.copy()
+    occlusion_map[top:bottom] = occlusion.bake_occlusion_map(
+        ctx.height_map, memory_budget=ctx.memory_budget, rows=(top, bottom),
+        **settings
+    )
+    return occlusion_map, get_dirty_box(old_occlusion_map, occlusion_map)
+
+
+def repaint_surface(ctx, box):
+    """Paint the surface texture again inside a box of the road map."""
+    ground_texture = load_ground(ctx)
+    if ground_texture is None or ctx.road_map is None:
+        return
+    surface_tex_path = ctx.path(SURFACE_TEXTURE)
+    if box is None and ctx.has_file(SURFACE_TEXTURE):
+        return
+    if box is None or not ctx.has_file(SURFACE_TEXTURE):
+        main.build_surface_texture(ctx)
+        return
+    ctx.writer.wait(surface_tex_path)
+    surface_texture = np.array(Image.open(surface_tex_path).convert('RGB'))
+    rows, cols = box_slices(box)
+    painted = main.paint_surface(
+        ctx.road_map[rows, cols], np.array(ctx.config['roadColor']),
+        ground_texture[rows, cols]
+    )
+    if ctx.occlusion_map is not None:
+        occlusion_map = occlusion.fit(ctx.occlusion_map, surface_texture.shape)
+        painted = occlusion.apply_occlusion(
+            painted, occlusion_map[rows, cols], ctx.occlusion_strength
+        )
+    surface_texture[rows, cols] = painted
+    ctx.writer.save_image(surface_texture, surface_tex_path)
+
+
+def rebake_normal_map(ctx, box):
+    """
+    Bake the normal map again inside a box of the height map, unless the map
+    has a hand-made one.
+    """
+    if ctx.has_file(NORMAL_MAP_FILENAME):
+        return
+    normal_map_path = ctx.path(BAKED_NORMAL_MAP_FILENAME)
+    if box is None and ctx.has_file(BAKED_NORMAL_MAP_FILENAME):
+        return
+    settings = normals.get_settings(ctx.config)
+    shape = normals.get_shape(
+        ctx.height_map.shape, settings['pixel_size'],
+        settings['normal_pixel_size']
+    )
+    normal_map = None
+    if box is not None and ctx.has_file(BAKED_NORMAL_MAP_FILENAME):
+        ctx.writer.wait(normal_map_path)
+        normal_map = np.array(Image.open(normal_map_path).convert('RGB'))
+    if normal_map is None or normal_map.shape[:2] != shape:
+        main.build_normal_map(ctx)
+        return
+    region = scale_box(
+        expand_box(box, NORMAL_SPILL, ctx.height_map.shape),
+        ctx.height_map.shape, shape
+    )
+    normals.bake_normal_map(
+        ctx.height_map, normals.load_water_normals(), out=normal_map,
+        region=region, **settings
+    )
+    ctx.writer.save_image(normal_map, normal_map_path)
+
+
+def build_map(ctx):
+    """
+    Build a map recomputing only what changed since its last build. The
+    inputs are compared with the ones of the last build to get a dirty box
+    per input, which grows with the reach of every stage: the distance map
+    reach of the roads, the window of the orientation map and the error
+    diffusion of the dithering. Only the placement maps, placements, surface
+    texture, normal map and tiles inside those boxes are computed again, and
+    the outputs of the last build are patched. The terrain mesh is global, so
+    it's built again whenever the height map changes. If there is no last
+    build, or the config or the ecotopes changed, the whole map is built.
+    Patched regions are dithered and placed with fresh random numbers, so the
+    result is a valid build of the new inputs but not the same one that a
+    full build would give.
+    Args:
+        ctx(MapContext): The map to build
+    Returns:
+        dict: Dirty box of each stage, all of them None when nothing changed
+    """
+    state = BuildState.load(ctx)
+    is_full = (
+        state is None or
+        state.info.get('config') != ctx.config or
+        state.info.get('ecotopes') != ctx.ecotopes
+    )
+    # Assets face the nearest segment of the road graph, which an edit of the
+    # roads can change far from it
+    if not is_full and ctx.road_graph is not None:
+        old_road_map = state.get('road_map')
+        is_full = get_dirty_box(old_road_map, ctx.road_map) is not None
+    if is_full:
+        state = BuildState()
+    height_map_shape = ctx.height_map.shape
+    ground = load_ground(ctx)
+    road_box = get_dirty_box(state.get('road_map'), ctx.road_map)
+    height_box = get_dirty_box(state.get('height_map'), ctx.height_map)
+    ground_box = get_dirty_box(state.get('ground'), ground)
+    if is_full:
+        road_box = height_box = None
+    # Roads
+    orient_box = None
+    if ctx.road_map is not None and not is_full and road_box is not None:
+        if state.get('road_map') is None:
+            orient_box = road_box
+        else:
+            dist_map, dist_box = update_dist_map(
+                state.get('dist_map'), ctx.road_map, road_box,
+                kernels.get_kernel(kernels.FLOOD, ctx.kernel_backend)
+            )
+            ctx.dist_map = dist_map
+            if dist_box is not None:
+                ctx.orientation_map, orient_box = update_orientation_map(
+                    state.get('orientation_map'), dist_map, dist_box
+                )
+            else:
+                ctx.orientation_map = state.get('orientation_map')
+    elif ctx.road_map is not None and not is_full:
+        ctx.dist_map = state.get('dist_map')
+        ctx.orientation_map = state.get('orientation_map')
+    # Ecotopes
+    density_map_size = ctx.density_map_size
+    density_shape = (density_map_size, density_map_size)
+    combined_density_map = np.zeros(density_shape, dtype=np.float32)
+    if ctx.road_density_map is not None:
+        combined_density_map[:] = ctx.road_density_map
+    # Assets change where orientations or heights changed
+    moved_box = union_box(
+        scale_box(orient_box, height_map_shape, density_shape),
+        scale_box(height_box, height_map_shape, density_shape)
+    )
+    placements = {} if is_full else state.info['placements']
+    placement_boxes = []
+    # Ecotopes with pixels to place, after the kept assets of every ecotope
+    # are in the occupancy grid
+    to_place = []
+    for ecotope in ctx.ecotopes:
+        ecotope_name = ecotope['name']
+        density_map = ctx.density_map(ecotope_name) / np.float32(MAX_COLOR)
+        density_map *= 1 - combined_density_map
+        np.maximum(density_map, combined_density_map, out=combined_density_map)
+        density_key = f"density_{ecotope_name}"
+        old_density_map = state.get(density_key)
+        old_placement_map = None
+        if old_density_map is not None:
+            # Only if it was saved from the density map of the last build
+            old_placement_map = ctx.load_placement_map(
+                ecotope_name, bitmask.get_digest(old_density_map)
+            )
+        density_box = get_dirty_box(old_density_map, density_map)
+        if is_full or old_placement_map is None:
+            placement_map = main.discretize_density(
+                density_map, ecotope_name, ctx
+            )
+            placements[ecotope_name] = []
+            to_place.append((ecotope, placement_map, None))
+            placement_boxes.append((0, 0) + density_shape)
+        else:
+            placement_map = old_placement_map
+            changed_box = None
+            if density_box is not None:
+                placement_map, changed_box = redither(
+                    old_placement_map, density_map, density_box,
+                    kernels.get_kernel(
+                        kernels.FLOYD_STEINBERG, ctx.kernel_backend
+                    )
+                )
+                main.save_placement_map(
+                    placement_map, density_map, ecotope_name, ctx
+                )
+            box = union_box(changed_box, moved_box)
+            if box is not None:
+                top, left, bottom, right = box
+                kept = [
+                    p for p in placements[ecotope_name]
+                    if not (top <= p[0] < bottom and left <= p[1] < right)
+                ]
+                placements[ecotope_name] = kept
+                to_place.append((ecotope, placement_map, box))
+                placement_boxes.append(box)
+        state.arrays[density_key] = density_map
+    landmarks = main.get_landmarks(ctx)
+    if to_place:
+        occupancy = main.create_occupancy(landmarks, ctx)
+        for ecotope_placements in placements.values():
+            for _, _, placement in ecotope_placements:
+                occupancy.stamp(placement)
+        for ecotope, placement_map, box in to_place:
+            placements[ecotope['name']] += place_pixels(
+                placement_map, ecotope, ctx, box, occupancy
+            )
+    placement_box = union_box(*placement_boxes)
+    if placement_box is not None or not ctx.has_file(PLACEMENT_FILENAME):
+        write_placement(ctx, placements, landmarks)
+    # Surface
+    texture_box = union_box(road_box, ground_box)
+    has_surface_texture = ground is not None and ctx.road_map is not None
+    if has_surface_texture and not is_full:
+        # The occlusion of the last build is kept outside the rows that the
+        # edits of the height map reach
+        old_occlusion_map = state.get('occlusion_map')
+        if old_occlusion_map is not None and \
+                not ctx.has_file(AMBIENT_OCCLUSION_FILENAME):
+            occlusion_box = None
+            if height_box is not None:
+                ctx.occlusion_map, occlusion_box = update_occlusion_map(
+                    old_occlusion_map, ctx, height_box
+                )
+            else:
+                ctx.occlusion_map = old_occlusion_map
+        else:
+            occlusion_box = get_dirty_box(old_occlusion_map, ctx.occlusion_map)
+        if occlusion_box is not None and ctx.occlusion_map is not None:
+            main.save_occlusion_map(ctx.occlusion_map, ctx)
+            texture_box = union_box(
+                texture_box,
+                scale_box(
+                    occlusion_box, ctx.occlusion_map.shape, ctx.road_map.shape
+                )
+            )
+    if is_full:
+        main.build_surface_texture(ctx)
+    else:
+        repaint_surface(ctx, texture_box)
+    if is_full:
+        main.build_normal_map(ctx)
+    else:
+        rebake_normal_map(ctx, height_box)
+    if is_full or height_box is not None:
+        main.build_surface(ctx)
+    elif texture_box is not None:
+        # The binary terrain embeds the surface texture
+        gltf.write_terrain_glb(ctx)
+    # Tiles
+    # Placements can move a bit out of their pixel with allowOffset
+    region = union_box(
+        texture_box, height_box,
+        scale_box(
+            expand_box(placement_box, 1, density_shape), density_shape,
+            height_map_shape
+        )
+    )
+    if 'tileSize' in ctx.config and (is_full or region is not None):
+        tiling.create_tiles(
+            ctx, ctx.config['tileSize'],
+            ctx.config.get(
+                'tileTextureSize', tiling.DEFAULT_TILE_TEXTURE_SIZE
+            ),
+            region=None if is_full else region
+        )
+    # Save the state for the next build
+    for name in ['road_map', 'height_map', 'dist_map', 'orientation_map']:
+        value = getattr(ctx, name)
+        if value is not None:
+            state.arrays[name] = np.asarray(value)
+    if ground is not None:
+        state.arrays['ground'] = ground
+    if has_surface_texture and ctx.occlusion_map is not None:
+        state.arrays['occlusion_map'] = ctx.occlusion_map
+    state.info = {
+        'config': ctx.config,
+        'ecotopes': ctx.ecotopes,
+        'placements': placements
+    }
+    state.save(ctx)
+    return {
+        "full": is_full,
+        "roads": road_box,
+        "orientation": orient_box,
+        "height": height_box,
+        "texture": texture_box,
+        "placement": placement_box,
+        "tiles": region
+    }
+
+
+def run():
+    # Load map names
+    with open(MAPS_FILENAME, 'r') as f:
+        cities = json.load(f)
+    option = int(input(utils.menu_str(cities))) - 1
+    if option == EXIT_CODE:
+        sys.exit("You selected to exit the program")
+    timer = utils.Timer()
+    timer.start()
+    dirty_boxes = build_map(MapContext(cities[option].lower()))
+    timer.stop()
+    for stage, box in dirty_boxes.items():
+        print(f"{stage}: {box}")
+    print(f"Elapsed time in the program was {timer}")
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,115 @@
+
+import numpy as np
+
+# Local modules
+from constants import *
+from utils import Point
+
+
+def rotation_matrix(angles):
+    """
+    Create the rotation matrices for Euler angles applied in XYZ order, like
+    three.js does.
+    Args:
+        angles(ndarray): Rotation in radians in the x, y and z axis (N x 3)
+    Returns:
+        ndarray: Rotation matrices (N x 3 x 3)
+    """
+    cos = np.cos(angles)
+    sin = np.sin(angles)
+    n = len(angles)
+    rx = np.zeros([n, 3, 3])
+    rx[:, 0, 0] = 1
+    rx[:, 1, 1] = cos[:, 0]
+    rx[:, 1, 2] = -sin[:, 0]
+    rx[:, 2, 1] = sin[:, 0]
+    rx[:, 2, 2] = cos[:, 0]
+    ry = np.zeros([n, 3, 3])
+    ry[:, 1, 1] = 1
+    ry[:, 0, 0] = cos[:, 1]
+    ry[:, 0, 2] = sin[:, 1]
+    ry[:, 2, 0] = -sin[:, 1]
+    ry[:, 2, 2] = cos[:, 1]
+    rz = np.zeros([n, 3, 3])
+    rz[:, 2, 2] = 1
+    rz[:, 0, 0] = cos[:, 2]
+    rz[:, 0, 1] = -sin[:, 2]
+    rz[:, 1, 0] = sin[:, 2]
+    rz[:, 1, 1] = cos[:, 2]
+    return rx @ ry @ rz
+
+
+def compose_matrices(placements, rng):
+    """
+    Compose the transform matrix of each placement from its position,
+    rotation and scale. Full rotations are resolved here with random angles.
+    Args:
+        placements(list): Placement dicts like the ones in placement.json
+        rng(Generator): Random generator for the full rotations
+    Returns:
+        ndarray: 4x4 matrices in column-major order, as used by three.js
+            (N x 16 float32)
+    """
+    n = len(placements)
+    positions = np.array(
+        [Point.dict_to_arr(p['position']) for p in placements]
+    ).reshape(n, 3)
+    scales = np.array(
+        [Point.dict_to_arr(p['scale']) for p in placements]
+    ).reshape(n, 3)
+    angles = np.zeros([n, 3])
+    for k, placement in enumerate(placements):
+        if placement['rotation'] == FULL_ROTATION:
+            angles[k] = rng.random(3) * 2 * np.pi
+        else:
+            angles[k, 1] = placement['rotation']
+    matrices = np.zeros([n, 4, 4])
+    matrices[:, :3, :3] = rotation_matrix(angles) * scales[:, np.newaxis, :]
+    matrices[:, :3, 3] = positions
+    matrices[:, 3, 3] = 1
+    return np.transpose(matrices, (0, 2, 1)).reshape(n, 16).astype('<f4')
+
+
+def create_instance_batches(placement_json, rng):
+    """
+    Group the placements by asset and compose their transform matrices.
+    Args:
+        placement_json(list): Placement dicts like the ones in placement.json
+        rng(Generator): Random generator for the full rotations
+    Returns:
+        dict: Matrices of the instances (N x 16 float32) for each asset id
+    """
+    placements_by_asset = {}
+    for placement in placement_json:
+        asset_id = placement['assetId']
+        placements_by_asset.setdefault(asset_id, []).append(placement)
+    batches = {}
+    for asset_id in sorted(placements_by_asset):
+        batches[asset_id] = compose_matrices(
+            placements_by_asset[asset_id], rng
+        )
+    return batches
+
+
+def write_instance_batches(ctx, placement_json):
+    """
+    Write a binary file with the packed matrices of each asset and a manifest
+    that lists them, next to placement.json.
+    Args:
+        ctx(MapContext): The map where the files are written
+        placement_json(list): Placement dicts like the ones in placement.json
+    Returns:
+        list: The manifest
+    """
+    batches = create_instance_batches(placement_json, ctx.rng)
+    manifest = []
+    for asset_id, matrices in batches.items():
+        filename = f"{asset_id}_{INSTANCES_BATCH_FILENAME}"
+        ctx.writer.save_bytes(matrices, ctx.path(filename), log=False)
+        manifest.append({
+            'assetId': asset_id,
+            'count': len(matrices),
+            'file': filename
+        })
+    ctx.writer.save_json(manifest, ctx.path(INSTANCES_FILENAME))
+    return manifest
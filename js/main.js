@@ -12,7 +12,15 @@ const gltfLoader = new GLTFLoader();
 const SHADOW_MAP_SIZE = 8192;
 
 
-async function asyncLoad(filepath) {
+async function asyncLoad(filepath, bundle) {
+  const path = filepath.replace(/^\.\.\//, '');
+  if (bundle !== null && bundle.has(path)) {
+    return new Promise(
+      (resolve, reject) => {
+        gltfLoader.parse(bundle.get(path), '', data => resolve(data), reject)
+      }
+    );
+  }
   return new Promise(
     (resolve, reject) => {
       gltfLoader.load(
@@ -22,33 +30,121 @@ async function asyncLoad(filepath) {
   );
 }
 
-async function loadObject(assetObject) {
-  const gltfData = await asyncLoad(assetObject.filepath);
+async function loadObject(assetObject, bundle) {
+  const gltfData = await asyncLoad(assetObject.filepath, bundle);
   const newAsset = gltfData.scene;
   console.log("Loaded: " + assetObject.name);
   return newAsset;
 }
 
-async function loadAssets() {
-  const assetsResponse = await fetch('../js/assets.json');
+// Load every file of a map in a single request when served by server.py.
+// Returns a map from paths relative to the project root to their contents,
+// or null when the bundle endpoint is not available.
+async function loadBundle(mapName) {
+  let response;
+  try {
+    response = await fetch('../bundle/' + mapName);
+  } catch (error) {
+    return null;
+  }
+  if (!response.ok) {
+    return null;
+  }
+  const buffer = await response.arrayBuffer();
+  const indexLength = new DataView(buffer).getUint32(0, true);
+  const index = JSON.parse(
+    new TextDecoder().decode(new Uint8Array(buffer, 4, indexLength))
+  );
+  const filesStart = 4 + indexLength;
+  const bundle = new Map();
+  for (const file of index.files) {
+    const start = filesStart + file.offset;
+    bundle.set(file.path, buffer.slice(start, start + file.length));
+  }
+  return bundle;
+}
+
+// Fetch a file from the bundle if it's there, otherwise from the network
+async function fetchFile(filepath, bundle) {
+  const path = filepath.replace(/^\.\.\//, '');
+  if (bundle !== null && bundle.has(path)) {
+    return new Response(bundle.get(path));
+  }
+  return fetch(filepath);
+}
+
+async function loadAssets(bundle) {
+  const assetsResponse = await fetchFile('../js/assets.json', bundle);
   const assetsJSON = await assetsResponse.json();
-  const assets = [];
-  for (let i = 0; i < assetsJSON.length; i++) {
-    const newAsset = await loadObject(assetsJSON[i]);
-    assets.push(newAsset);
+  // Download and parse all the assets at the same time
+  return Promise.all(
+    assetsJSON.map(assetObject => loadObject(assetObject, bundle))
+  );
+}
+
+async function loadPlacement(mapName, placer, bundle) {
+  // Use the instance batches when the map has them
+  const mapDir = '../assets/' + mapName + '/';
+  const instancesResponse = await fetchFile(
+    mapDir + 'instances.json', bundle
+  );
+  if (instancesResponse.ok) {
+    const manifest = await instancesResponse.json();
+    const buffers = await Promise.all(
+      manifest.map(
+        batch => fetchFile(mapDir + batch.file, bundle).then(
+          response => response.arrayBuffer()
+        )
+      )
+    );
+    placer.useInstances(manifest, buffers);
+  } else {
+    const placementResponse = await fetchFile(
+      mapDir + 'placement.json', bundle
+    );
+    const placement = await placementResponse.json();
+    placer.usePlacement(placement);
   }
-  return assets;
 }
 
-async function loadConfig(mapName) {
-  const configResponse = await fetch('../assets/' + mapName + '/config.json');
+// Reload the parts of the map that change when server.py rebuilds it with
+// --watch. The stream doesn't exist with other servers.
+function watchMap(mapName, surfaceGroup, placementGroup, placer) {
+  const events = new EventSource('../events/' + mapName);
+  events.onerror = () => events.close();
+  events.onmessage = async event => {
+    const message = JSON.parse(event.data);
+    if (message.error !== undefined) {
+      console.error("Build failed: " + message.error);
+      return;
+    }
+    const outputs = message.outputs;
+    const surfaceFiles = ['surface.glb', 'surface.json', 'surface.png'];
+    if (outputs.some(output => surfaceFiles.includes(output))) {
+      surfaceGroup.clear();
+      await addSurface(mapName, surfaceGroup, null, Date.now());
+    }
+    const placementFiles = ['instances.json', 'placement.json'];
+    if (outputs.some(output => placementFiles.includes(output))) {
+      placementGroup.clear();
+      await loadPlacement(mapName, placer, null);
+    }
+    console.log("Reloaded: " + outputs.join(', '));
+  };
+}
+
+async function loadConfig(mapName, bundle) {
+  const configResponse = await fetchFile(
+    '../assets/' + mapName + '/config.json', bundle
+  );
   const config = await configResponse.json();
   return config;
 }
 
 
 export async function main(mapName, skyTexture) {
-  const config = await loadConfig(mapName);
+  const bundle = await loadBundle(mapName);
+  const config = await loadConfig(mapName, bundle);
   const mapSize = config.mapSize;
   const canvas = document.querySelector('#c');
   const renderer = new THREE.WebGLRenderer({
@@ -82,7 +178,9 @@ export async function main(mapName, skyTexture) {
   scene.background = skyTexture;
 
   // Add Surface
-  await addSurface(mapName, scene);
+  const surfaceGroup = new THREE.Group();
+  scene.add(surfaceGroup);
+  await addSurface(mapName, surfaceGroup, bundle);
 
   // Add directional light
   const color = 0xFFFFFF;
@@ -135,16 +233,14 @@ export async function main(mapName, skyTexture) {
   }
 
   // Load assets
-  const assets = await loadAssets();
+  const assets = await loadAssets(bundle);
 
   // Add scene objects from placement map
-  const placer = new Placer(scene, assets);
-  const placementResponse = await fetch(
-    '../assets/' + mapName + '/placement.json'
-  );
-  const placement = await placementResponse.json();
-  placer.usePlacement(placement);
-
+  const placementGroup = new THREE.Group();
+  scene.add(placementGroup);
+  const placer = new Placer(placementGroup, assets);
+  await loadPlacement(mapName, placer, bundle);
+  watchMap(mapName, surfaceGroup, placementGroup, placer);
 
   // Resize display
   function resizeRendererToDisplaySize(renderer) {
@@ -1,4 +1,7 @@
+import * as THREE from 'https://cdn.skypack.dev/three@0.125';
+
 const FULL_ROTATION = "full";
+const MATRIX_SIZE = 16;
 
 
 export default class Placer {
@@ -37,6 +40,36 @@ export default class Placer {
     // console.log("Placed object with id: " + sceneObject.assetId)
   }
 
+  placeInstances(batch, matrices) {
+    // Draw every mesh of the asset once for all the instances
+    const asset = this.assets[batch.assetId - 1];
+    const instanceMatrix = new THREE.Matrix4();
+    const matrix = new THREE.Matrix4();
+    asset.updateMatrixWorld(true);
+    asset.traverse(
+      child => {
+        if (child.isMesh) {
+          const mesh = new THREE.InstancedMesh(
+            child.geometry, child.material, batch.count
+          );
+          for (let i = 0; i < batch.count; i++) {
+            instanceMatrix.fromArray(matrices, i * MATRIX_SIZE);
+            matrix.multiplyMatrices(instanceMatrix, child.matrixWorld);
+            mesh.setMatrixAt(i, matrix);
+          }
+          mesh.castShadow = true;
+          this.scene.add(mesh);
+        }
+      }
+    );
+  }
+
+  useInstances(manifest, buffers) {
+    manifest.forEach(
+      (batch, k) => this.placeInstances(batch, new Float32Array(buffers[k]))
+    );
+  }
+
   usePlacement(placement) {
     placement.forEach(
       item => {
@@ -1,4 +1,5 @@
 import * as THREE from 'https://cdn.skypack.dev/three@0.125';
+import { GLTFLoader } from 'https://cdn.skypack.dev/three@0.125/examples/jsm/loaders/GLTFLoader.js';
 
 const MAX_COLOR = 255;
 
@@ -80,9 +81,30 @@ function getTriangleUVs(verticesUVs) {
 }
 
 
-export default async function addSurface(mapName, scene) {
-  const response = await fetch('../assets/' + mapName + '/surface.json');
-  const surface = await response.json();
+function createAdaptiveGeometry(surface) {
+  // Vertices are (column, row, height) in height map pixels
+  const {vertices, triangles, maxHeight, pixelSize, height, width} = surface;
+  const numVertices = vertices.length / 3;
+  const positions = new Float32Array(numVertices * 3);
+  const uvs = new Float32Array(numVertices * 2);
+  for (let k = 0; k < numVertices; k++) {
+    const i = vertices[3 * k];
+    const j = vertices[3 * k + 1];
+    positions[3 * k] = (i - width / 2) * pixelSize;
+    positions[3 * k + 1] = (vertices[3 * k + 2] / MAX_COLOR) * maxHeight;
+    positions[3 * k + 2] = (j - height / 2) * pixelSize;
+    uvs[2 * k] = i / width;
+    uvs[2 * k + 1] = (height - j) / height;
+  }
+  const geom = new THREE.BufferGeometry();
+  geom.setAttribute('position', new THREE.BufferAttribute(positions, 3));
+  geom.setAttribute('uv', new THREE.BufferAttribute(uvs, 2));
+  geom.setIndex(new THREE.BufferAttribute(new Uint32Array(triangles), 1));
+  return geom;
+}
+
+
+function createGridGeometry(surface) {
   const arrayList = [];
   const uvsList = [];
   const geom = new THREE.BufferGeometry();
@@ -116,12 +138,65 @@ export default async function addSurface(mapName, scene) {
   geom.setAttribute('position', new THREE.BufferAttribute(vertices, 3));
   const uvs = new Float32Array(uvsList);
   geom.setAttribute('uv', new THREE.BufferAttribute(uvs, 2));
+  return geom;
+}
+
+
+// The GLB is a url or the contents of the file when it comes in a bundle
+async function addSurfaceGLB(glb, scene) {
+  const gltfLoader = new GLTFLoader();
+  const gltfData = await new Promise(
+    (resolve, reject) => {
+      if (typeof glb === 'string') {
+        gltfLoader.load(glb, resolve, null, reject);
+      } else {
+        gltfLoader.parse(glb, '', resolve, reject);
+      }
+    }
+  );
+  gltfData.scene.traverse(
+    child => {
+      if (child.isMesh) {
+        child.receiveShadow = true;
+      }
+    }
+  );
+  scene.add(gltfData.scene);
+}
+
+
+export default async function addSurface(mapName, scene, bundle, version) {
+  // The version changes the urls of the files when they are rebuilt
+  const query = version !== undefined ? '?v=' + version : '';
+  const mapDir = '../assets/' + mapName + '/';
+  // Use the exported terrain when the map has one. A bundle has it whenever
+  // it exists, so it isn't requested again
+  const bundlePath = 'assets/' + mapName + '/surface.glb';
+  if (bundle !== undefined && bundle !== null) {
+    if (bundle.has(bundlePath)) {
+      await addSurfaceGLB(bundle.get(bundlePath), scene);
+      return;
+    }
+  } else {
+    const glbPath = mapDir + 'surface.glb' + query;
+    const glbResponse = await fetch(glbPath, {method: 'HEAD'});
+    if (glbResponse.ok) {
+      await addSurfaceGLB(glbPath, scene);
+      return;
+    }
+  }
+  const response = await fetch(mapDir + 'surface.json' + query);
+  const surface = await response.json();
+  // Use the adaptive mesh when the surface has one
+  const geom = surface.triangles !== undefined ?
+    createAdaptiveGeometry(surface) : createGridGeometry(surface);
   geom.computeVertexNormals();
   const textureLoader = new THREE.TextureLoader();
-  const texture = textureLoader.load('../assets/' + mapName + '/surface.png');
-  const normalMap = textureLoader.load(
-    '../assets/' + mapName + '/normal_map.png'
-  )
+  const texture = textureLoader.load(mapDir + 'surface.png' + query);
+  // Builds bake a normal map when the map doesn't have a hand-made one
+  const normalMapFile = surface.normalMap !== undefined ?
+    surface.normalMap : 'normal_map.png';
+  const normalMap = textureLoader.load(mapDir + normalMapFile + query);
   const material = new THREE.MeshStandardMaterial({
     map: texture, side: THREE.DoubleSide, normalMap
   });
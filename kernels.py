@@ -0,0 +1,162 @@
+import argparse
+import importlib.util
+import os
+import time
+
+import numpy as np
+
+# Local modules
+import dithering
+import roads
+
+# Numba is imported only when its kernels are used
+HAS_NUMBA = importlib.util.find_spec("numba") is not None
+
+PYTHON_BACKEND = "python"
+NUMBA_BACKEND = "numba"
+# Environment variable that chooses the backend of a run
+BACKEND_ENV_VAR = "PICTORIAL_MAP_KERNELS"
+# Kernels
+FLOYD_STEINBERG = "floyd_steinberg_dithering"
+FLOOD = "flood"
+MAX_COLOR = 255
+
+
+def get_backends():
+    """Get the names of the backends that can be used."""
+    return [PYTHON_BACKEND] + ([NUMBA_BACKEND] if HAS_NUMBA else [])
+
+
+def get_kernels(backend):
+    """
+    Get the kernels of a backend. Numba is only imported here, so that
+    processes that don't use it, or that fork workers before using it, never
+    load it.
+    Args:
+        backend(str): Name of the backend
+    Returns:
+        dict: Kernel functions by name
+    """
+    if backend == NUMBA_BACKEND:
+        import numba_kernels
+        return {
+            FLOYD_STEINBERG: numba_kernels.floyd_steinberg_dithering,
+            FLOOD: numba_kernels.flood
+        }
+    return {
+        FLOYD_STEINBERG: dithering.floyd_steinberg_dithering,
+        FLOOD: roads.flood
+    }
+
+
+def get_backend(backend=None):
+    """
+    Get the backend of a run: the given one, the one in the environment
+    variable PICTORIAL_MAP_KERNELS or Numba if it's installed, in that order.
+    Args:
+        backend(str): Name of the backend
+    Returns:
+        str: Name of the backend
+    """
+    if backend is None:
+        backend = os.environ.get(BACKEND_ENV_VAR)
+    if backend is None:
+        backend = NUMBA_BACKEND if HAS_NUMBA else PYTHON_BACKEND
+    if backend not in get_backends():
+        raise ValueError(
+            f"Kernel backend {backend} is not available, the available ones "
+            f"are {', '.join(get_backends())}"
+        )
+    return backend
+
+
+def get_kernel(name, backend=None):
+    """
+    Get a kernel of a backend, see get_backend.
+    Args:
+        name(str): Name of the kernel, FLOYD_STEINBERG or FLOOD
+        backend(str): Name of the backend
+    Returns:
+        function: The kernel
+    """
+    return get_kernels(get_backend(backend))[name]
+
+
+def get_test_inputs(rng, size):
+    """Get inputs for every kernel, like the ones of a map."""
+    road_map = np.zeros([size, size], dtype=np.uint8)
+    road_map[size // 3, :] = MAX_COLOR
+    road_map[:, size // 2] = MAX_COLOR
+    road_map[rng.random([size, size]) < 0.001] = MAX_COLOR
+    road_map = np.array(roads.high_pass(road_map, MAX_COLOR), dtype=np.uint8)
+    return {
+        FLOYD_STEINBERG: [
+            rng.random([size, size]).astype(np.float32),
+            rng.random([size, size]) * 0.2,
+            np.full([size, size], 0.5, dtype=np.float32)
+        ],
+        FLOOD: [
+            road_map,
+            np.zeros([size, size], dtype=np.uint8),
+            np.full([size, size], MAX_COLOR, dtype=np.uint8)
+        ]
+    }
+
+
+def check_backend(backend, size, seed=0):
+    """
+    Check that every kernel of a backend gives the same output as the
+    reference backend and compare their times.
+    Args:
+        backend(str): Name of the backend
+        size(int): Side of the test rasters
+        seed(int): Seed of the random inputs
+    Returns:
+        bool: Whether every output is the same
+    """
+    reference = get_kernels(PYTHON_BACKEND)
+    kernels = get_kernels(backend)
+    inputs = get_test_inputs(np.random.default_rng(seed), size)
+    same = True
+    for name, kernel in kernels.items():
+        for i, arr in enumerate(inputs[name]):
+            # Compile for the dtype before measuring
+            kernel(arr[:2, :2].copy())
+            start = time.perf_counter()
+            expected = reference[name](arr)
+            reference_time = time.perf_counter() - start
+            start = time.perf_counter()
+            output = kernel(arr)
+            kernel_time = time.perf_counter() - start
+            is_same = (
+                output.dtype == expected.dtype and
+                np.array_equal(output, expected)
+            )
+            same = same and is_same
+            print(
+                f"{name} {i} ({arr.dtype}): "
+                f"{'same' if is_same else 'DIFFERENT'}, "
+                f"{reference_time:.3f}s -> {kernel_time:.4f}s "
+                f"({reference_time / max(kernel_time, 1e-9):.0f}x)"
+            )
+    return same
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check that the kernel backends give the same outputs as "
+                    "the pure Python reference"
+    )
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    backends = [b for b in get_backends() if b != PYTHON_BACKEND]
+    if not backends:
+        print("Only the python backend is available, install numba")
+        return
+    if not all(check_backend(b, args.size, args.seed) for b in backends):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
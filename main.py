@@ -1,15 +1,32 @@
+import functools
 import json
 import math
 import sys
 
 import numpy as np
-import os.path
 from PIL import Image
 
 # Local modules
+import artifacts
+from artifacts import ArtifactWriter
+import bitmask
 from constants import FULL_ROTATION, RANDOM_ROTATION
 import dithering
+import gltf
+import instancing
+import kernels
+from map_context import MapContext
+import memory
+import normals
+import occlusion
+from occupancy import OccupancyGrid
+import pipeline
+from pipeline import PROCESS, Stage
+from rasterstore import ChunkedRaster
+import rasterstore
 import roads
+import rtin
+import tiling
 from utils import COLOR_CHANNELS
 from utils import Point
 import utils
@@ -20,11 +37,16 @@ DEBUG_DIR = "debug"
 ASSETS_DIR = "assets"
 # Maps
 DENSITY_FILENAME = "density_map.png"
-PLACEMENT_MAP_FILENAME = "placement_map.jpg"
+PLACEMENT_MAP_FILENAME = "placement_map.bits"  # packed bits
+PLACEMENT_PREVIEW_FILENAME = "placement_map.png"
 HEIGHT_MAP_FILENAME = "height_map.png"
 ROAD_MAP_FILENAME = "road_map.png"
 DIST_MAP_FILENAME = "dist_map.png"
 ORIENT_MAP_FILENAME = "orient_map.png"
+NORMAL_MAP_FILENAME = "normal_map.png"
+BAKED_NORMAL_MAP_FILENAME = "baked_normal_map.png"
+OCCLUSION_MAP_FILENAME = "occlusion_map.png"
+AMBIENT_OCCLUSION_FILENAME = "ambient_occlusion.PNG"
 # JSONs
 SURFACE_FILENAME = "surface.json"
 PLACEMENT_FILENAME = "placement.json"
@@ -41,47 +63,106 @@ ROUND_DECIMALS = 3
 # Indent 2 spaces in JSON files
 JSON_INDENT = 2
 EXIT_CODE = -1
-rng = np.random.default_rng()
-chosen_option = "shechem"
-config = {}
-# Orientation sample size
-ORIENT_SAMPLE_SIZE = 5
+# Bytes of float64 arrays per pixel while painting the surface
+PAINT_BYTES_PER_PIXEL = 80
 
 
 # noinspection PyTypeChecker
-def paint_surface(road_map, road_color, ground_texture):
+def paint_surface(road_map, road_color, ground_texture, memory_budget=None):
     """
     Create a texture for the surface (road + ground)
     Args:
-        road_map(Image): Map where each pixel represents the density of road
+        road_map(ndarray): Map where each pixel represents the density of road
         road_color(ndarray): RGB color for the road
         ground_texture(ndarray): RGB texture for the ground
+        memory_budget(int): Memory budget of the build in bytes, the texture
+            is painted in bands of rows that fit in it
     Returns:
         2darray: Texture with the colors for the surface in uint8
     """
-    road_map_arr = np.asarray(road_map) / MAX_COLOR
-    h, w = road_map_arr.shape
+    h, w = road_map.shape
     surface_texture = np.zeros([h, w, COLOR_CHANNELS], dtype=np.uint8)
-    for j in range(h):
-        for i in range(w):
-            # Ground texture will need to match shape of road map
-            ground_color = ground_texture[j][i]
-            road_weight = road_map_arr[j][i]
-            surface_texture[j][i] = (
-                road_weight * road_color + (1 - road_weight) * ground_color
-            )
+    band_rows = memory.get_band_rows(
+        h, w * PAINT_BYTES_PER_PIXEL, memory_budget
+    )
+    for top in range(0, h, band_rows):
+        rows = slice(top, top + band_rows)
+        # Ground texture will need to match shape of road map
+        road_weight = (road_map[rows] / MAX_COLOR)[..., np.newaxis]
+        surface_texture[rows] = (
+            road_weight * road_color +
+            (1 - road_weight) * ground_texture[rows]
+        )
     return surface_texture
 
 
-def create_surface(height_map, max_height, pixel_size):
+def paint_surface_store(
+        road_store, road_color, ground_store, surface_store, memory_budget=None
+):
+    """
+    Paint the surface texture of chunked road and ground maps chunk by
+    chunk, see paint_surface.
+    Args:
+        road_store(ChunkedRaster): Road map
+        road_color(ndarray): RGB color for the road
+        ground_store(ChunkedRaster): RGB texture for the ground
+        surface_store(ChunkedRaster): RGB store with the same layout where
+            the texture is written
+        memory_budget(int): Memory budget of the build in bytes
+    Returns:
+        ChunkedRaster: surface_store
+    """
+    for box, _ in road_store.windows():
+        surface_store.write(
+            box[0], box[1],
+            paint_surface(
+                road_store.read(box), road_color, ground_store.read(box),
+                memory_budget
+            )
+        )
+    surface_store.flush()
+    return surface_store
+
+
+def save_occlusion_map(occlusion_map, ctx):
+    """Write occlusion_map.png when it was baked, not made by hand."""
+    if not ctx.has_file(AMBIENT_OCCLUSION_FILENAME):
+        ctx.writer.save_image(occlusion_map, ctx.path(OCCLUSION_MAP_FILENAME))
+
+
+def shade_surface(surface_texture, occlusion_map, ctx):
+    """
+    Darken the surface texture where the terrain is occluded and write the
+    occlusion map.
+    Args:
+        surface_texture(ndarray): RGB texture of the surface
+        occlusion_map(ndarray): Light of each pixel, None for no occlusion
+        ctx(MapContext): The map
+    Returns:
+        ndarray: The darkened texture
+    """
+    if occlusion_map is None:
+        return surface_texture
+    save_occlusion_map(occlusion_map, ctx)
+    return occlusion.apply_occlusion(
+        surface_texture, occlusion_map, ctx.occlusion_strength
+    )
+
+
+def create_surface(height_map, max_height, pixel_size, max_error=None,
+                   normal_map=None):
     """
     Create a JSON with the necessary information to build the surface of a map
     Args:
         height_map(2darray): Map where each pixel represents a height (uint8)
         max_height(float): Maximum height for all vertices
         pixel_size(float): Length of a side of a pixel in the height map
+        max_error(float): If given, add an adaptive mesh whose heights differ
+            at most this value (in world units) from the height map
+        normal_map(str): If given, name of the normal map of the surface
     Returns:
-        dict: A JSON with the necessary info for creating the surface of the map
+        dict: A JSON with the necessary info for creating the surface of the
+            map
     """
     height, width = height_map.shape
     surface_object = {
@@ -91,10 +172,20 @@ def create_surface(height_map, max_height, pixel_size):
         "height": height,
         "width": width
     }
+    if normal_map is not None:
+        surface_object["normalMap"] = normal_map
+    if max_error is not None:
+        vertices, triangles = rtin.RTIN(height_map).get_mesh(
+            max_error / max_height * MAX_COLOR
+        )
+        surface_object["vertices"] = (
+            np.round(vertices, ROUND_DECIMALS).ravel().tolist()
+        )
+        surface_object["triangles"] = triangles.ravel().tolist()
     return surface_object
 
 
-def discretize_density(density_map, ecotope_name):
+def discretize_density(density_map, ecotope_name, ctx):
     # Discretize Density Map
     # opt = input(
     #     "Enter an option:\n"
@@ -108,90 +199,117 @@ def discretize_density(density_map, ecotope_name):
     # Discretize with Dithering
     if opt == '1':
         print("Using Floyd-Steinberg Error Diffusion Dithering...")
-        output = dithering.floyd_steinberg_dithering(density_map)
+        dither = kernels.get_kernel(
+            kernels.FLOYD_STEINBERG, ctx.kernel_backend
+        )
     else:
         print("Using Ordered Dithering...")
-        output = dithering.ordered_dithering(density_map)
-    # Save as Placement Map
-    output_img = Image.fromarray(output)
-    placement_map_path = (
-        f"assets/{chosen_option}/{ecotope_name}_{PLACEMENT_MAP_FILENAME}"
-    )
-    output_img.save(placement_map_path, quality=MAX_QUALITY)
-    print(f"Image saved in {placement_map_path}")
+        dither = dithering.ordered_dithering
+    # Reuse the placement map of the last build if the density didn't change
+    output = ctx.get_placement_map(ecotope_name, density_map, dither)
+    save_placement_map(output, density_map, ecotope_name, ctx)
     return output
 
 
-def get_height(x, z, height_map):
+def save_placement_map(placement_map, density_map, ecotope_name, ctx):
+    """
+    Save a placement map as packed bits, with the digest of the density map
+    it was discretized from so that later builds can reuse it, and a PNG of
+    it as a debug artifact.
+    Args:
+        placement_map(ndarray): The placement map
+        density_map(ndarray): Density map it was discretized from
+        ecotope_name(str): Name of the ecotope
+        ctx(MapContext): The map
+    """
+    ctx.writer.save_mask(
+        placement_map, ctx.path(f"{ecotope_name}_{PLACEMENT_MAP_FILENAME}"),
+        bitmask.get_digest(density_map)
+    )
+    if not ctx.writer.debug:
+        return
+    debug_dir = f'{DEBUG_DIR}/{ctx.map_name}'
+    utils.exist_or_create(f'{DEBUG_DIR}')
+    utils.exist_or_create(debug_dir)
+    preview = (np.asarray(placement_map) > 0).astype(np.uint8) * MAX_COLOR
+    ctx.writer.save_image(
+        preview, f'{debug_dir}/{ecotope_name}_{PLACEMENT_PREVIEW_FILENAME}',
+        debug=True
+    )
+
+
+def dither_uncached(density_map, cached_placement_map, kernel_backend):
+    """Floyd-Steinberg dithering unless a saved placement map can be used."""
+    if cached_placement_map is not None:
+        return cached_placement_map
+    dither = kernels.get_kernel(kernels.FLOYD_STEINBERG, kernel_backend)
+    return dither(density_map)
+
+
+def create_dist_map(road_map, kernel_backend):
+    """roads.create_dist_map with the flood kernel of a backend."""
+    return roads.create_dist_map(
+        road_map, kernels.get_kernel(kernels.FLOOD, kernel_backend)
+    )
+
+
+def save_dist_map(dist_map, ctx):
+    """
+    Save the distance map as a debug artifact.
+    Args:
+        dist_map(ndarray): Map with the distances from the roads
+        ctx(MapContext): The map
+    """
+    # Chunked distance maps are already on disk, in the cache
+    if not ctx.writer.debug or isinstance(dist_map, ChunkedRaster):
+        return
+    debug_dir = f'{DEBUG_DIR}/{ctx.map_name}'
+    utils.exist_or_create(f'{DEBUG_DIR}')
+    utils.exist_or_create(debug_dir)
+    ctx.writer.save_image(
+        dist_map, f'{debug_dir}/{DIST_MAP_FILENAME}', debug=True
+    )
+
+
+def get_height(x, z, ctx):
     """
     Get the height for an asset to be placed in the map. It uses image
     interpolation in the height map.
     Args:
         x: position of the asset in the x axis
         z: position of the asset in the x axis
-        height_map: the map with height information as a float 2D array
+        ctx(MapContext): the map with the normalized height map
 
     Returns:
         float: height for the given position
     """
     # Add 0.5 because the origin is moved to the middle of the
+    height_map = ctx.normalized_height_map
     h, w = height_map.shape
-    max_height = config['maxHeight']
-    height_map_pixel_size = config['heightMapPixelSize']
-    u = x / (w * height_map_pixel_size) + 0.5
-    v = -z / (h * height_map_pixel_size) + 0.5
+    u = x / (w * ctx.height_map_pixel_size) + 0.5
+    v = -z / (h * ctx.height_map_pixel_size) + 0.5
     normalized_height = utils.blerp(u, v, height_map)
-    height = normalized_height * max_height
+    height = normalized_height * ctx.max_height
     return height
 
 
-def get_min_dist(dist_map, i, j):
-    min_i = i
-    min_j = j
-    min_sq_dist = 2 * (ORIENT_SAMPLE_SIZE ** 2)
-    min_dist = MAX_COLOR
-    h, w = dist_map.shape
-    # Case out of map
-    if not 0 <= i < w or not 0 <= j < h:
-        return i, j
-    for b in range(ORIENT_SAMPLE_SIZE):
-        current_j = j - ORIENT_SAMPLE_SIZE // 2 + b
-        if not 0 <= current_j < h:
-            continue
-        for a in range(ORIENT_SAMPLE_SIZE):
-            current_i = i - ORIENT_SAMPLE_SIZE // 2 + a
-            if not 0 <= current_i < w:
-                continue
-            current_sq_dist = (i - current_i) ** 2 + (j - current_j) ** 2
-            current_dist = dist_map[current_j][current_i]
-            same_dist_less_eucl = (
-                current_dist == min_dist and current_sq_dist < min_sq_dist
-            )
-            if current_dist < min_dist or same_dist_less_eucl:
-                min_i = current_i
-                min_j = current_j
-                min_dist = current_dist
-                min_sq_dist = current_sq_dist
-    return min_i, min_j
-
-
-def get_orientation(x, z, dist_map):
-    h, w = dist_map.shape
-    height_map_pixel_size = config['heightMapPixelSize']
-    u = x / (w * height_map_pixel_size) + 0.5
-    v = -z / (h * height_map_pixel_size) + 0.5
+def get_orientation(x, z, ctx):
+    if ctx.road_graph is not None:
+        # The graph has the nearest road at any distance, even out of the map
+        h, w = ctx.road_graph.shape
+        u = x / (w * ctx.height_map_pixel_size) + 0.5
+        v = -z / (h * ctx.height_map_pixel_size) + 0.5
+        return ctx.road_graph.get_facing(u * w, v * h)
+    orientation_map = ctx.orientation_map
+    h, w = orientation_map.shape
+    u = x / (w * ctx.height_map_pixel_size) + 0.5
+    v = -z / (h * ctx.height_map_pixel_size) + 0.5
     i = int(round(u * w))
     j = int(round(v * h))
-    min_dist_pixel = get_min_dist(dist_map, i, j)
-    dx = min_dist_pixel[0] - i
-    dy = j - min_dist_pixel[1]
-    orient_unit_vector = utils.normalize([dx, dy])
-    # Get the angle of rotation in the Z axis
-    rotation = np.arccos(orient_unit_vector[0])
-    # If y component of orient vector is negative, rotate negative angle
-    if orient_unit_vector[1] < 0:
-        rotation = -rotation
-    return rotation
+    # Case out of map, there is no road to face
+    if not 0 <= i < w or not 0 <= j < h:
+        return math.pi / 2
+    return float(orientation_map[j, i])
 
 
 def fix_rotation(rotation, asset_id):
@@ -203,7 +321,8 @@ def fix_rotation(rotation, asset_id):
         return rotation
 
 
-def place_asset(asset, i, j, w, h, footprint, height_map, dist_map=None):
+def place_asset(asset, i, j, w, h, footprint, ctx):
+    rng = ctx.rng
     # Position
     if 'allowOffset' in asset:
         position_offset = (-0.5 + rng.random(2)) * asset['allowOffset']
@@ -211,7 +330,7 @@ def place_asset(asset, i, j, w, h, footprint, height_map, dist_map=None):
         position_offset = np.zeros(2)
     x = (i - w / 2 + 0.5 + position_offset[0]) * footprint
     z = (j - h / 2 + 0.5 + position_offset[1]) * footprint
-    y = get_height(x, z, height_map)
+    y = get_height(x, z, ctx)
     pos = Point(x, y, z)
     # Scale
     if 'allowScale' in asset:
@@ -230,8 +349,8 @@ def place_asset(asset, i, j, w, h, footprint, height_map, dist_map=None):
         else:
             rotation = rng.random() * asset['allowRotation']
     else:
-        if dist_map is not None:
-            rotation = get_orientation(x, z, dist_map)
+        if ctx.road_graph is not None or ctx.orientation_map is not None:
+            rotation = get_orientation(x, z, ctx)
         else:
             rotation = 0
     # REMOVE THIS LINE (IT'S ONLY FOR THIS ASSETS)
@@ -247,148 +366,110 @@ def place_asset(asset, i, j, w, h, footprint, height_map, dist_map=None):
     return placement_dict
 
 
-def procedurally_place(placement_map, ecotope, height_map, dist_map=None):
-    pixel_size = config['densityMapPixelSize']
-    ratio = int(pixel_size // ecotope['footprint'])
-    if ratio > 1:
-        # Divide the pixels so that multiple assets can be placed
-        placement_map = utils.resize(placement_map, ratio)
-        footprint = pixel_size / ratio
-    else:
-        footprint = pixel_size
+def procedurally_place(
+        placement_map, ecotope, ctx, pixels=None, occupancy=None
+):
+    """
+    Place the assets of an ecotope in the occupied pixels of its placement
+    map.
+    Args:
+        placement_map(ndarray): Discretized density map of the ecotope
+        ecotope(dict): The ecotope with its assets
+        ctx(MapContext): The map
+        pixels(ndarray): (row, column) of the occupied pixels to place, all of
+            them if None
+        occupancy(OccupancyGrid): If given, assets that overlap the ones
+            already in it are dropped, and the rest are added to it
+    Returns:
+        list: Placement dicts
+    """
+    pixel_size = ctx.density_map_pixel_size
+    # Each occupied pixel is divided in ratio x ratio cells so that multiple
+    # assets can be placed
+    ratio = max(int(pixel_size // ecotope['footprint']), 1)
+    footprint = pixel_size / ratio
     h, w = placement_map.shape
+    h *= ratio
+    w *= ratio
     # Iterate placing assets
     placement_json = []
-    # Create a height map array with float values between 0 and 1
-    normalized_height_map = np.array(height_map, dtype=float) / MAX_COLOR
-    # Iterate on pixels
-    for j in range(h):
-        for i in range(w):
-            if placement_map[j][i]:
-                p = rng.random()
+    # Iterate only on occupied pixels, generating the positions of their cells
+    if pixels is None:
+        pixels = np.argwhere(placement_map)
+    for pixel_j, pixel_i in pixels:
+        for b in range(ratio):
+            j = pixel_j * ratio + b
+            for a in range(ratio):
+                i = pixel_i * ratio + a
+                p = ctx.rng.random()
                 accumulated_prob = 0
                 for asset in ecotope['data']:
                     accumulated_prob += asset['probability']
                     if p <= accumulated_prob:
                         placement_dict = place_asset(
-                            asset, i, j, w, h, footprint,
-                            normalized_height_map, dist_map
+                            asset, i, j, w, h, footprint, ctx
                         )
-                        placement_json.append(placement_dict)
+                        if occupancy is None or occupancy.place(
+                                placement_dict
+                        ):
+                            placement_json.append(placement_dict)
                         break
     return placement_json
 
 
-def main():
-    global chosen_option
-    global config
-    # Load map names
-    with open(MAPS_FILENAME, 'r') as f:
-        cities = json.load(f)
-    option = int(input(utils.menu_str(cities))) - 1
-    if option == EXIT_CODE:
-        sys.exit("You selected to exit the program")
-    chosen_option = cities[option].lower()
-
-    timer = utils.Timer()
-    timer.start()
-    # Load map config
-    config_path = f"assets/{chosen_option}/{CONFIG_FILENAME}"
-    with open(config_path, 'r') as f:
-        config = json.load(f)
-    height_map_pixel_size = config['heightMapPixelSize']
-    max_height = config['maxHeight']
-    density_map_pixel_size = config['densityMapPixelSize']
-    road_color = np.array(config['roadColor'])
-    # Load height map
-    height_map_path = f"assets/{chosen_option}/{HEIGHT_MAP_FILENAME}"
-    if not os.path.isfile(height_map_path):
-        print(f"Height map {height_map_path} not found")
-    img = Image.open(height_map_path)
-    height_map_img = img.convert('L')
-    height_map = np.array(height_map_img, dtype=np.uint8)
-
-    # Load road map
-    road_map_path = f"assets/{chosen_option}/{ROAD_MAP_FILENAME}"
-
-    density_map_size = int(
-        math.ceil(
-            (height_map.shape[0] * height_map_pixel_size) /
-            density_map_pixel_size
-        )
-    )
-    new_size = (density_map_size, density_map_size)
-    if not os.path.isfile(road_map_path):
-        road_map = None
-        dist_map = None
-    else:
-        utils.exist_or_create(f'{DEBUG_DIR}')
-        utils.exist_or_create(f'{DEBUG_DIR}/{chosen_option}')
-        road_map = Image.open(road_map_path).convert('L')
-        dist_map = roads.create_dist_map(road_map)
-        dist_map_img = Image.fromarray(dist_map)
-        dist_map_img.save(f'{DEBUG_DIR}/{chosen_option}/{DIST_MAP_FILENAME}')
-    # Load ecotopes
-    ecotopes_path = f"assets/{chosen_option}/{ECOTOPES_FILENAME}"
-    with open(ecotopes_path, 'r') as f:
-        ecotopes = json.load(f)
+def place_ecotopes(ctx, occupancy=None):
+    """
+    Discretize the density map of every ecotope and place its assets.
+    Args:
+        ctx(MapContext): The map to build
+        occupancy(OccupancyGrid): Grid that assets must not overlap in, the
+            assets of each ecotope are added to it
+    Returns:
+        list: Placement dicts of all the ecotopes
+    """
+    if ctx.dist_map is not None:
+        save_dist_map(ctx.dist_map, ctx)
     # Iterate on ecotopes
     placement_json = []
-    ecotopes = sorted(ecotopes, key=lambda e: e['priority'])
-    combined_density_map = np.zeros([density_map_size, density_map_size])
-    ones = np.ones([density_map_size, density_map_size])
+    density_map_size = ctx.density_map_size
+    combined_density_map = np.zeros(
+        [density_map_size, density_map_size], dtype=np.float32
+    )
     # Combine road maps so density maps don't use that part
-    if road_map is not None:
-        resized_road_map = road_map.resize(new_size)
-        resized_road_map = np.array(resized_road_map, dtype=np.uint8)
-        # high pass the road map
-        resized_road_map = roads.high_pass(resized_road_map, MAX_COLOR)
-        combined_density_map = (
-            np.asarray(resized_road_map, dtype=float) / MAX_COLOR
-        )
+    if ctx.road_density_map is not None:
+        combined_density_map[:] = ctx.road_density_map
     # Combine ecotopes iterating them by hierarchy level
-    for ecotope in ecotopes:
+    for ecotope in ctx.ecotopes:
         ecotope_name = ecotope['name']
-        density_map_file = (
-            f"assets/{chosen_option}/{ecotope_name}_density_map.png"
-        )
         # Open Density Map
-        img = Image.open(density_map_file)
-        grayscale = img.convert('L')
-        density_map = np.array(grayscale, dtype=float) / MAX_COLOR
-        density_map = density_map * (ones - combined_density_map)
+        density_map = ctx.density_map(ecotope_name) / np.float32(MAX_COLOR)
+        density_map *= 1 - combined_density_map
         # Retain the densities of the previous ecotopes to not place elements
         # over each other
-        combined_density_map = np.maximum(density_map, combined_density_map)
+        np.maximum(density_map, combined_density_map, out=combined_density_map)
         # Discretize
-        placement_map = discretize_density(density_map, ecotope_name)
+        placement_map = discretize_density(density_map, ecotope_name, ctx)
         # Procedurally place
         placement_json += procedurally_place(
-            placement_map, ecotope, height_map, dist_map
+            placement_map, ecotope, ctx, occupancy=occupancy
         )
-    # Create the texture for the surface
-    ground_img_path = f"assets/{chosen_option}/{GROUND_TEXTURE}"
-    if os.path.isfile(ground_img_path) and road_map is not None:
-        ground_img = Image.open(ground_img_path)
-        ground_texture = np.asarray(ground_img)
-        surface_texture = paint_surface(road_map, road_color, ground_texture)
-        surface_tex_img = Image.fromarray(surface_texture)
-        surface_tex_path = f"assets/{chosen_option}/{SURFACE_TEXTURE}"
-        surface_tex_img.save(surface_tex_path)
-        print(f"Image saved in {surface_tex_path}")
-    # Create surface JSON from height map
-    surface_json = create_surface(height_map, max_height, height_map_pixel_size)
-    # Store triangles into surface JSON
-    surface_path = f"assets/{chosen_option}/{SURFACE_FILENAME}"
-    with open(surface_path, 'w') as f:
-        json.dump(surface_json, f, indent=JSON_INDENT)
-    print(f"Finished writing surface json file in {surface_path}")
+    return placement_json
+
+
+def get_landmarks(ctx):
+    """
+    Get the placement dicts of the landmarks of a map.
+    Args:
+        ctx(MapContext): The map
+    Returns:
+        list: Placement dicts of the landmarks
+    """
+    placement_json = []
     # LANDMARKS REMOVE THIS
-    if chosen_option == 'jerusalem':
+    if ctx.map_name == 'jerusalem':
         x = 194 - 320 / 2
         z = 93 - 320 / 2
-        normalized_height_map = np.array(height_map, dtype=float) / MAX_COLOR
-        y = get_height(x, z, normalized_height_map)
+        y = get_height(x, z, ctx)
         pos = Point(x, y, z)
         s = Point(1, 1, 1)
         placement_dict = {
@@ -398,11 +479,10 @@ def main():
             'scale': s.to_dict()
         }
         placement_json.append(placement_dict)
-    if chosen_option == 'shechem':
+    if ctx.map_name == 'shechem':
         x = 243 - 320 / 2
         z = 153 - 320 / 2
-        normalized_height_map = np.array(height_map, dtype=float) / MAX_COLOR
-        y = get_height(x, z, normalized_height_map)
+        y = get_height(x, z, ctx)
         pos = Point(x, y, z)
         s = Point(3, 3, 3)
         placement_dict = {
@@ -412,12 +492,464 @@ def main():
             'scale': s.to_dict()
         }
         placement_json.append(placement_dict)
+    return placement_json
+
+
+def create_occupancy(landmarks, ctx):
+    """
+    Create the occupancy grid of a map with its landmarks, so that assets
+    are never placed over them.
+    Args:
+        landmarks(list): Placement dicts of the landmarks
+        ctx(MapContext): The map
+    Returns:
+        OccupancyGrid: The grid
+    """
+    occupancy = OccupancyGrid.from_map(ctx)
+    for placement_dict in landmarks:
+        occupancy.stamp(placement_dict)
+    return occupancy
+
+
+def build_placement(ctx):
+    """
+    Place the assets of every ecotope and the landmarks and write
+    placement.json and the instance batches.
+    Args:
+        ctx(MapContext): The map to build
+    """
+    landmarks = get_landmarks(ctx)
+    occupancy = create_occupancy(landmarks, ctx)
+    placement_json = place_ecotopes(ctx, occupancy) + landmarks
     # Save placement array in JSON
-    placement_path = f"assets/{chosen_option}/{PLACEMENT_FILENAME}"
-    with open(placement_path, 'w') as f:
-        json.dump(placement_json, f, indent=JSON_INDENT)
-    print(f"Finished writing placement json file in {placement_path}")
+    ctx.writer.save_json(placement_json, ctx.path(PLACEMENT_FILENAME))
+    # Save the placement grouped by asset for instanced drawing
+    instancing.write_instance_batches(ctx, placement_json)
+
+
+def build_surface_texture(ctx):
+    """
+    Paint the roads over the ground texture and write surface.png, when the
+    map has both.
+    Args:
+        ctx(MapContext): The map to build
+    """
+    if not ctx.has_file(GROUND_TEXTURE) or ctx.road_map is None:
+        return
+    road_color = np.array(ctx.config['roadColor'])
+    ground_img = Image.open(ctx.path(GROUND_TEXTURE))
+    ground_texture = np.asarray(ground_img)
+    surface_texture = paint_surface(
+        ctx.road_map, road_color, ground_texture, ctx.memory_budget
+    )
+    surface_texture = shade_surface(surface_texture, ctx.occlusion_map, ctx)
+    ctx.writer.save_image(surface_texture, ctx.path(SURFACE_TEXTURE))
+
+
+def build_normal_map(ctx):
+    """
+    Bake baked_normal_map.png from the height map, with the water pattern
+    below the waterHeight of the map. Maps with a hand-made normal_map.png
+    keep it instead.
+    Args:
+        ctx(MapContext): The map to build
+    """
+    if ctx.has_file(NORMAL_MAP_FILENAME):
+        return
+    normal_map = normals.bake_normal_map(
+        ctx.height_map, normals.load_water_normals(),
+        **normals.get_settings(ctx.config)
+    )
+    ctx.writer.save_image(normal_map, ctx.path(BAKED_NORMAL_MAP_FILENAME))
+
+
+def build_surface(ctx):
+    """
+    Write surface.json and surface.glb from the height map.
+    Args:
+        ctx(MapContext): The map to build
+    """
+    # Create surface JSON from height map
+    surface_json = create_surface(
+        ctx.height_map, ctx.max_height, ctx.height_map_pixel_size,
+        ctx.config.get('meshMaxError'),
+        normals.get_normal_map_filename(ctx.map_dir)
+    )
+    # Store triangles into surface JSON
+    ctx.writer.save_json(surface_json, ctx.path(SURFACE_FILENAME))
+    # Export the terrain as a binary glTF
+    gltf.write_terrain_glb(ctx)
+
+
+def build_tiles(ctx):
+    """
+    Cut the map in tiles for streaming when the map defines a tile size.
+    Args:
+        ctx(MapContext): The map to build
+    """
+    if 'tileSize' not in ctx.config:
+        return
+    tiling.create_tiles(
+        ctx, ctx.config['tileSize'],
+        ctx.config.get('tileTextureSize', tiling.DEFAULT_TILE_TEXTURE_SIZE)
+    )
+
+
+# Stages of a build in the order they run
+STAGES = {
+    "placement": build_placement,
+    "surface_texture": build_surface_texture,
+    "normal_map": build_normal_map,
+    "surface": build_surface,
+    "tiles": build_tiles
+}
+
+
+def build_map(ctx, stages=None):
+    """
+    Run the Procedural Placement of a map and write its outputs.
+    Args:
+        ctx(MapContext): The map to build
+        stages(list): Names of the stages to run, all of them if None
+    """
+    for name, stage in STAGES.items():
+        if stages is None or name in stages:
+            stage(ctx)
+
+
+def add_placement_map_stages(build, ctx):
+    """
+    Add the stages of a build that don't use the random numbers: the height
+    and road maps, the distance and orientation maps, the combination of the
+    density maps and the dithering of each ecotope, and the landmarks with
+    the occupancy grid they start. Only the combination of the density maps
+    is a chain.
+    Args:
+        build(Pipeline): The pipeline where the stages are added
+        ctx(MapContext): The map to build
+    Returns:
+        list: Names of the stages of the placement maps, in the order of the
+            ecotopes
+    """
+    build.add(Stage("height_map", lambda: ctx.height_map))
+    build.add(
+        Stage(
+            "kernel_backend", lambda: kernels.get_backend(ctx.kernel_backend)
+        )
+    )
+    build.add(
+        Stage("normalized_height_map", lambda _: ctx.normalized_height_map,
+              ["height_map"])
+    )
+    if ctx.has_raster(ROAD_MAP_FILENAME) and ctx.config.get('roadGraph'):
+        # Assets face the road graph, the distance map isn't needed
+        build.add(Stage("road_map", lambda: ctx.road_map))
+        build.add(Stage("road_graph", lambda _: ctx.road_graph, ["road_map"]))
+        build.add(Stage("orientation_map", lambda: None))
+        build.add(
+            Stage("road_density_map", lambda *_: ctx.road_density_map,
+                  ["road_map", "height_map"])
+        )
+    elif ctx.has_raster(ROAD_MAP_FILENAME):
+        build.add(Stage("road_map", lambda: ctx.road_map))
+        build.add(Stage("road_graph", lambda: None))
+        if ctx.raster_store(ROAD_MAP_FILENAME) is not None:
+            # Chunked road maps are flooded window by window
+            build.add(
+                Stage("dist_map", lambda _: ctx.dist_map, ["kernel_backend"])
+            )
+        else:
+            build.add(
+                Stage("dist_map", create_dist_map,
+                      ["road_map", "kernel_backend"], PROCESS)
+            )
+
+        def set_orientation_map(dist_map):
+            ctx.dist_map = dist_map
+            return ctx.orientation_map
+
+        build.add(Stage("orientation_map", set_orientation_map, ["dist_map"]))
+        build.add(
+            Stage("save_dist_map", lambda d: save_dist_map(d, ctx),
+                  ["dist_map"])
+        )
+        build.add(
+            Stage("road_density_map", lambda *_: ctx.road_density_map,
+                  ["road_map", "height_map"])
+        )
+    else:
+        build.add(Stage("road_graph", lambda: None))
+        build.add(Stage("orientation_map", lambda: None))
+        build.add(
+            Stage("road_density_map", lambda _: None, ["height_map"])
+        )
+
+    def combine_roads(road_density_map):
+        size = ctx.density_map_size
+        combined_density_map = np.zeros([size, size], dtype=np.float32)
+        if road_density_map is not None:
+            combined_density_map[:] = road_density_map
+        return combined_density_map
+
+    build.add(
+        Stage("combined_roads", combine_roads, ["road_density_map"])
+    )
+    combined = "combined_roads"
+    # Landmarks occupy the ground first, then each ecotope in order
+    build.add(
+        Stage("landmarks", lambda _: get_landmarks(ctx),
+              ["normalized_height_map"])
+    )
+    build.add(
+        Stage("occupancy", lambda landmarks: create_occupancy(landmarks, ctx),
+              ["landmarks"])
+    )
+    placement_maps = []
+    for ecotope in ctx.ecotopes:
+        name = ecotope['name']
+
+        def get_density_map(combined_density_map, ecotope_name=name):
+            density_map = (
+                ctx.density_map(ecotope_name) / np.float32(MAX_COLOR)
+            )
+            density_map *= 1 - combined_density_map
+            return density_map
+
+        def load_placement_map(density_map, ecotope_name=name):
+            return ctx.load_placement_map(
+                ecotope_name, bitmask.get_digest(density_map)
+            )
+
+        def save_density_placement_map(
+                placement_map, density_map, ecotope_name=name
+        ):
+            save_placement_map(placement_map, density_map, ecotope_name, ctx)
+
+        build.add(Stage(f"density_{name}", get_density_map, [combined]))
+        build.add(
+            Stage(
+                f"combined_{name}", np.maximum,
+                [f"density_{name}", combined]
+            )
+        )
+        combined = f"combined_{name}"
+        # Placement maps saved from the same density map aren't dithered
+        build.add(
+            Stage(f"saved_placement_map_{name}", load_placement_map,
+                  [f"density_{name}"])
+        )
+        build.add(
+            Stage(
+                f"placement_map_{name}", dither_uncached,
+                [f"density_{name}", f"saved_placement_map_{name}",
+                 "kernel_backend"], PROCESS
+            )
+        )
+        build.add(
+            Stage(f"save_placement_map_{name}", save_density_placement_map,
+                  [f"placement_map_{name}", f"density_{name}"])
+        )
+        placement_maps.append(f"placement_map_{name}")
+    return placement_maps
+
+
+def add_normal_map_stages(build, ctx):
+    """
+    Add the stages that bake the normal map of a map from its height map,
+    unless the map has a hand-made one.
+    Args:
+        build(Pipeline): The pipeline where the stages are added
+        ctx(MapContext): The map to build
+    Returns:
+        list: Names of the stages that write the normal map, if any
+    """
+    if ctx.has_file(NORMAL_MAP_FILENAME):
+        return []
+    build.add(Stage("water_normals", normals.load_water_normals))
+    normal_settings = normals.get_settings(ctx.config)
+    height_store = ctx.raster_store(HEIGHT_MAP_FILENAME)
+    if height_store is not None:
+        def bake_normal_store(water_normals):
+            shape = normals.get_shape(
+                height_store.shape, normal_settings['pixel_size'],
+                normal_settings['normal_pixel_size']
+            )
+            normal_store = ChunkedRaster.create(
+                ctx.path(
+                    rasterstore.get_store_filename(BAKED_NORMAL_MAP_FILENAME)
+                ),
+                shape + (COLOR_CHANNELS,), np.uint8, height_store.chunk_size
+            )
+            return normals.bake_normal_map(
+                height_store, water_normals, out=normal_store,
+                **normal_settings
+            )
+
+        build.add(Stage("normal_map", bake_normal_store, ["water_normals"]))
+        return ["normal_map"]
+
+    def save_normal_map(normal_map):
+        ctx.writer.save_image(normal_map, ctx.path(BAKED_NORMAL_MAP_FILENAME))
+
+    build.add(
+        Stage("normal_map",
+              functools.partial(normals.bake_normal_map, **normal_settings),
+              ["height_map", "water_normals"], PROCESS)
+    )
+    build.add(Stage("save_normal_map", save_normal_map, ["normal_map"]))
+    return ["save_normal_map"]
+
+
+def create_build_pipeline(ctx):
+    """
+    Express the build of a map as a pipeline of stages with their inputs, so
+    that independent stages like the distance map, the surface texture, the
+    surface files and the dithering of each ecotope run at the same time.
+    Only the combination of the density maps and the placement of the
+    ecotopes are chains, the placement to use the random numbers in the same
+    order as build_map.
+    Args:
+        ctx(MapContext): The map to build
+    Returns:
+        Pipeline: The pipeline, its stages change ctx when they run
+    """
+    build = pipeline.Pipeline()
+    placement_maps = add_placement_map_stages(build, ctx)
+    has_roads = ctx.has_raster(ROAD_MAP_FILENAME)
+    placements = []
+    for ecotope, placement_map in zip(ctx.ecotopes, placement_maps):
+        def place(placement_map, occupancy, *_, placed_ecotope=ecotope):
+            return procedurally_place(
+                placement_map, placed_ecotope, ctx, occupancy=occupancy
+            )
+
+        # Each ecotope is placed after the previous one
+        name = ecotope['name']
+        build.add(
+            Stage(f"placements_{name}", place,
+                  [placement_map, "occupancy", "normalized_height_map",
+                   "orientation_map", "road_graph"] + placements[-1:])
+        )
+        placements.append(f"placements_{name}")
+
+    def write_placement(landmarks, *ecotope_placements):
+        placement_json = sum(ecotope_placements, []) + landmarks
+        ctx.writer.save_json(placement_json, ctx.path(PLACEMENT_FILENAME))
+        instancing.write_instance_batches(ctx, placement_json)
+
+    build.add(Stage("placement", write_placement, ["landmarks"] + placements))
+    # Surface
+    surface_inputs = ["height_map"]
+    road_store = ctx.raster_store(ROAD_MAP_FILENAME)
+    ground_store = ctx.raster_store(GROUND_TEXTURE)
+    if road_store is not None and ground_store is not None:
+        # Chunked maps get a chunked texture, that tiles read window by window
+        def paint_surface_texture(road_color, memory_budget):
+            surface_store = rasterstore.create_like(
+                ctx.path(rasterstore.get_store_filename(SURFACE_TEXTURE)),
+                road_store, channels=(COLOR_CHANNELS,)
+            )
+            return paint_surface_store(
+                road_store, road_color, ground_store, surface_store,
+                memory_budget
+            )
+
+        build.add(
+            Stage("road_color", lambda: np.array(ctx.config['roadColor']))
+        )
+        build.add(Stage("memory_budget", lambda: ctx.memory_budget))
+        build.add(
+            Stage("surface_texture", paint_surface_texture,
+                  ["road_color", "memory_budget"])
+        )
+        surface_inputs.append("surface_texture")
+    elif ctx.has_file(GROUND_TEXTURE) and has_roads:
+        def save_surface_texture(surface_texture, occlusion_map):
+            surface_texture = shade_surface(
+                surface_texture, occlusion_map, ctx
+            )
+            ctx.writer.save_image(surface_texture, ctx.path(SURFACE_TEXTURE))
+
+        build.add(
+            Stage("road_color", lambda: np.array(ctx.config['roadColor']))
+        )
+        build.add(
+            Stage("ground_texture",
+                  lambda: np.asarray(Image.open(ctx.path(GROUND_TEXTURE))))
+        )
+        build.add(Stage("memory_budget", lambda: ctx.memory_budget))
+        build.add(
+            Stage("surface_texture", paint_surface,
+                  ["road_map", "road_color", "ground_texture",
+                   "memory_budget"], PROCESS)
+        )
+        build.add(
+            Stage("occlusion_map", lambda _: ctx.occlusion_map, ["height_map"])
+        )
+        build.add(
+            Stage("save_surface_texture", save_surface_texture,
+                  ["surface_texture", "occlusion_map"])
+        )
+        surface_inputs.append("save_surface_texture")
+
+    # Normal map
+    surface_inputs += add_normal_map_stages(build, ctx)
+
+    def write_surface_json(height_map):
+        surface_json = create_surface(
+            height_map, ctx.max_height, ctx.height_map_pixel_size,
+            ctx.config.get('meshMaxError'),
+            normals.get_normal_map_filename(ctx.map_dir)
+        )
+        ctx.writer.save_json(surface_json, ctx.path(SURFACE_FILENAME))
+
+    build.add(Stage("surface", write_surface_json, ["height_map"]))
+    # The binary terrain embeds the surface texture
+    build.add(
+        Stage("surface_glb", lambda *_: gltf.write_terrain_glb(ctx),
+              surface_inputs)
+    )
+    if 'tileSize' in ctx.config:
+        build.add(
+            Stage("tiles", lambda *_: build_tiles(ctx),
+                  ["placement"] + surface_inputs)
+        )
+    return build
+
+
+def main():
+    # Load map names
+    with open(MAPS_FILENAME, 'r') as f:
+        cities = json.load(f)
+    option = int(input(utils.menu_str(cities))) - 1
+    if option == EXIT_CODE:
+        sys.exit("You selected to exit the program")
+    chosen_option = cities[option].lower()
+
+    timer = utils.Timer()
+    timer.start()
+    ctx = MapContext(chosen_option, assets_dir=ASSETS_DIR)
+    # Write the outputs in the background while the next stages run
+    ctx.writer = ArtifactWriter(
+        compress_level=ctx.config.get(
+            'pngCompressLevel', artifacts.DEFAULT_COMPRESS_LEVEL
+        ),
+        debug=ctx.config.get('debugArtifacts', True)
+    )
+    with ctx.writer:
+        build = create_build_pipeline(ctx)
+        build.run()
     timer.stop()
+    build.report()
+    peak_memory = build.get_peak_memory()
+    if (
+            ctx.memory_budget is not None and peak_memory is not None and
+            peak_memory > ctx.memory_budget
+    ):
+        print(
+            f"Warning: peak memory {memory.format_mb(peak_memory)} was over "
+            f"the budget of {memory.format_mb(ctx.memory_budget)}"
+        )
     print(f"Elapsed time in the program was {timer}")
 
 
@@ -0,0 +1,399 @@
+from functools import cached_property
+import json
+import math
+import os.path
+
+import numpy as np
+from PIL import Image
+
+# Local modules
+from artifacts import ArtifactWriter
+import bitmask
+from constants import *
+import kernels
+from memory import BYTES_PER_MB
+import occlusion
+import rasterstore
+from rasterstore import ChunkedRaster
+from roadgraph import RoadGraph
+import roads
+
+# Cached properties derived from each input file
+FILE_DEPENDENTS = {
+    CONFIG_FILENAME: (
+        'density_map_size', 'road_density_map', 'road_graph', 'occlusion_map'
+    ),
+    HEIGHT_MAP_FILENAME: (
+        'height_map', 'height_map_shape', 'normalized_height_map',
+        'density_map_size', 'road_density_map', 'occlusion_map'
+    ),
+    ROAD_MAP_FILENAME: (
+        'road_map', 'dist_map', 'orientation_map', 'road_density_map',
+        'road_graph'
+    ),
+    ECOTOPES_FILENAME: ('ecotopes',),
+    AMBIENT_OCCLUSION_FILENAME: ('occlusion_map',)
+}
+
+
+class MapContext:
+    def __init__(
+            self, map_name, assets_dir=ASSETS_DIR, config=None, seed=None,
+            writer=None
+    ):
+        """
+        Object that owns the config and the rasters of a map. Every raster is
+        decoded only once, in its most compact dtype, and derived arrays are
+        computed the first time they are used.
+        Args:
+            map_name(str): Name of the folder of the map
+            assets_dir(str): Directory that contains the map folder
+            config(dict): Config of the map, read from config.json if None
+            seed(int): Seed for the random generator used in placement
+            writer(ArtifactWriter): Writer for the outputs of the map, files
+                are written right away if None
+        """
+        self.map_name = map_name
+        self.assets_dir = assets_dir
+        self.map_dir = f"{assets_dir}/{map_name}"
+        if writer is None:
+            writer = ArtifactWriter(workers=0)
+        self.writer = writer
+        # Modification time of every file when it was read
+        self.mtimes = {}
+        # Decoded density maps by ecotope name
+        self.density_maps = {}
+        # Dithered placement maps by ecotope name and digest of their input,
+        # kept between builds of the same context
+        self.placement_map_cache = {}
+        self.set_config(config)
+        self.reseed(seed)
+
+    def set_config(self, config=None):
+        """
+        Set the config of the map and the values that come from it.
+        Args:
+            config(dict): Config of the map, read from config.json if None
+        """
+        if config is None:
+            config = self.load_json(CONFIG_FILENAME)
+        self.config = config
+        self.max_height = config.get('maxHeight')
+        self.height_map_pixel_size = config.get('heightMapPixelSize')
+        self.density_map_pixel_size = config.get('densityMapPixelSize')
+        # Backend of the sequential kernels, see kernels.get_backend
+        self.kernel_backend = config.get('kernelBackend')
+        self.occlusion_strength = config.get(
+            'occlusionStrength', occlusion.DEFAULT_STRENGTH
+        )
+        # Raster stages work in bands that fit in the budget if it's given
+        memory_budget = config.get('memoryBudget')
+        self.memory_budget = (
+            None if memory_budget is None
+            else int(memory_budget * BYTES_PER_MB)
+        )
+
+    def reseed(self, seed=None):
+        """
+        Restart the random generator so that every build of the same context
+        places the same assets.
+        Args:
+            seed(int): Seed for the random generator, the one in the config if
+                None
+        """
+        if seed is None:
+            seed = self.config.get('seed')
+        self.rng = np.random.default_rng(seed)
+
+    def invalidate(self, *names):
+        """
+        Drop cached rasters so they are decoded again the next time they are
+        used.
+        Args:
+            names(str): Names of the cached properties to drop
+        """
+        for name in names:
+            self.__dict__.pop(name, None)
+
+    def refresh(self):
+        """
+        Drop everything derived from the files that changed since they were
+        read.
+        Returns:
+            list: Names of the files that changed
+        """
+        changed = []
+        for filename, mtime in list(self.mtimes.items()):
+            if self.get_mtime(filename) != mtime:
+                changed.append(filename)
+                del self.mtimes[filename]
+        for filename in changed:
+            self.invalidate(*FILE_DEPENDENTS.get(filename, ()))
+            if filename == CONFIG_FILENAME:
+                self.set_config()
+            elif filename.endswith(DENSITY_FILENAME):
+                ecotope_name = filename[:-len(DENSITY_FILENAME) - 1]
+                self.density_maps.pop(ecotope_name, None)
+        return changed
+
+    @property
+    def nbytes(self):
+        """int: Memory used by the arrays cached in the context"""
+        arrays = list(self.__dict__.values())
+        arrays += list(self.density_maps.values())
+        arrays += list(self.placement_map_cache.values())
+        return sum(a.nbytes for a in arrays if isinstance(a, np.ndarray))
+
+    def get_mtime(self, filename):
+        if not self.has_file(filename):
+            return None
+        return os.path.getmtime(self.path(filename))
+
+    def path(self, filename):
+        return f"{self.map_dir}/{filename}"
+
+    def has_file(self, filename):
+        return os.path.isfile(self.path(filename))
+
+    def cache_path(self, filename):
+        """Path of a file derived from the inputs, outside the map folder."""
+        return f"{CACHE_DIR}/{self.map_name}/{filename}"
+
+    def raster_store(self, filename):
+        """
+        Open the chunked store of a raster input, see rasterstore.py. Stages
+        that can work window by window use it instead of the image.
+        Args:
+            filename(str): Name of the image inside the map folder
+        Returns:
+            ChunkedRaster: The store or None if the raster has none or the
+                image changed after it was imported
+        """
+        path = self.path(rasterstore.get_store_filename(filename))
+        if not ChunkedRaster.exists(path):
+            return None
+        if self.has_file(filename) and self.get_mtime(filename) > \
+                os.path.getmtime(f"{path}/{rasterstore.MANIFEST_FILENAME}"):
+            return None
+        return ChunkedRaster.open(path)
+
+    def has_raster(self, filename):
+        """Whether a raster input exists as an image or as a store."""
+        return (
+            self.has_file(filename) or
+            self.raster_store(filename) is not None
+        )
+
+    def create_store(self, filename, like, dtype=None):
+        """
+        Create a store in the cache for a raster derived from a store input.
+        Args:
+            filename(str): Name of the derived raster
+            like(ChunkedRaster): Store whose rows, columns and chunks it has
+            dtype(dtype): Type of the pixels, the one of like if None
+        Returns:
+            ChunkedRaster: The store, open to write
+        """
+        return rasterstore.create_like(
+            self.cache_path(rasterstore.get_store_filename(filename)), like,
+            dtype
+        )
+
+    def load_gray(self, filename):
+        """
+        Decode a grayscale raster of the map, from its store if it only has
+        that.
+        Args:
+            filename(str): Name of the image inside the map folder
+        Returns:
+            ndarray: The raster in uint8 or None if the file doesn't exist
+        """
+        self.mtimes[filename] = self.get_mtime(filename)
+        if not self.has_file(filename):
+            store = self.raster_store(filename)
+            return None if store is None else np.asarray(store)
+        img = Image.open(self.path(filename)).convert('L')
+        return np.asarray(img, dtype=np.uint8)
+
+    def load_json(self, filename):
+        self.mtimes[filename] = self.get_mtime(filename)
+        with open(self.path(filename), 'r') as f:
+            return json.load(f)
+
+    @cached_property
+    def height_map(self):
+        height_map = self.load_gray(HEIGHT_MAP_FILENAME)
+        if height_map is None:
+            raise FileNotFoundError(
+                f"Height map {self.path(HEIGHT_MAP_FILENAME)} not found"
+            )
+        return height_map
+
+    @cached_property
+    def normalized_height_map(self):
+        """ndarray: Height map with float32 values between 0 and 1"""
+        height_store = self.raster_store(HEIGHT_MAP_FILENAME)
+        if height_store is not None:
+            # Placement reads single pixels of it, see get_height
+            store = self.create_store(
+                HEIGHT_MAP_FILENAME, height_store, np.float32
+            )
+            for box, _ in height_store.windows():
+                store.write(
+                    box[0], box[1],
+                    height_store.read(box).astype(np.float32) / MAX_COLOR
+                )
+            store.flush()
+            return store
+        return self.height_map.astype(np.float32) / MAX_COLOR
+
+    @cached_property
+    def road_map(self):
+        return self.load_gray(ROAD_MAP_FILENAME)
+
+    @cached_property
+    def dist_map(self):
+        road_store = self.raster_store(ROAD_MAP_FILENAME)
+        if road_store is not None:
+            return roads.create_dist_store(
+                road_store,
+                self.create_store(DIST_MAP_FILENAME, road_store),
+                kernels.get_kernel(kernels.FLOOD, self.kernel_backend)
+            )
+        if self.road_map is None:
+            return None
+        return roads.create_dist_map(
+            self.road_map,
+            kernels.get_kernel(kernels.FLOOD, self.kernel_backend)
+        )
+
+    @cached_property
+    def orientation_map(self):
+        """ndarray: Rotation in radians to face the nearest road per pixel"""
+        if self.dist_map is None:
+            return None
+        if isinstance(self.dist_map, ChunkedRaster):
+            return roads.create_orientation_store(
+                self.dist_map,
+                self.create_store(
+                    ORIENT_MAP_FILENAME, self.dist_map, np.float32
+                ),
+                self.memory_budget
+            )
+        return roads.create_orientation_map(self.dist_map, self.memory_budget)
+
+    @cached_property
+    def road_graph(self):
+        """RoadGraph: Graph that assets face instead of the orientation map
+        if the config has roadGraph, None otherwise"""
+        if not self.config.get('roadGraph') or self.road_map is None:
+            return None
+        # The graph of the same road map is loaded from the cache
+        key = bitmask.get_digest(self.road_map)
+        path = self.cache_path(ROAD_GRAPH_FILENAME)
+        road_graph = RoadGraph.load(path, key)
+        if road_graph is None:
+            road_graph = RoadGraph.from_road_map(self.road_map)
+            road_graph.save(path, key)
+        return road_graph
+
+    @cached_property
+    def occlusion_map(self):
+        """ndarray: Light that reaches each pixel of the terrain in uint8,
+        from ambient_occlusion.PNG if the map has one or baked from the
+        height map, None if occlusionStrength is 0"""
+        if self.occlusion_strength == 0:
+            return None
+        if self.has_file(AMBIENT_OCCLUSION_FILENAME):
+            return self.load_gray(AMBIENT_OCCLUSION_FILENAME)
+        return occlusion.bake_occlusion_map(
+            self.height_map, memory_budget=self.memory_budget,
+            **occlusion.get_settings(self.config)
+        )
+
+    @cached_property
+    def height_map_shape(self):
+        """tuple: Rows and columns of the height map, chunked ones aren't
+        decoded"""
+        height_store = self.raster_store(HEIGHT_MAP_FILENAME)
+        if height_store is not None:
+            return height_store.shape[:2]
+        return self.height_map.shape
+
+    @cached_property
+    def density_map_size(self):
+        return int(
+            math.ceil(
+                (self.height_map_shape[0] * self.height_map_pixel_size) /
+                self.density_map_pixel_size
+            )
+        )
+
+    @cached_property
+    def road_density_map(self):
+        """ndarray: Binary road map (0 or 1) at density map resolution"""
+        if self.road_map is None:
+            return None
+        size = (self.density_map_size, self.density_map_size)
+        resized_road_map = np.asarray(
+            Image.fromarray(self.road_map).resize(size), dtype=np.uint8
+        )
+        return roads.high_pass(resized_road_map, 1).astype(np.uint8)
+
+    @cached_property
+    def ecotopes(self):
+        ecotopes = self.load_json(ECOTOPES_FILENAME)
+        return sorted(ecotopes, key=lambda e: e['priority'])
+
+    @cached_property
+    def assets(self):
+        with open(ASSETS_FILENAME, 'r') as f:
+            return json.load(f)
+
+    def density_map(self, ecotope_name):
+        if ecotope_name not in self.density_maps:
+            self.density_maps[ecotope_name] = self.load_gray(
+                f"{ecotope_name}_{DENSITY_FILENAME}"
+            )
+        return self.density_maps[ecotope_name]
+
+    def get_placement_map(self, ecotope_name, density_map, discretize):
+        """
+        Get the placement map of an ecotope, discretizing its density map
+        only if it's different from the one of the last time. The placement
+        map saved by an earlier build is reused if it was discretized from
+        the same density map.
+        Args:
+            ecotope_name(str): Name of the ecotope
+            density_map(ndarray): Density map of the ecotope, after removing
+                the area of the ecotopes with higher priority
+            discretize(function): Function that receives the density map and
+                returns the placement map
+        Returns:
+            ndarray: The placement map
+        """
+        key = (ecotope_name, bitmask.get_digest(density_map))
+        if key not in self.placement_map_cache:
+            # Only the last placement map of each ecotope is kept
+            for cached_key in list(self.placement_map_cache):
+                if cached_key[0] == ecotope_name:
+                    del self.placement_map_cache[cached_key]
+            placement_map = self.load_placement_map(ecotope_name, key[1])
+            if placement_map is None:
+                placement_map = discretize(density_map)
+            self.placement_map_cache[key] = placement_map
+        return self.placement_map_cache[key]
+
+    def load_placement_map(self, ecotope_name, key=None):
+        """
+        Load the placement map of an ecotope saved by the last build.
+        Args:
+            ecotope_name(str): Name of the ecotope
+            key(bytes): If given, digest of the density map it must come from
+        Returns:
+            ndarray: The placement map as booleans, None if there isn't one
+                or it comes from another density map
+        """
+        path = self.path(f"{ecotope_name}_{PLACEMENT_MAP_FILENAME}")
+        self.writer.wait(path)
+        return bitmask.load_mask(path, key)
@@ -0,0 +1,93 @@
+import os
+import threading
+
+BYTES_PER_MB = 1024 ** 2
+# Seconds between samples of the memory of a process
+SAMPLE_INTERVAL = 0.005
+# Part of the memory budget that the working arrays of a single raster stage
+# can use, the rest is left for the rasters of the map and the stages that
+# run at the same time
+BAND_BUDGET_FRACTION = 0.25
+STATM_PATH = "/proc/self/statm"
+
+
+def get_rss():
+    """
+    Get the memory that the current process uses.
+    Returns:
+        int: Resident set size in bytes, None where it can't be read
+    """
+    try:
+        with open(STATM_PATH, 'r') as f:
+            resident_pages = int(f.read().split()[1])
+    except OSError:
+        return None
+    return resident_pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def get_band_rows(rows, bytes_per_row, memory_budget=None):
+    """
+    Get how many rows of a raster to process at a time so that the working
+    arrays of a stage fit in its part of the memory budget.
+    Args:
+        rows(int): Rows of the raster
+        bytes_per_row(int): Bytes of working arrays per row
+        memory_budget(int): Memory budget of the build in bytes, all rows at
+            once if None
+    Returns:
+        int: Rows per band, at least 1
+    """
+    if memory_budget is None:
+        return rows
+    band_budget = memory_budget * BAND_BUDGET_FRACTION
+    return int(min(rows, max(1, band_budget // max(bytes_per_row, 1))))
+
+
+def format_mb(num_bytes):
+    return f"{num_bytes / BYTES_PER_MB:.1f} MB"
+
+
+class MemorySampler:
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        """
+        Sample the memory of the current process in a thread while it's used
+        as a context manager, to get the peak of a block of code. Memory that
+        lives shorter than the interval can be missed.
+        Args:
+            interval(float): Seconds between samples
+        """
+        self.interval = interval
+        self.start = None
+        self.peak = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        rss = get_rss()
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.start = get_rss()
+        self.peak = self.start
+        if self.start is not None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.sample()
+
+    @property
+    def increase(self):
+        """int: Bytes that the peak was above the start, None if unknown"""
+        if self.start is None:
+            return None
+        return self.peak - self.start
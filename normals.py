@@ -0,0 +1,428 @@
+import argparse
+import json
+import os.path
+import sys
+
+import numpy as np
+from PIL import Image
+
+# Local modules
+from constants import *
+from rasterstore import ChunkedRaster
+import utils
+
+# Difference kernels of the slopes
+SOBEL = "sobel"
+CENTRAL = "central"
+KERNELS = (SOBEL, CENTRAL)
+# Sum of the weights of each side of a kernel, times the pixels between sides
+KERNEL_DIVISORS = {SOBEL: 8, CENTRAL: 2}
+# Output pixels in a side of a tile
+DEFAULT_TILE_SIZE = 256
+# Height pixels read around a tile, one for the differences and one for the
+# interpolation of the slopes
+TILE_HALO = 2
+# Scale of the slopes, 1 for the real slopes of the terrain
+DEFAULT_STRENGTH = 1.0
+WATER_NORMALS_FILENAME = f"{ASSETS_DIR}/waternormals.jpg"
+
+
+def get_normal_map_filename(map_dir):
+    """
+    Get the normal map that viewers use: the hand-made normal_map.png of a
+    map if it has one, otherwise the one that builds bake.
+    Args:
+        map_dir(str): Folder of the map
+    Returns:
+        str: Name of the normal map inside the folder
+    """
+    if os.path.isfile(f"{map_dir}/{NORMAL_MAP_FILENAME}"):
+        return NORMAL_MAP_FILENAME
+    return BAKED_NORMAL_MAP_FILENAME
+
+
+def get_settings(config):
+    """
+    Get the arguments of bake_normal_map from the config of a map.
+    Args:
+        config(dict): Config of the map
+    Returns:
+        dict: Keyword arguments of bake_normal_map
+    """
+    return {
+        "max_height": config['maxHeight'],
+        "pixel_size": config['heightMapPixelSize'],
+        "normal_pixel_size": config.get('normalMapPixelSize'),
+        "kernel": config.get('normalKernel', SOBEL),
+        "strength": config.get('normalStrength', DEFAULT_STRENGTH),
+        "water_height": config.get('waterHeight')
+    }
+
+
+def get_shape(height_shape, pixel_size, normal_pixel_size=None):
+    """
+    Get the rows and columns of the normal map of a height map.
+    Args:
+        height_shape(tuple): Rows and columns of the height map
+        pixel_size(float): Side of a pixel of the height map in world units
+        normal_pixel_size(float): Side of a pixel of the normal map in world
+            units, the one of the height map if None
+    Returns:
+        tuple: Rows and columns
+    """
+    if normal_pixel_size is None:
+        return tuple(height_shape[:2])
+    scale = pixel_size / normal_pixel_size
+    return tuple(max(round(n * scale), 1) for n in height_shape[:2])
+
+
+def load_water_normals(path=WATER_NORMALS_FILENAME):
+    """Decode the tiling pattern of the water normals into unit vectors."""
+    water_img = Image.open(path).convert('RGB')
+    return decode(np.asarray(water_img))
+
+
+def encode(normals):
+    """Encode unit normals in [-1, 1] as RGB in uint8."""
+    return np.round((normals + 1) * (MAX_COLOR / 2)).astype(np.uint8)
+
+
+def decode(normal_map):
+    """Decode RGB normals in uint8 into unit vectors in float32."""
+    normals = normal_map.astype(np.float32) * (2 / MAX_COLOR) - 1
+    norm = np.linalg.norm(normals, axis=-1, keepdims=True)
+    norm[norm == 0] = 1
+    return normals / norm
+
+
+def get_slopes(heights, pixel_size, kernel=SOBEL):
+    """
+    Get the slopes of every pixel of a window of heights except the ones in
+    its border.
+    Args:
+        heights(ndarray): Heights in world units
+        pixel_size(float): Side of a pixel in world units
+        kernel(str): SOBEL or CENTRAL
+    Returns:
+        tuple: Slopes along the columns and along the rows, with one pixel
+            less in each side than heights
+    """
+    if kernel not in KERNELS:
+        raise ValueError(
+            f"Unknown normal kernel {kernel}, use one of {', '.join(KERNELS)}"
+        )
+    # Differences between the right and left neighbors, and the ones below
+    # and above
+    dx = heights[:, 2:] - heights[:, :-2]
+    dy = heights[2:] - heights[:-2]
+    if kernel == SOBEL:
+        dx = dx[:-2] + 2 * dx[1:-1] + dx[2:]
+        dy = dy[:, :-2] + 2 * dy[:, 1:-1] + dy[:, 2:]
+    else:
+        dx = dx[1:-1]
+        dy = dy[:, 1:-1]
+    divisor = KERNEL_DIVISORS[kernel] * pixel_size
+    return dx / divisor, dy / divisor
+
+
+def interpolate(arr, rows, cols):
+    """
+    Sample an array with bilinear interpolation.
+    Args:
+        arr(ndarray): Array with one more row and column than the last ones
+            sampled
+        rows(ndarray): Row of each sample, not negative
+        cols(ndarray): Column of each sample, not negative
+    Returns:
+        ndarray: Samples with shape (len(rows), len(cols))
+    """
+    row0 = np.floor(rows).astype(int)
+    col0 = np.floor(cols).astype(int)
+    s = (rows - row0)[:, np.newaxis]
+    t = (cols - col0)[np.newaxis, :]
+    if arr.ndim == 3:
+        s = s[..., np.newaxis]
+        t = t[..., np.newaxis]
+    top = arr[row0][:, col0] * (1 - t) + arr[row0][:, col0 + 1] * t
+    bottom = arr[row0 + 1][:, col0] * (1 - t) + arr[row0 + 1][:, col0 + 1] * t
+    return top * (1 - s) + bottom * s
+
+
+def sample_wrapped(arr, rows, cols):
+    """Sample a tiling pattern with bilinear interpolation, see interpolate."""
+    h, w = arr.shape[:2]
+    padded = np.pad(arr, [(0, 1), (0, 1)] + [(0, 0)] * (arr.ndim - 2),
+                    mode='wrap')
+    return interpolate(padded, np.mod(rows, h), np.mod(cols, w))
+
+
+def sample_water(water_normals, box, shape):
+    """
+    Sample the water pattern stretched over a whole map in a box of it.
+    Args:
+        water_normals(ndarray): Unit normals of the water pattern
+        box(tuple): (top, left, bottom, right) of the samples
+        shape(tuple): Rows and columns of the map
+    Returns:
+        ndarray: Unit normals of the water in the box
+    """
+    top, left, bottom, right = box
+    water_h, water_w = water_normals.shape[:2]
+    return sample_wrapped(
+        water_normals,
+        (np.arange(top, bottom) + 0.5) * water_h / shape[0] - 0.5,
+        (np.arange(left, right) + 0.5) * water_w / shape[1] - 0.5
+    )
+
+
+def blend_water(normals, water_normals):
+    """
+    Add the detail of the water pattern to the normals of the terrain below
+    it, keeping the slopes of both (whiteout blending).
+    Args:
+        normals(ndarray): Unit normals of the terrain (... x 3)
+        water_normals(ndarray): Unit normals of the water (... x 3)
+    Returns:
+        ndarray: Unit normals
+    """
+    blended = np.concatenate([
+        normals[..., :2] + water_normals[..., :2],
+        normals[..., 2:] * water_normals[..., 2:]
+    ], axis=-1)
+    return blended / np.linalg.norm(blended, axis=-1, keepdims=True)
+
+
+def get_tiles(shape, tile_size, region=None):
+    """Get the boxes of the tiles that cover a region of a raster."""
+    top, left, bottom, right = (0, 0) + tuple(shape) if region is None \
+        else region
+    for tile_top in range(top, bottom, tile_size):
+        for tile_left in range(left, right, tile_size):
+            yield (
+                tile_top, tile_left, min(tile_top + tile_size, bottom),
+                min(tile_left + tile_size, right)
+            )
+
+
+def read_window(height_map, top, left, bottom, right):
+    """
+    Read a window of a height map, repeating its border pixels where the
+    window falls outside of it.
+    Args:
+        height_map(ndarray): Height map, or its ChunkedRaster
+        top(int): First row of the window, can be negative
+        left(int): First column of the window, can be negative
+        bottom(int): Row after the last one of the window
+        right(int): Column after the last one of the window
+    Returns:
+        ndarray: The window in float32
+    """
+    h, w = height_map.shape[:2]
+    window = np.asarray(
+        height_map[
+            max(top, 0):min(bottom, h), max(left, 0):min(right, w)
+        ], dtype=np.float32
+    )
+    pad = [
+        (max(-top, 0), max(bottom - h, 0)),
+        (max(-left, 0), max(right - w, 0))
+    ]
+    return np.pad(window, pad, mode='edge')
+
+
+def iter_normal_tiles(
+        height_map, height_scale, pixel_size, shape, kernel=SOBEL,
+        strength=DEFAULT_STRENGTH, tile_size=DEFAULT_TILE_SIZE, region=None
+):
+    """
+    Compute the tangent space normals of a height map tile by tile, reading
+    each tile with a halo of pixels around it, so that the tiles match the
+    normals of the whole map and only a tile of working arrays is in memory.
+    Their x grows to the right and y to the top of the image.
+    Args:
+        height_map(ndarray): Height map, or its ChunkedRaster
+        height_scale(float): World units of a value of the height map
+        pixel_size(float): Side of a pixel of the height map in world units
+        shape(tuple): Rows and columns of the normals, the height map is
+            resampled if they are different
+        kernel(str): SOBEL or CENTRAL
+        strength(float): Scale of the slopes
+        tile_size(int): Pixels in a side of a tile of the normals
+        region(tuple): (top, left, bottom, right) of the normals to compute,
+            all of them if None
+    Returns:
+        generator: (box, normals, heights) of each tile, with its unit
+            normals and its heights in world units
+    """
+    h, w = height_map.shape[:2]
+    sy = h / shape[0]
+    sx = w / shape[1]
+    for box in get_tiles(shape, tile_size, region):
+        top, left, bottom, right = box
+        # Centers of the pixels of the tile in height map pixels
+        rows = np.clip((np.arange(top, bottom) + 0.5) * sy - 0.5, 0, h - 1)
+        cols = np.clip((np.arange(left, right) + 0.5) * sx - 0.5, 0, w - 1)
+        window_top = int(rows[0]) - TILE_HALO
+        window_left = int(cols[0]) - TILE_HALO
+        heights = read_window(
+            height_map, window_top, window_left,
+            int(rows[-1]) + TILE_HALO + 1, int(cols[-1]) + TILE_HALO + 1
+        ) * height_scale
+        dx, dy = get_slopes(heights, pixel_size, kernel)
+        # The slopes start one pixel inside the window
+        rows -= window_top + 1
+        cols -= window_left + 1
+        dx = interpolate(dx, rows, cols) * strength
+        dy = interpolate(dy, rows, cols) * strength
+        # Rows grow to the bottom of the image
+        normals = np.stack([-dx, dy, np.ones_like(dx)], axis=-1)
+        normals /= np.linalg.norm(normals, axis=-1, keepdims=True)
+        yield box, normals, interpolate(heights[1:-1, 1:-1], rows, cols)
+
+
+def bake_normal_map(
+        height_map, water_normals=None, max_height=MAX_COLOR, pixel_size=1,
+        normal_pixel_size=None, kernel=SOBEL, strength=DEFAULT_STRENGTH,
+        water_height=None, tile_size=DEFAULT_TILE_SIZE, out=None, region=None
+):
+    """
+    Bake the normal map of a terrain from its height map, adding the water
+    pattern where the terrain is below the water in the same pass. Red grows
+    to the left of the image, like in the hand-made normal maps of the
+    project, and green to the top.
+    Args:
+        height_map(ndarray): Height map in uint8, or its ChunkedRaster
+        water_normals(ndarray): Unit normals of the water pattern, which is
+            stretched over the whole map, or None for no water
+        max_height(float): Height of the maximum value of the height map
+        pixel_size(float): Side of a pixel of the height map in world units
+        normal_pixel_size(float): Side of a pixel of the normal map in world
+            units, the one of the height map if None
+        kernel(str): SOBEL or CENTRAL
+        strength(float): Scale of the slopes
+        water_height(float): Height of the water, None for no water
+        tile_size(int): Pixels in a side of a tile
+        out(ndarray): RGB normal map to write the tiles in, or its
+            ChunkedRaster, a new array if None
+        region(tuple): (top, left, bottom, right) of the normal map to bake,
+            all of it if None
+    Returns:
+        ndarray: RGB normal map in uint8, out if it was given
+    """
+    shape = get_shape(height_map.shape, pixel_size, normal_pixel_size)
+    if out is None:
+        out = np.zeros(shape + (COLOR_CHANNELS,), dtype=np.uint8)
+    has_water = water_normals is not None and water_height is not None
+    for box, normals, heights in iter_normal_tiles(
+            height_map, max_height / MAX_COLOR, pixel_size, shape, kernel,
+            strength, tile_size, region
+    ):
+        top, left, bottom, right = box
+        if has_water:
+            is_water = heights <= water_height
+            if is_water.any():
+                water = sample_water(water_normals, box, shape)
+                normals[is_water] = blend_water(
+                    normals[is_water], water[is_water]
+                )
+        # Red grows to the left, like in the hand-made normal maps
+        normals[..., 0] *= -1
+        if isinstance(out, ChunkedRaster):
+            out.write(top, left, encode(normals))
+        else:
+            out[top:bottom, left:right] = encode(normals)
+    if isinstance(out, ChunkedRaster):
+        out.flush()
+    return out
+
+
+def add_water(normal_map, height_map, water_normals, max_height,
+              water_height):
+    """
+    Blend the water pattern into a normal map that wasn't baked, like a
+    hand-made one, where the terrain is below the water.
+    Args:
+        normal_map(ndarray): RGB normal map in uint8
+        height_map(ndarray): Height map in uint8, resampled to the normal map
+            if it has another size
+        water_normals(ndarray): Unit normals of the water pattern
+        max_height(float): Height of the maximum value of the height map
+        water_height(float): Height of the water
+    Returns:
+        ndarray: New RGB normal map in uint8
+    """
+    shape = normal_map.shape[:2]
+    height_img = Image.fromarray(np.asarray(height_map, dtype=np.uint8))
+    if height_img.size != (shape[1], shape[0]):
+        height_img = height_img.resize((shape[1], shape[0]), Image.BILINEAR)
+    heights = np.asarray(height_img) * (max_height / MAX_COLOR)
+    is_water = heights <= water_height
+    normal_map = np.array(normal_map)
+    if is_water.any():
+        water = sample_water(water_normals, (0, 0) + shape, shape)
+        normal_map[is_water] = encode(
+            blend_water(decode(normal_map[is_water]), water[is_water])
+        )
+    return normal_map
+
+
+def get_vertex_normals(height_map, pixel_size, kernel=CENTRAL):
+    """
+    Get the normal of every vertex of a grid mesh of a height map, in world
+    space with y up and rows of the height map growing along z.
+    Args:
+        height_map(ndarray): Heights in world units
+        pixel_size(float): Distance between two vertices in world units
+        kernel(str): SOBEL or CENTRAL
+    Returns:
+        ndarray: Unit normal of each pixel (rows x columns x 3)
+    """
+    normals = np.zeros(height_map.shape + (3,), dtype=np.float32)
+    for (top, left, bottom, right), tile, _ in iter_normal_tiles(
+            height_map, 1, pixel_size, height_map.shape, kernel
+    ):
+        # Tangent space z is the world up and its y goes against the rows
+        normals[top:bottom, left:right] = tile[..., [0, 2, 1]] * [1, 1, -1]
+    return normals
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Bake the normal map of a map from its height map"
+    )
+    parser.add_argument("--kernel", choices=KERNELS)
+    parser.add_argument(
+        "--pixel-size", type=float,
+        help="Side of a pixel of the normal map in world units"
+    )
+    parser.add_argument("--tile-size", type=int, default=DEFAULT_TILE_SIZE)
+    args = parser.parse_args()
+    # Load map names
+    with open(MAPS_FILENAME, 'r') as f:
+        cities = json.load(f)
+    option = int(input(utils.menu_str(cities))) - 1
+    if option == EXIT_CODE:
+        sys.exit("You selected to exit the program")
+    map_dir = f"{ASSETS_DIR}/{cities[option].lower()}"
+    with open(f"{map_dir}/{CONFIG_FILENAME}", 'r') as f:
+        settings = get_settings(json.load(f))
+    if args.kernel is not None:
+        settings['kernel'] = args.kernel
+    if args.pixel_size is not None:
+        settings['normal_pixel_size'] = args.pixel_size
+    height_map = np.asarray(
+        Image.open(f"{map_dir}/{HEIGHT_MAP_FILENAME}").convert('L')
+    )
+    timer = utils.Timer()
+    timer.start()
+    normal_map = bake_normal_map(
+        height_map, load_water_normals(), tile_size=args.tile_size, **settings
+    )
+    timer.stop()
+    normal_map_path = f"{map_dir}/{BAKED_NORMAL_MAP_FILENAME}"
+    Image.fromarray(normal_map).save(normal_map_path)
+    print(f"Normal map saved in {normal_map_path}, elapsed time was {timer}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import numba
+import numpy as np
+
+MAX_COLOR = 255
+# Weights of the error diffusion and their denominator
+DIFFUSION_WEIGHTS = [7, 3, 5, 1, 16]
+
+
+@numba.njit(cache=True)
+def diffuse_error(output, weights):
+    """Serpentine error diffusion of the dithering, in place."""
+    h, w = output.shape
+    for j in range(h):
+        for i in range(w):
+            x = i if j % 2 == 0 else w - 1 - i
+            original_pixel = output[j, x]
+            new_pixel = np.rint(original_pixel)
+            output[j, x] = new_pixel
+            error = original_pixel - new_pixel
+            if j < h - 1 and 0 < x < w - 1:
+                if j % 2 == 0:
+                    output[j, x + 1] += error * weights[0] / weights[4]
+                    output[j + 1, x - 1] += error * weights[1] / weights[4]
+                    output[j + 1, x] += error * weights[2] / weights[4]
+                    output[j + 1, x + 1] += error * weights[3] / weights[4]
+                else:
+                    # Same neighbors as the reference, which diffuses the
+                    # last weight to the left pixel again
+                    output[j, x - 1] += error * weights[0] / weights[4]
+                    output[j + 1, x - 1] += error * weights[1] / weights[4]
+                    output[j + 1, x] += error * weights[2] / weights[4]
+                    output[j + 1, x - 1] += error * weights[3] / weights[4]
+
+
+@numba.njit(cache=True)
+def flood_rings(new_arr):
+    """Give each non road pixel the ring of roads it's in, in place."""
+    h, w = new_arr.shape
+    closed = np.zeros((h, w), dtype=np.bool_)
+    # Pixels of the current and next rings, every pixel enters once
+    queue = np.empty((h * w, 2), dtype=np.int64)
+    start = 0
+    end = 0
+    for j in range(h):
+        for i in range(w):
+            if new_arr[j, i] == 0:
+                closed[j, i] = True
+                queue[end, 0] = j
+                queue[end, 1] = i
+                end += 1
+    for color in range(1, MAX_COLOR):
+        ring_end = end
+        for k in range(start, ring_end):
+            j = queue[k, 0]
+            i = queue[k, 1]
+            for row in range(j - 1, j + 2):
+                for col in range(i - 1, i + 2):
+                    if 0 <= row < h and 0 <= col < w and \
+                            not closed[row, col]:
+                        closed[row, col] = True
+                        new_arr[row, col] = color
+                        queue[end, 0] = row
+                        queue[end, 1] = col
+                        end += 1
+        start = ring_end
+
+
+def floyd_steinberg_dithering(img_arr):
+    """JIT version of dithering.floyd_steinberg_dithering."""
+    output = np.copy(img_arr)
+    weights = np.array(DIFFUSION_WEIGHTS, dtype=output.dtype)
+    diffuse_error(output, weights)
+    return (np.clip(output, 0, 1) * 255).astype(np.uint8)
+
+
+def flood(img_arr):
+    """JIT version of roads.flood."""
+    new_arr = MAX_COLOR - img_arr
+    flood_rings(new_arr)
+    return new_arr
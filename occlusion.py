@@ -0,0 +1,297 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import json
+import math
+import multiprocessing
+import sys
+
+import numpy as np
+from PIL import Image
+
+# Local modules
+from constants import *
+import memory
+import pipeline
+import utils
+
+# Directions in which the horizon of each pixel is searched
+DEFAULT_DIRECTIONS = 8
+# Height map pixels to the farthest point that can occlude a pixel
+DEFAULT_RADIUS = 32
+# How dark the surface gets, 0 for no occlusion
+DEFAULT_STRENGTH = 1.0
+# Samples between two distances that double
+SAMPLES_PER_OCTAVE = 2
+# A sample reads the level of the max pyramid whose cells are at most
+# 1 / 2 ** LEVEL_OFFSET of its distance, larger cells see too much of the
+# hills beside the march and make the terrain darker
+LEVEL_OFFSET = 3
+# Bytes of working arrays per pixel while marching a band
+OCCLUSION_BYTES_PER_PIXEL = 24
+# Max pyramid of the map in the processes of a pool
+worker_pyramid = None
+
+
+def get_settings(config):
+    """
+    Get the arguments of bake_occlusion_map from the config of a map.
+    Args:
+        config(dict): Config of the map
+    Returns:
+        dict: Keyword arguments of bake_occlusion_map
+    """
+    pixel_size = config['heightMapPixelSize']
+    radius = config.get('occlusionRadius')
+    return {
+        "max_height": config['maxHeight'],
+        "pixel_size": pixel_size,
+        "radius": DEFAULT_RADIUS if radius is None else radius / pixel_size,
+        "directions": config.get('occlusionDirections', DEFAULT_DIRECTIONS),
+        "workers": config.get('occlusionWorkers')
+    }
+
+
+def create_max_pyramid(heights, levels):
+    """
+    Create a pyramid where each level has the maximum of 2x2 cells of the
+    previous one.
+    Args:
+        heights(ndarray): Heights of the first level
+        levels(int): Levels after the first one
+    Returns:
+        list: Array of each level
+    """
+    pyramid = [heights]
+    for _ in range(levels):
+        level = pyramid[-1]
+        # Odd rows and columns are repeated
+        level = np.pad(
+            level, [(0, level.shape[0] % 2), (0, level.shape[1] % 2)],
+            mode='edge'
+        )
+        pyramid.append(np.maximum.reduce([
+            level[::2, ::2], level[1::2, ::2], level[::2, 1::2],
+            level[1::2, 1::2]
+        ]))
+    return pyramid
+
+
+def get_distances(radius):
+    """
+    Get the distances of the samples of the march, which grow geometrically
+    so that a march takes a number of samples logarithmic in its radius.
+    Args:
+        radius(float): Distance to the last sample in pixels
+    Returns:
+        list: (distance, level of the pyramid) of every sample
+    """
+    count = int(math.floor(math.log2(max(radius, 1)) * SAMPLES_PER_OCTAVE))
+    distances = []
+    for i in range(count + 1):
+        distance = 2 ** (i / SAMPLES_PER_OCTAVE)
+        level = max(int(math.floor(math.log2(distance))) - LEVEL_OFFSET, 0)
+        distances.append((distance, level))
+    return distances
+
+
+def get_reach(radius):
+    """
+    Get the pixels from a pixel to the farthest height that its occlusion
+    reads, which is past radius because far samples read whole cells of the
+    max pyramid.
+    Args:
+        radius(float): Distance to the last sample in pixels
+    Returns:
+        int: Pixels that the occlusion of a pixel can reach
+    """
+    return max(
+        math.ceil(distance) + 2 ** level
+        for distance, level in get_distances(radius)
+    )
+
+
+def set_worker_pyramid(pyramid):
+    """Keep the max pyramid in a worker, so it's sent once per worker."""
+    global worker_pyramid
+    worker_pyramid = pyramid
+
+
+def get_worker_band_occlusion(top, bottom, **kwargs):
+    return get_band_occlusion(worker_pyramid, top, bottom, **kwargs)
+
+
+def get_band_occlusion(pyramid, top, bottom, pixel_size, directions, radius):
+    """
+    Get the ambient light that reaches each pixel of a band of rows of a
+    height map, which is 1 minus the mean of the sine of the elevation of
+    the horizon in every direction. The horizon in a direction is searched
+    marching from the pixel to radius, reading the maximum height of
+    coarser cells of the max pyramid as the samples get farther, so that a
+    far hill is found without visiting every pixel on the way to it.
+    Args:
+        pyramid(list): Max pyramid of the heights in world units
+        top(int): First row of the band
+        bottom(int): Row after the last one of the band
+        pixel_size(float): Side of a pixel in world units
+        directions(int): Directions of the horizon search
+        radius(float): Distance to the farthest sample in pixels
+    Returns:
+        ndarray: Light in [0, 1] of each pixel of the band (float32)
+    """
+    h, w = pyramid[0].shape
+    rows = np.arange(top, bottom)
+    cols = np.arange(w)
+    heights = pyramid[0][top:bottom]
+    occlusion = np.zeros(heights.shape, dtype=np.float32)
+    distances = get_distances(radius)
+    for k in range(directions):
+        angle = 2 * math.pi * k / directions
+        dx = math.cos(angle)
+        dy = -math.sin(angle)
+        max_slope = np.zeros(heights.shape, dtype=np.float32)
+        for distance, level in distances:
+            # Samples outside the map repeat its border
+            sample_rows = np.clip(
+                np.round(rows + dy * distance).astype(int), 0, h - 1
+            )
+            sample_cols = np.clip(
+                np.round(cols + dx * distance).astype(int), 0, w - 1
+            )
+            sample_heights = pyramid[level][
+                np.ix_(sample_rows >> level, sample_cols >> level)
+            ]
+            slope = (sample_heights - heights) / np.float32(
+                distance * pixel_size
+            )
+            np.maximum(max_slope, slope, out=max_slope)
+        # Sine of the elevation of the horizon
+        occlusion += max_slope / np.sqrt(1 + max_slope * max_slope)
+    return 1 - occlusion / directions
+
+
+def bake_occlusion_map(
+        height_map, max_height=MAX_COLOR, pixel_size=1, radius=DEFAULT_RADIUS,
+        directions=DEFAULT_DIRECTIONS, workers=None, memory_budget=None,
+        rows=None
+):
+    """
+    Bake the ambient occlusion of a terrain from its height map, see
+    get_band_occlusion. The map is computed in bands of rows, in a pool of
+    processes if workers is given.
+    Args:
+        height_map(ndarray): Height map in uint8
+        max_height(float): Height of the maximum value of the height map
+        pixel_size(float): Side of a pixel of the height map in world units
+        radius(float): Pixels to the farthest point that can occlude a pixel
+        directions(int): Directions of the horizon search
+        workers(int): Processes that compute bands at the same time, the
+            bands are computed in this process if None
+        memory_budget(int): Memory budget of the build in bytes, bands fit
+            in it
+        rows(tuple): First row and row after the last one to bake, all of
+            them if None
+    Returns:
+        ndarray: Light that reaches each pixel of the rows in uint8, 255
+            where nothing occludes it
+    """
+    h, w = height_map.shape
+    top, bottom = (0, h) if rows is None else rows
+    heights = height_map * np.float32(max_height / MAX_COLOR)
+    levels = max(
+        int(math.floor(math.log2(max(radius, 1)))) - LEVEL_OFFSET, 0
+    )
+    pyramid = create_max_pyramid(heights, levels)
+    band_rows = memory.get_band_rows(
+        bottom - top, w * OCCLUSION_BYTES_PER_PIXEL, memory_budget
+    )
+    if workers is not None:
+        # At least a band for every worker
+        band_rows = min(band_rows, max(math.ceil((bottom - top) / workers), 1))
+    tops = list(range(top, bottom, band_rows))
+    bottoms = [min(band_top + band_rows, bottom) for band_top in tops]
+    settings = {
+        "pixel_size": pixel_size, "directions": directions, "radius": radius
+    }
+    if workers is None:
+        get_band = functools.partial(get_band_occlusion, pyramid, **settings)
+        bands = list(map(get_band, tops, bottoms))
+    else:
+        get_band = functools.partial(get_worker_band_occlusion, **settings)
+        with ProcessPoolExecutor(
+                workers,
+                mp_context=multiprocessing.get_context(pipeline.START_METHOD),
+                initializer=set_worker_pyramid, initargs=(pyramid,)
+        ) as pool:
+            bands = list(pool.map(get_band, tops, bottoms))
+    light = np.concatenate(bands) if bands else np.ones([0, w])
+    return np.round(light * MAX_COLOR).astype(np.uint8)
+
+
+def fit(occlusion_map, shape):
+    """Resize an occlusion map to the rows and columns of a texture."""
+    if occlusion_map.shape[:2] == tuple(shape[:2]):
+        return occlusion_map
+    size = (shape[1], shape[0])
+    return np.asarray(
+        Image.fromarray(occlusion_map).resize(size, Image.BILINEAR)
+    )
+
+
+def apply_occlusion(texture, occlusion_map, strength=DEFAULT_STRENGTH):
+    """
+    Darken a texture where the terrain is occluded.
+    Args:
+        texture(ndarray): RGB texture in uint8
+        occlusion_map(ndarray): Light of each pixel in uint8, resized to the
+            texture if it has another size
+        strength(float): How dark the occluded pixels get, from 0 (not at
+            all) to 1 (multiplied by the light)
+    Returns:
+        ndarray: The darkened texture in uint8
+    """
+    light = fit(occlusion_map, texture.shape) / MAX_COLOR
+    factor = 1 - strength * (1 - light)
+    return np.round(texture * factor[..., np.newaxis]).astype(np.uint8)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Bake the ambient occlusion of a map from its height map"
+    )
+    parser.add_argument("--directions", type=int)
+    parser.add_argument(
+        "--radius", type=float,
+        help="Pixels to the farthest point that can occlude a pixel"
+    )
+    parser.add_argument(
+        "--workers", type=int, help="Processes that compute bands of rows"
+    )
+    args = parser.parse_args()
+    # Load map names
+    with open(MAPS_FILENAME, 'r') as f:
+        cities = json.load(f)
+    option = int(input(utils.menu_str(cities))) - 1
+    if option == EXIT_CODE:
+        sys.exit("You selected to exit the program")
+    map_dir = f"{ASSETS_DIR}/{cities[option].lower()}"
+    with open(f"{map_dir}/{CONFIG_FILENAME}", 'r') as f:
+        settings = get_settings(json.load(f))
+    for name in ['directions', 'radius', 'workers']:
+        if getattr(args, name) is not None:
+            settings[name] = getattr(args, name)
+    height_map = np.asarray(
+        Image.open(f"{map_dir}/{HEIGHT_MAP_FILENAME}").convert('L')
+    )
+    timer = utils.Timer()
+    timer.start()
+    occlusion_map = bake_occlusion_map(height_map, **settings)
+    timer.stop()
+    occlusion_map_path = f"{map_dir}/{OCCLUSION_MAP_FILENAME}"
+    Image.fromarray(occlusion_map).save(occlusion_map_path)
+    print(f"Occlusion map saved in {occlusion_map_path}, elapsed time was "
+          f"{timer}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+import math
+
+import numpy as np
+
+# Local modules
+from constants import FULL_ROTATION
+
+# Side in meters of the cells of the occupancy grid
+OCCUPANCY_CELL_SIZE = 0.5
+BYTE_BITS = 8
+FULL_BYTE = 0xFF
+
+
+def get_footprints(ctx):
+    """
+    Get the footprint of every asset, the one of its ecotope if it has one.
+    Args:
+        ctx(MapContext): The map
+    Returns:
+        dict: Side in meters of the square each asset occupies by asset id
+    """
+    footprints = {asset['id']: asset['footprint'] for asset in ctx.assets}
+    for ecotope in ctx.ecotopes:
+        for asset in ecotope['data']:
+            if 'footprint' in asset:
+                footprints[asset['assetId']] = asset['footprint']
+    return footprints
+
+
+class OccupancyGrid:
+    def __init__(self, size, footprints, cell_size=OCCUPANCY_CELL_SIZE):
+        """
+        Bitset over the ground of a map with a bit set for every cell covered
+        by a placed asset, so that placing an asset checks only the cells of
+        its footprint no matter how many assets there are.
+        Args:
+            size(float): Side in meters of the map, centered in the origin
+            footprints(dict): Side in meters of each asset by asset id
+            cell_size(float): Side in meters of each cell
+        """
+        self.size = size
+        self.footprints = footprints
+        self.cell_size = cell_size
+        self.cells = int(math.ceil(size / cell_size))
+        # Rows of bits packed like np.packbits, first column in the high bit
+        self.bits = np.zeros(
+            (self.cells, -(-self.cells // BYTE_BITS)), dtype=np.uint8
+        )
+
+    @classmethod
+    def from_map(cls, ctx):
+        size = ctx.density_map_size * ctx.density_map_pixel_size
+        return cls(
+            size, get_footprints(ctx),
+            ctx.config.get('occupancyCellSize', OCCUPANCY_CELL_SIZE)
+        )
+
+    def get_cells(self, placement):
+        """
+        Get the cells covered by a placed asset, the bounding box of the
+        rectangle of its footprint scaled in x and z and rotated in the up
+        axis. Assets with a full rotation can face any way, so they cover the
+        bounding box of every rotation of the rectangle.
+        Args:
+            placement(dict): Placement dict of the asset
+        Returns:
+            tuple: First and last rows and columns (exclusive) of the cells,
+                None if the asset is out of the map
+        """
+        scale = placement['scale']
+        footprint = self.footprints[placement['assetId']]
+        half_width = footprint * abs(scale['x']) / 2
+        half_depth = footprint * abs(scale['z']) / 2
+        rotation = placement['rotation']
+        if rotation == FULL_ROTATION:
+            half_x = half_z = math.hypot(half_width, half_depth)
+        else:
+            cos = abs(math.cos(rotation))
+            sin = abs(math.sin(rotation))
+            half_x = half_width * cos + half_depth * sin
+            half_z = half_width * sin + half_depth * cos
+        x = placement['position']['x'] + self.size / 2
+        z = placement['position']['z'] + self.size / 2
+        top = max(int(math.floor((z - half_z) / self.cell_size)), 0)
+        bottom = min(int(math.ceil((z + half_z) / self.cell_size)), self.cells)
+        left = max(int(math.floor((x - half_x) / self.cell_size)), 0)
+        right = min(int(math.ceil((x + half_x) / self.cell_size)), self.cells)
+        if top >= bottom or left >= right:
+            return None
+        return top, bottom, left, right
+
+    @staticmethod
+    def get_masks(left, right):
+        """Get the bytes of a row and their masks for a range of columns."""
+        first = left // BYTE_BITS
+        last = (right - 1) // BYTE_BITS
+        masks = np.full(last - first + 1, FULL_BYTE, dtype=np.uint8)
+        masks[0] &= FULL_BYTE >> (left % BYTE_BITS)
+        masks[-1] &= (
+            FULL_BYTE << (BYTE_BITS - 1 - (right - 1) % BYTE_BITS)
+        ) & FULL_BYTE
+        return slice(first, last + 1), masks
+
+    def is_free(self, placement):
+        """Whether none of the cells of a placed asset are occupied."""
+        cells = self.get_cells(placement)
+        if cells is None:
+            return True
+        top, bottom, left, right = cells
+        columns, masks = self.get_masks(left, right)
+        return not np.any(self.bits[top:bottom, columns] & masks)
+
+    def stamp(self, placement):
+        """Occupy the cells of a placed asset."""
+        cells = self.get_cells(placement)
+        if cells is None:
+            return
+        top, bottom, left, right = cells
+        columns, masks = self.get_masks(left, right)
+        self.bits[top:bottom, columns] |= masks
+
+    def place(self, placement):
+        """
+        Occupy the cells of an asset if they are free.
+        Args:
+            placement(dict): Placement dict of the asset
+        Returns:
+            bool: Whether the asset was placed
+        """
+        if not self.is_free(placement):
+            return False
+        self.stamp(placement)
+        return True
+
+    @property
+    def occupied(self):
+        """ndarray: Occupied cells as booleans, rows go along z"""
+        return np.unpackbits(self.bits, axis=1, count=self.cells).astype(bool)
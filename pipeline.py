@@ -0,0 +1,211 @@
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+import multiprocessing
+import time
+
+# Local modules
+from memory import MemorySampler, format_mb
+
+# Where a stage runs
+THREAD = "thread"
+PROCESS = "process"
+# Workers are started from a server process instead of forking the build,
+# whose threads can be holding locks, like the one of a module they import,
+# that would never be released in the worker
+START_METHOD = (
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods()
+    else "spawn"
+)
+
+
+class Stage:
+    def __init__(self, name, func, inputs=(), executor=THREAD):
+        """
+        Step of a pipeline. Its output is the value returned by func, called
+        with the outputs of its inputs in order.
+        Args:
+            name(str): Name of the stage and of its output
+            func(function): Function that computes the output
+            inputs(tuple): Names of the stages whose outputs func receives
+            executor(str): THREAD for stages that wait on I/O, release the GIL
+                or change shared objects, PROCESS for pure Python loops. The
+                function and the inputs of a process stage must be picklable
+        """
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.executor = executor
+        self.start_time = None
+        self.end_time = None
+        # Peak memory above the start of the stage, and the peak of the
+        # process it ran in, in bytes
+        self.peak_memory = None
+        self.process_peak_memory = None
+
+    @property
+    def duration(self):
+        return self.end_time - self.start_time
+
+
+def run_stage(stage_func, *args):
+    """
+    Run a stage and measure it in the worker, returns (output, times,
+    memory). Thread stages share the process, so their memory includes the
+    stages that run at the same time.
+    """
+    with MemorySampler() as sampler:
+        start = time.perf_counter()
+        output = stage_func(*args)
+        end = time.perf_counter()
+    return output, (start, end), (sampler.increase, sampler.peak)
+
+
+class Pipeline:
+    def __init__(self, stages=()):
+        """
+        Directed acyclic graph of stages that runs every stage as soon as its
+        inputs are ready, so independent stages run at the same time.
+        Args:
+            stages(list): Stages of the pipeline
+        """
+        self.stages = {}
+        for stage in stages:
+            self.add(stage)
+        self.outputs = {}
+        self.elapsed_time = None
+        self.peak_memory = None
+
+    def add(self, stage):
+        if stage.name in self.stages:
+            raise ValueError(f"Stage {stage.name} already exists")
+        self.stages[stage.name] = stage
+        return stage
+
+    def validate(self):
+        """Check that every input exists and that there are no cycles."""
+        for stage in self.stages.values():
+            for name in stage.inputs:
+                if name not in self.stages:
+                    raise ValueError(
+                        f"Stage {stage.name} needs unknown stage {name}"
+                    )
+        visited = set()
+        visiting = set()
+
+        def visit(name):
+            if name in visiting:
+                raise ValueError(f"Stage {name} is part of a cycle")
+            if name in visited:
+                return
+            visiting.add(name)
+            for input_name in self.stages[name].inputs:
+                visit(input_name)
+            visiting.remove(name)
+            visited.add(name)
+
+        for name in self.stages:
+            visit(name)
+
+    def run(self, max_workers=None):
+        """
+        Run all the stages.
+        Args:
+            max_workers(int): Workers of each pool. If None, processes are as
+                many as CPUs and threads a few more to overlap I/O
+        Returns:
+            dict: Output of every stage
+        """
+        self.validate()
+        self.outputs = {}
+        pending = dict(self.stages)
+        running = {}
+        start = time.perf_counter()
+        with MemorySampler() as sampler, \
+                ThreadPoolExecutor(max_workers) as thread_pool, \
+                ProcessPoolExecutor(
+                    max_workers,
+                    mp_context=multiprocessing.get_context(START_METHOD)
+                ) as process_pool:
+            pools = {THREAD: thread_pool, PROCESS: process_pool}
+            while pending or running:
+                ready = [
+                    stage for stage in pending.values()
+                    if all(name in self.outputs for name in stage.inputs)
+                ]
+                for stage in ready:
+                    del pending[stage.name]
+                    args = [self.outputs[name] for name in stage.inputs]
+                    future = pools[stage.executor].submit(
+                        run_stage, stage.func, *args
+                    )
+                    running[future] = stage
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    # Raises the exception of the stage if it failed
+                    (
+                        output, (stage.start_time, stage.end_time),
+                        (stage.peak_memory, stage.process_peak_memory)
+                    ) = future.result()
+                    self.outputs[stage.name] = output
+        self.elapsed_time = time.perf_counter() - start
+        self.peak_memory = sampler.peak
+        return self.outputs
+
+    def get_peak_memory(self):
+        """
+        Get the peak memory of the last run, the one of the main process plus
+        the largest one of a process stage, since process stages can run at
+        the same time as the main process is at its peak.
+        Returns:
+            int: Bytes, None where memory can't be measured
+        """
+        if self.peak_memory is None:
+            return None
+        worker_peaks = [
+            stage.process_peak_memory for stage in self.stages.values()
+            if stage.executor == PROCESS and
+            stage.process_peak_memory is not None
+        ]
+        return self.peak_memory + max(worker_peaks, default=0)
+
+    def get_critical_path(self):
+        """
+        Get the chain of stages that took the longest in the last run, which
+        bounds the time of the pipeline.
+        Returns:
+            tuple: Names of the stages in the chain and their total seconds
+        """
+        longest = {}
+
+        def get_longest(name):
+            if name not in longest:
+                stage = self.stages[name]
+                chains = [get_longest(n) for n in stage.inputs]
+                path, duration = max(chains, key=lambda c: c[1], default=(
+                    [], 0
+                ))
+                longest[name] = (path + [name], duration + stage.duration)
+            return longest[name]
+
+        return max(
+            (get_longest(name) for name in self.stages), key=lambda c: c[1]
+        )
+
+    def report(self):
+        """Print the time of every stage and the critical path."""
+        for stage in sorted(self.stages.values(), key=lambda s: s.start_time):
+            memory = ""
+            if stage.peak_memory is not None:
+                memory = f", +{format_mb(stage.peak_memory)}"
+            print(f"{stage.name}: {stage.duration:.3f}s{memory}")
+        path, duration = self.get_critical_path()
+        total = sum(stage.duration for stage in self.stages.values())
+        print(f"Critical path ({duration:.3f}s): {' -> '.join(path)}")
+        print(
+            f"Pipeline took {self.elapsed_time:.3f}s for {total:.3f}s of "
+            f"stages"
+        )
+        peak_memory = self.get_peak_memory()
+        if peak_memory is not None:
+            print(f"Peak memory: {format_mb(peak_memory)}")
@@ -0,0 +1,320 @@
+from collections import deque
+from contextlib import contextmanager
+import csv
+import json
+import time
+
+import numpy as np
+import pyglet
+from pyglet.gl import *
+from pyglet.math import Vec3
+
+# Parts of a frame measured in the CPU
+CAMERA_PHASE = "camera"
+DRAW_PHASE = "draw"
+OVERLAY_PHASE = "overlay"
+PHASES = [CAMERA_PHASE, DRAW_PHASE, OVERLAY_PHASE]
+CSV_FIELDS = (
+    ["frame", "time", "frame_ms"] + [f"{phase}_ms" for phase in PHASES] +
+    ["gpu_ms", "draw_mode", "vertices", "triangles", "x", "y", "z", "pitch",
+     "yaw"]
+)
+# Frames in the rolling statistics and histogram
+HISTORY_FRAMES = 240
+# Upper bounds in ms of the bins of the frame time histogram, the last bin
+# has the slower frames
+HISTOGRAM_BINS = [4, 8, 12, 16.7, 25, 33.3, 50]
+HISTOGRAM_BAR_WIDTH = 30
+PERCENTILES = [50, 95, 99]
+# Seconds between updates of the overlay text
+OVERLAY_UPDATE_INTERVAL = 0.25
+OVERLAY_MARGIN = 10
+OVERLAY_FONT = "Courier New"
+OVERLAY_FONT_SIZE = 11
+OVERLAY_WIDTH = 420
+# Timer queries in flight, GPU times arrive a few frames late
+GPU_QUERIES = 4
+GPU_TIMER_VERSION = (3, 3)
+NS_PER_MS = 1e6
+MS_PER_S = 1000
+# Frames per second of the time of a camera path, so that every run renders
+# the same views no matter how fast it goes
+CAMERA_PATH_FPS = 60
+
+
+class GPUTimer:
+    def __init__(self, size=GPU_QUERIES):
+        """
+        Measure the GPU time of a block of GL calls with GL_TIME_ELAPSED
+        queries. Results are read a few frames later, when they are ready, so
+        the CPU never waits for the GPU.
+        Args:
+            size(int): Queries in flight, frames are not measured when all of
+                them are waiting
+        """
+        self.queries = (GLuint * size)()
+        glGenQueries(size, self.queries)
+        self.free = list(self.queries)
+        # (query, record) in the order they were issued
+        self.pending = deque()
+        self.active = None
+
+    def begin(self, record):
+        if not self.free:
+            return
+        query = self.free.pop()
+        glBeginQuery(GL_TIME_ELAPSED, query)
+        self.active = (query, record)
+
+    def end(self):
+        if self.active is None:
+            return
+        glEndQuery(GL_TIME_ELAPSED)
+        self.pending.append(self.active)
+        self.active = None
+
+    def poll(self):
+        """Store the GPU time of the frames whose queries are ready."""
+        while self.pending:
+            query, record = self.pending[0]
+            available = GLint()
+            glGetQueryObjectiv(query, GL_QUERY_RESULT_AVAILABLE, available)
+            if not available.value:
+                return
+            elapsed = GLuint64()
+            glGetQueryObjectui64v(query, GL_QUERY_RESULT, elapsed)
+            record["gpu_ms"] = elapsed.value / NS_PER_MS
+            self.pending.popleft()
+            self.free.append(query)
+
+    def delete(self):
+        glDeleteQueries(len(self.queries), self.queries)
+
+
+class FrameProfiler:
+    def __init__(self, window, terrain, record=False):
+        """
+        Measure every frame of a window: the CPU time of each phase, the GPU
+        time of the terrain and the size of the mesh that is drawn. Shows the
+        rolling statistics in an overlay and can keep every frame for a CSV.
+        Args:
+            window(Window): The window
+            terrain(Terrain): Terrain drawn in the window
+            record(bool): Whether to keep every frame for dump_csv
+        """
+        self.window = window
+        self.terrain = terrain
+        self.camera = None
+        self.records = [] if record else None
+        self.history = deque(maxlen=HISTORY_FRAMES)
+        self.frame = 0
+        self.record = None
+        self.frame_start = None
+        self.start_time = time.perf_counter()
+        self.gpu_timer = None
+        if window.context.get_info().have_version(*GPU_TIMER_VERSION):
+            self.gpu_timer = GPUTimer()
+        self.label = pyglet.text.Label(
+            "", font_name=OVERLAY_FONT, font_size=OVERLAY_FONT_SIZE,
+            x=OVERLAY_MARGIN, y=window.height - OVERLAY_MARGIN,
+            width=OVERLAY_WIDTH, anchor_y='top', multiline=True,
+            color=(255, 255, 255, 255)
+        )
+        self.last_update = 0
+
+    def start_frame(self):
+        """Finish the last frame and start measuring a new one."""
+        now = time.perf_counter()
+        if self.record is not None:
+            self.record["frame_ms"] = (now - self.frame_start) * MS_PER_S
+            self.history.append(self.record)
+            if self.records is not None:
+                self.records.append(self.record)
+        if self.gpu_timer is not None:
+            self.gpu_timer.poll()
+        self.frame_start = now
+        self.record = {
+            "frame": self.frame,
+            "time": now - self.start_time,
+            "gpu_ms": None,
+            "draw_mode": self.terrain.draw_mode,
+            "vertices": self.terrain.vertex_count,
+            "triangles": self.terrain.triangle_count
+        }
+        for phase in PHASES:
+            self.record[f"{phase}_ms"] = 0.0
+        if self.camera is not None:
+            self.record.update({
+                "x": self.camera.position.x,
+                "y": self.camera.position.y,
+                "z": self.camera.position.z,
+                "pitch": self.camera.pitch,
+                "yaw": self.camera.yaw
+            })
+        self.frame += 1
+
+    @contextmanager
+    def measure(self, phase):
+        """Add the CPU time of a block to a phase of the current frame."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.record is not None:
+                self.record[f"{phase}_ms"] += (
+                    (time.perf_counter() - start) * MS_PER_S
+                )
+
+    @contextmanager
+    def measure_gpu(self):
+        """Measure the GPU time of the GL calls of a block."""
+        if self.gpu_timer is None or self.record is None:
+            yield
+            return
+        self.gpu_timer.begin(self.record)
+        try:
+            yield
+        finally:
+            self.gpu_timer.end()
+
+    def get_stats(self):
+        """
+        Get the statistics of the recent frames.
+        Returns:
+            dict: Mean and percentiles of the frame time, mean of each phase
+                and of the GPU time in ms, None if no frame finished
+        """
+        if not self.history:
+            return None
+        frame_times = np.array([r["frame_ms"] for r in self.history])
+        stats = {
+            "frame_ms": frame_times.mean(),
+            "fps": MS_PER_S / frame_times.mean(),
+            "percentiles": dict(
+                zip(PERCENTILES, np.percentile(frame_times, PERCENTILES))
+            ),
+            "histogram": np.bincount(
+                np.searchsorted(HISTOGRAM_BINS, frame_times),
+                minlength=len(HISTOGRAM_BINS) + 1
+            )
+        }
+        for phase in PHASES:
+            stats[f"{phase}_ms"] = np.mean(
+                [r[f"{phase}_ms"] for r in self.history]
+            )
+        gpu_times = [
+            r["gpu_ms"] for r in self.history if r["gpu_ms"] is not None
+        ]
+        stats["gpu_ms"] = np.mean(gpu_times) if gpu_times else None
+        return stats
+
+    def get_text(self):
+        stats = self.get_stats()
+        if stats is None:
+            return ""
+        percentiles = "  ".join(
+            f"p{p} {value:.1f}" for p, value in stats["percentiles"].items()
+        )
+        gpu = (
+            "n/a" if stats["gpu_ms"] is None else f"{stats['gpu_ms']:.2f} ms"
+        )
+        lines = [
+            f"Frame {stats['frame_ms']:.2f} ms ({stats['fps']:.0f} fps)",
+            f"  {percentiles}",
+            "CPU " + "  ".join(
+                f"{phase} {stats[f'{phase}_ms']:.2f}" for phase in PHASES
+            ),
+            f"GPU {gpu}",
+            f"Mode {self.terrain.draw_mode}: "
+            f"{self.terrain.vertex_count} vertices, "
+            f"{self.terrain.triangle_count} triangles",
+            ""
+        ]
+        histogram = stats["histogram"]
+        bounds = [f"<{b:g}" for b in HISTOGRAM_BINS]
+        bounds.append(f">{HISTOGRAM_BINS[-1]:g}")
+        most = max(histogram.max(), 1)
+        for bound, count in zip(bounds, histogram):
+            bar = "#" * int(round(count / most * HISTOGRAM_BAR_WIDTH))
+            lines.append(f"{bound:>5} ms |{bar} {count}")
+        return "\n".join(lines)
+
+    def draw(self):
+        """Draw the overlay, its text changes a few times per second."""
+        now = time.perf_counter()
+        if now - self.last_update >= OVERLAY_UPDATE_INTERVAL:
+            self.last_update = now
+            self.label.y = self.window.height - OVERLAY_MARGIN
+            self.label.text = self.get_text()
+        self.label.draw()
+
+    def dump_csv(self, path):
+        """
+        Write every recorded frame to a CSV file.
+        Args:
+            path(str): Path of the file
+        """
+        if self.gpu_timer is not None:
+            glFinish()
+            self.gpu_timer.poll()
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, CSV_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(self.records or [])
+        print(f"Finished writing {path}")
+
+    def print_summary(self):
+        text = self.get_text()
+        if text:
+            print(text)
+
+
+class CameraPath:
+    def __init__(self, keyframes):
+        """
+        Path that moves a camera through keyframes, used to profile the same
+        views in every run.
+        Args:
+            keyframes(list): Dicts with the time in seconds, the position as
+                [x, y, z] and the pitch and yaw of the camera, sorted by time
+        """
+        self.keyframes = keyframes
+        self.times = [keyframe['time'] for keyframe in keyframes]
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            keyframes = json.load(f)
+        return cls(sorted(keyframes, key=lambda k: k['time']))
+
+    @property
+    def duration(self):
+        return self.times[-1]
+
+    def apply(self, camera, frame):
+        """
+        Place a camera where the path is in a frame.
+        Args:
+            camera(FPSCamera): The camera
+            frame(int): Number of the frame, at CAMERA_PATH_FPS
+        Returns:
+            bool: False when the path is over
+        """
+        t = frame / CAMERA_PATH_FPS
+        if t > self.duration:
+            return False
+        i = int(np.searchsorted(self.times, t, side='right'))
+        start = self.keyframes[max(i - 1, 0)]
+        end = self.keyframes[min(i, len(self.keyframes) - 1)]
+        span = end['time'] - start['time']
+        weight = 0 if span == 0 else (t - start['time']) / span
+        position = [
+            a + (b - a) * weight
+            for a, b in zip(start['position'], end['position'])
+        ]
+        camera.position = Vec3(*position)
+        camera.pitch = (
+            start['pitch'] + (end['pitch'] - start['pitch']) * weight
+        )
+        camera.yaw = start['yaw'] + (end['yaw'] - start['yaw']) * weight
+        return True
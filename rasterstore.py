@@ -0,0 +1,352 @@
+import argparse
+import json
+import math
+import os
+import sys
+
+import numpy as np
+from PIL import Image
+
+# Local modules
+from constants import *
+import utils
+
+# A store is a folder with a manifest and a .npy file per chunk
+STORE_SUFFIX = ".chunks"
+MANIFEST_FILENAME = "manifest.json"
+CHUNK_FILENAME = "{row}_{col}.npy"
+STORE_VERSION = 1
+# Pixels in a side of a chunk
+DEFAULT_CHUNK_SIZE = 1024
+GRAY_MODE = 'L'
+RGB_MODE = 'RGB'
+
+
+def get_store_filename(filename):
+    """Get the name of the store of a raster, like height_map.chunks."""
+    return f"{os.path.splitext(filename)[0]}{STORE_SUFFIX}"
+
+
+def get_spans(start, stop, step, chunk_size):
+    """
+    Split a range of pixels with a step by the chunks it crosses.
+    Args:
+        start(int): First pixel
+        stop(int): Pixel after the last one
+        step(int): Pixels between two samples
+        chunk_size(int): Pixels in a side of a chunk
+    Returns:
+        list: (chunk, slice in the chunk, slice in the output) of every
+            chunk that has samples
+    """
+    spans = []
+    for chunk in range(start // chunk_size, (stop - 1) // chunk_size + 1):
+        chunk_start = chunk * chunk_size
+        chunk_stop = min(chunk_start + chunk_size, stop)
+        # First sample inside the chunk
+        first = start + math.ceil(max(chunk_start - start, 0) / step) * step
+        if first >= chunk_stop:
+            continue
+        count = math.ceil((chunk_stop - first) / step)
+        output_start = (first - start) // step
+        spans.append((
+            chunk,
+            slice(first - chunk_start, chunk_stop - chunk_start, step),
+            slice(output_start, output_start + count)
+        ))
+    return spans
+
+
+class ChunkedRaster:
+    def __init__(self, path, shape, dtype, chunk_size, mode='r'):
+        """
+        Raster stored on disk in square chunks, each one a .npy file that is
+        memory-mapped when it's first used, so that stages read and write
+        windows of rasters that don't fit in memory. Use create or open.
+        Args:
+            path(str): Folder of the store
+            shape(tuple): Rows, columns and channels if it has them
+            dtype(dtype): Type of the pixels
+            chunk_size(int): Pixels in a side of a chunk
+            mode(str): 'r' to read and 'r+' to also write
+        """
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+        self.mode = mode
+        # Memory maps of the chunks by (row, col)
+        self.chunks = {}
+
+    @classmethod
+    def create(cls, path, shape, dtype, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Create an empty store, with zeros in every pixel.
+        Args:
+            path(str): Folder of the store
+            shape(tuple): Rows, columns and channels if it has them
+            dtype(dtype): Type of the pixels
+            chunk_size(int): Pixels in a side of a chunk
+        Returns:
+            ChunkedRaster: The store, open to write
+        """
+        os.makedirs(path, exist_ok=True)
+        store = cls(path, shape, dtype, chunk_size, mode='r+')
+        rows, cols = store.grid
+        for row in range(rows):
+            for col in range(cols):
+                top, left, bottom, right = store.get_chunk_box(row, col)
+                np.lib.format.open_memmap(
+                    store.get_chunk_path(row, col), mode='w+',
+                    dtype=store.dtype,
+                    shape=(bottom - top, right - left) + store.shape[2:]
+                )
+        # The manifest is written last, so half created stores aren't opened
+        manifest = {
+            "version": STORE_VERSION,
+            "shape": list(store.shape),
+            "dtype": store.dtype.str,
+            "chunkSize": chunk_size
+        }
+        with open(f"{path}/{MANIFEST_FILENAME}", 'w') as f:
+            json.dump(manifest, f, indent=JSON_INDENT)
+        return store
+
+    @classmethod
+    def open(cls, path, mode='r'):
+        with open(f"{path}/{MANIFEST_FILENAME}", 'r') as f:
+            manifest = json.load(f)
+        return cls(
+            path, manifest['shape'], manifest['dtype'],
+            manifest['chunkSize'], mode
+        )
+
+    @staticmethod
+    def exists(path):
+        return os.path.isfile(f"{path}/{MANIFEST_FILENAME}")
+
+    def __getstate__(self):
+        # Memory maps aren't sent to other processes, they map the files again
+        state = dict(self.__dict__)
+        state['chunks'] = {}
+        return state
+
+    @property
+    def grid(self):
+        """tuple: Rows and columns of chunks"""
+        return (
+            math.ceil(self.shape[0] / self.chunk_size),
+            math.ceil(self.shape[1] / self.chunk_size)
+        )
+
+    def get_chunk_path(self, row, col):
+        return f"{self.path}/{CHUNK_FILENAME.format(row=row, col=col)}"
+
+    def get_chunk_box(self, row, col):
+        top = row * self.chunk_size
+        left = col * self.chunk_size
+        return (
+            top, left, min(top + self.chunk_size, self.shape[0]),
+            min(left + self.chunk_size, self.shape[1])
+        )
+
+    def get_chunk(self, row, col):
+        if (row, col) not in self.chunks:
+            self.chunks[(row, col)] = np.load(
+                self.get_chunk_path(row, col), mmap_mode=self.mode
+            )
+        return self.chunks[(row, col)]
+
+    def read(self, box, step=1):
+        """
+        Read a window of the raster.
+        Args:
+            box(tuple): (top, left, bottom, right) of the window in pixels
+            step(int): Pixels between two samples in both axes
+        Returns:
+            ndarray: The pixels of the window
+        """
+        top, left, bottom, right = box
+        output = np.empty(
+            (
+                max(math.ceil((bottom - top) / step), 0),
+                max(math.ceil((right - left) / step), 0)
+            ) + self.shape[2:],
+            dtype=self.dtype
+        )
+        if output.size == 0:
+            return output
+        col_spans = get_spans(left, right, step, self.chunk_size)
+        for row, chunk_rows, rows in get_spans(
+                top, bottom, step, self.chunk_size
+        ):
+            for col, chunk_cols, cols in col_spans:
+                output[rows, cols] = self.get_chunk(row, col)[
+                    chunk_rows, chunk_cols
+                ]
+        return output
+
+    def write(self, top, left, arr):
+        """
+        Write a window of the raster.
+        Args:
+            top(int): First row of the window
+            left(int): First column of the window
+            arr(ndarray): Pixels of the window
+        """
+        bottom = top + arr.shape[0]
+        right = left + arr.shape[1]
+        col_spans = get_spans(left, right, 1, self.chunk_size)
+        for row, chunk_rows, rows in get_spans(
+                top, bottom, 1, self.chunk_size
+        ):
+            for col, chunk_cols, cols in col_spans:
+                self.get_chunk(row, col)[chunk_rows, chunk_cols] = (
+                    arr[rows, cols]
+                )
+
+    def flush(self):
+        for chunk in self.chunks.values():
+            if self.mode != 'r':
+                chunk.flush()
+
+    def windows(self, margin=0):
+        """
+        Iterate the chunks with a margin around them, for stages whose
+        output in a pixel depends on the pixels near it.
+        Args:
+            margin(int): Pixels around each chunk, cut at the border of the
+                raster
+        Returns:
+            generator: (box of the chunk, box of the window) in pixels
+        """
+        rows, cols = self.grid
+        h, w = self.shape[:2]
+        for row in range(rows):
+            for col in range(cols):
+                top, left, bottom, right = self.get_chunk_box(row, col)
+                yield (top, left, bottom, right), (
+                    max(top - margin, 0), max(left - margin, 0),
+                    min(bottom + margin, h), min(right + margin, w)
+                )
+
+    def __getitem__(self, key):
+        """Read pixels like an ndarray, with a row and a column."""
+        row, col = key
+        if isinstance(row, (int, np.integer)) and \
+                isinstance(col, (int, np.integer)):
+            # Single pixels come straight from their chunk
+            row %= self.shape[0]
+            col %= self.shape[1]
+            return self.get_chunk(
+                row // self.chunk_size, col // self.chunk_size
+            )[row % self.chunk_size, col % self.chunk_size]
+        rows = row if isinstance(row, slice) else slice(row, row + 1)
+        cols = col if isinstance(col, slice) else slice(col, col + 1)
+        top, bottom, row_step = rows.indices(self.shape[0])
+        left, right, col_step = cols.indices(self.shape[1])
+        if row_step != col_step:
+            raise IndexError("Both axes of a store must have the same step")
+        arr = self.read((top, left, bottom, right), row_step)
+        if not isinstance(row, slice):
+            arr = arr[0]
+        elif not isinstance(col, slice):
+            arr = arr[:, 0]
+        return arr
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self.read((0, 0) + self.shape[:2])
+        return arr if dtype is None else arr.astype(dtype)
+
+
+def create_like(path, store, dtype=None, channels=()):
+    """
+    Create a store with the rows, columns and chunks of another one.
+    Args:
+        path(str): Folder of the new store
+        store(ChunkedRaster): Store to copy the layout from
+        dtype(dtype): Type of the pixels, the one of store if None
+        channels(tuple): Channels of each pixel
+    Returns:
+        ChunkedRaster: The new store
+    """
+    return ChunkedRaster.create(
+        path, store.shape[:2] + tuple(channels),
+        store.dtype if dtype is None else dtype, store.chunk_size
+    )
+
+
+def import_image(image_path, path, mode=GRAY_MODE,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Convert an image into a store. PIL can't decode a region of a PNG, so the
+    image is decoded once here and every later read is a window.
+    Args:
+        image_path(str): Path of the image
+        path(str): Folder of the store
+        mode(str): GRAY_MODE or RGB_MODE
+        chunk_size(int): Pixels in a side of a chunk
+    Returns:
+        ChunkedRaster: The store
+    """
+    arr = np.asarray(Image.open(image_path).convert(mode), dtype=np.uint8)
+    store = ChunkedRaster.create(path, arr.shape, arr.dtype, chunk_size)
+    store.write(0, 0, arr)
+    store.flush()
+    return store
+
+
+def import_map(ctx, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Convert the raster inputs of a map into stores next to them.
+    Args:
+        ctx(MapContext): The map
+        chunk_size(int): Pixels in a side of a chunk
+    Returns:
+        list: Names of the images that were converted
+    """
+    images = [
+        (HEIGHT_MAP_FILENAME, GRAY_MODE), (ROAD_MAP_FILENAME, GRAY_MODE),
+        (GROUND_TEXTURE, RGB_MODE)
+    ]
+    images += [
+        (f"{ecotope['name']}_{DENSITY_FILENAME}", GRAY_MODE)
+        for ecotope in ctx.ecotopes
+    ]
+    imported = []
+    for filename, mode in images:
+        if not ctx.has_file(filename):
+            continue
+        store = import_image(
+            ctx.path(filename), ctx.path(get_store_filename(filename)), mode,
+            chunk_size
+        )
+        print(f"Finished writing {store.path} {store.shape} in {store.grid} "
+              f"chunks")
+        imported.append(filename)
+    return imported
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert the PNG inputs of a map into chunked stores that "
+                    "builds read window by window"
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+        help="Pixels in a side of a chunk"
+    )
+    args = parser.parse_args()
+    # Load map names
+    with open(MAPS_FILENAME, 'r') as f:
+        cities = json.load(f)
+    option = int(input(utils.menu_str(cities))) - 1
+    if option == EXIT_CODE:
+        sys.exit("You selected to exit the program")
+    # Imported here so that the map context can import this module
+    from map_context import MapContext
+    import_map(MapContext(cities[option].lower()), args.chunk_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,424 @@
+import heapq
+import io
+import math
+import os
+
+import numpy as np
+
+# Local modules
+import roads
+
+# Pixels that a simplified polyline can be away from the skeleton
+SIMPLIFY_TOLERANCE = 1.0
+# Children of every node of the segment index
+INDEX_CAPACITY = 16
+# Distance under which a point is on the road and faces along it
+ON_ROAD_DISTANCE = 1e-6
+# Neighbors of a pixel as (row, col) offsets, the 4 connected ones first so
+# that traces follow staircases instead of skipping their corners
+NEIGHBOR_OFFSETS = [
+    (-1, 0), (0, 1), (1, 0), (0, -1), (-1, 1), (1, 1), (1, -1), (-1, -1)
+]
+# Neighbors in circular order, for the transitions of the thinning
+RING_OFFSETS = [
+    (-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1)
+]
+
+
+def get_ring(img):
+    """Get the 8 neighbors of every pixel of a padded image, in order."""
+    h, w = img.shape
+    return [
+        img[1 + dj:h - 1 + dj, 1 + di:w - 1 + di] for dj, di in RING_OFFSETS
+    ]
+
+
+def skeletonize(mask):
+    """
+    Thin a binary raster to lines one pixel wide with the Zhang-Suen
+    algorithm, every pass over the whole raster at once.
+    Args:
+        mask(ndarray): Booleans, True in the roads
+    Returns:
+        ndarray: Booleans, True in the skeleton
+    """
+    img = np.pad(mask.astype(np.uint8), 1)
+    center = img[1:-1, 1:-1]
+    changed = True
+    while changed:
+        changed = False
+        for step in range(2):
+            p2, p3, p4, p5, p6, p7, p8, p9 = get_ring(img)
+            neighbors = p2 + p3 + p4 + p5 + p6 + p7 + p8 + p9
+            ring = [p2, p3, p4, p5, p6, p7, p8, p9, p2]
+            transitions = sum(
+                (ring[k] == 0) & (ring[k + 1] == 1) for k in range(8)
+            )
+            if step == 0:
+                is_side = ((p2 & p4 & p6) == 0) & ((p4 & p6 & p8) == 0)
+            else:
+                is_side = ((p2 & p4 & p8) == 0) & ((p2 & p6 & p8) == 0)
+            removed = (
+                (center == 1) & (neighbors >= 2) & (neighbors <= 6) &
+                (transitions == 1) & is_side
+            )
+            if removed.any():
+                center[removed] = 0
+                changed = True
+    return center.astype(bool)
+
+
+def trace_polylines(skeleton):
+    """
+    Follow the skeleton between its nodes, the pixels that don't have
+    exactly two neighbors. Loops without nodes start in any of their pixels.
+    Args:
+        skeleton(ndarray): Booleans, True in the skeleton
+    Returns:
+        list: Polylines as lists of (row, col) pixels
+    """
+    h, w = skeleton.shape
+    padded = np.pad(skeleton.astype(np.uint8), 1)
+    is_node = skeleton & (sum(get_ring(padded)) != 2)
+    visited = np.zeros_like(skeleton)
+
+    def get_neighbors(pixel):
+        j, i = pixel
+        return [
+            (j + dj, i + di) for dj, di in NEIGHBOR_OFFSETS
+            if 0 <= j + dj < h and 0 <= i + di < w and skeleton[j + dj, i + di]
+        ]
+
+    def follow(start, first):
+        path = [start, first]
+        visited[first] = True
+        previous, current = start, first
+        while not is_node[current]:
+            candidates = [
+                pixel for pixel in get_neighbors(current)
+                if pixel != previous and (is_node[pixel] or not visited[pixel])
+            ]
+            if not candidates:
+                break
+            # Stop at a node next to the path before taking a side pixel
+            nodes = [pixel for pixel in candidates if is_node[pixel]]
+            previous, current = current, (nodes or candidates)[0]
+            path.append(current)
+            visited[current] = True
+        return path
+
+    polylines = []
+
+    def trace_from(node):
+        traced = False
+        for pixel in get_neighbors(node):
+            if is_node[pixel]:
+                # Nodes next to each other are joined once
+                if pixel > node:
+                    polylines.append([node, pixel])
+                traced = True
+            elif not visited[pixel]:
+                polylines.append(follow(node, pixel))
+                traced = True
+        return traced
+
+    for node in zip(*np.nonzero(is_node)):
+        visited[node] = True
+        if not trace_from(node) and not get_neighbors(node):
+            # Isolated pixels are roads too
+            polylines.append([node, node])
+    # Loops and the pixels that the traces went around
+    for pixel in zip(*np.nonzero(skeleton & ~visited)):
+        if visited[pixel]:
+            continue
+        is_node[pixel] = True
+        visited[pixel] = True
+        if not trace_from(pixel):
+            polylines.append([pixel, get_neighbors(pixel)[0]])
+    return polylines
+
+
+def get_segment_distances(x, y, starts, ends):
+    """
+    Get the distance from a point to every segment, or from every point to a
+    segment.
+    Args:
+        x(float): Column of the point
+        y(float): Row of the point
+        starts(ndarray): (x, y) of the start of each segment
+        ends(ndarray): (x, y) of the end of each segment
+    Returns:
+        tuple: Distances and the parameter in [0, 1] of the closest point of
+            each segment
+    """
+    direction = ends - starts
+    length2 = (direction ** 2).sum(axis=1)
+    offset_x = x - starts[:, 0]
+    offset_y = y - starts[:, 1]
+    dot = offset_x * direction[:, 0] + offset_y * direction[:, 1]
+    t = np.divide(
+        dot, length2, out=np.zeros(np.broadcast(dot, length2).shape),
+        where=length2 > 0
+    )
+    t = np.clip(t, 0, 1)
+    dx = offset_x - t * direction[:, 0]
+    dy = offset_y - t * direction[:, 1]
+    return np.hypot(dx, dy), t
+
+
+def simplify(points, tolerance=SIMPLIFY_TOLERANCE):
+    """
+    Remove the points of a polyline that are closer than a tolerance to the
+    line without them (Douglas-Peucker).
+    Args:
+        points(ndarray): (x, y) of each point
+        tolerance(float): Largest distance to the original polyline
+    Returns:
+        ndarray: The points that are kept
+    """
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        inner = points[first + 1:last]
+        distances, _ = get_segment_distances(
+            inner[:, 0], inner[:, 1], points[first:first + 1],
+            points[last:last + 1]
+        )
+        k = int(np.argmax(distances))
+        if distances[k] > tolerance:
+            middle = first + 1 + k
+            keep[middle] = True
+            stack += [(first, middle), (middle, last)]
+    return points[keep]
+
+
+def get_box_distances(x, y, boxes):
+    """Get the distance from a point to (min x, min y, max x, max y) boxes."""
+    dx = np.maximum(np.maximum(boxes[:, 0] - x, x - boxes[:, 2]), 0)
+    dy = np.maximum(np.maximum(boxes[:, 1] - y, y - boxes[:, 3]), 0)
+    return np.hypot(dx, dy)
+
+
+class SegmentIndex:
+    def __init__(self, starts, ends, capacity=INDEX_CAPACITY):
+        """
+        Packed R-tree of segments, built with Sort-Tile-Recursive: segments
+        are sorted in vertical slices and then by row, and every node holds
+        the boxes of capacity consecutive children, so children are found by
+        their position instead of pointers. Nearest queries visit O(log n)
+        nodes.
+        Args:
+            starts(ndarray): (x, y) of the start of each segment
+            ends(ndarray): (x, y) of the end of each segment
+            capacity(int): Children of every node
+        """
+        self.capacity = capacity
+        centers = (starts + ends) / 2
+        count = len(starts)
+        leaves = math.ceil(count / capacity)
+        slice_size = capacity * math.ceil(math.sqrt(leaves)) or 1
+        by_x = np.argsort(centers[:, 0], kind='stable')
+        slices = np.arange(count) // slice_size
+        # Sort by slice and then by row inside it
+        self.order = by_x[np.lexsort((centers[by_x, 1], slices))]
+        self.starts = starts[self.order]
+        self.ends = ends[self.order]
+        boxes = np.concatenate([
+            np.minimum(self.starts, self.ends),
+            np.maximum(self.starts, self.ends)
+        ], axis=1)
+        # Boxes of the segments, and of the nodes of each level above them
+        self.levels = [boxes]
+        while len(boxes) > 1:
+            groups = np.arange(0, len(boxes), capacity)
+            boxes = np.concatenate([
+                np.minimum.reduceat(boxes[:, :2], groups),
+                np.maximum.reduceat(boxes[:, 2:], groups)
+            ], axis=1)
+            self.levels.append(boxes)
+
+    def nearest(self, x, y):
+        """
+        Find the segment closest to a point, visiting the nodes in order of
+        their distance until a segment is closer than every node left.
+        Args:
+            x(float): Column of the point
+            y(float): Row of the point
+        Returns:
+            tuple: Index of the segment, its distance and the parameter of
+                its closest point, None if there are no segments
+        """
+        if len(self.starts) == 0:
+            return None
+        top = len(self.levels) - 1
+        queue = [(0.0, top, 0, 0.0)]
+        while queue:
+            distance, level, k, t = heapq.heappop(queue)
+            if level < 0:
+                return int(self.order[k]), distance, t
+            if level == 0:
+                # A segment's box is expanded into the segment itself
+                distances, ts = get_segment_distances(
+                    x, y, self.starts[k:k + 1], self.ends[k:k + 1]
+                )
+                heapq.heappush(queue, (distances[0], -1, k, ts[0]))
+                continue
+            first = k * self.capacity
+            last = min(first + self.capacity, len(self.levels[level - 1]))
+            if level == 1:
+                distances, ts = get_segment_distances(
+                    x, y, self.starts[first:last], self.ends[first:last]
+                )
+                for child in range(first, last):
+                    heapq.heappush(queue, (
+                        distances[child - first], -1, child, ts[child - first]
+                    ))
+                continue
+            distances = get_box_distances(
+                x, y, self.levels[level - 1][first:last]
+            )
+            for child in range(first, last):
+                heapq.heappush(
+                    queue, (distances[child - first], level - 1, child, 0.0)
+                )
+        return None
+
+
+class RoadGraph:
+    def __init__(self, points, segments, shape):
+        """
+        Roads as polylines, with an index of their segments for nearest road
+        queries at any distance.
+        Args:
+            points(ndarray): (x, y) in pixels of the road map of every point,
+                pixel centers are at .5
+            segments(ndarray): Indices of the two points of every segment
+            shape(tuple): Rows and columns of the road map
+        """
+        self.shape = tuple(int(n) for n in shape)
+        self.points = np.asarray(points, dtype=np.float32)
+        self.segments = np.asarray(segments, dtype=np.uint32)
+        starts = self.points[self.segments[:, 0]].astype(float)
+        ends = self.points[self.segments[:, 1]].astype(float)
+        self.index = SegmentIndex(
+            starts.reshape(-1, 2), ends.reshape(-1, 2)
+        )
+
+    @classmethod
+    def from_road_map(cls, road_map, tolerance=SIMPLIFY_TOLERANCE):
+        """
+        Extract the graph of a road map: the roads are thinned to their
+        center lines, traced into polylines between junctions and ends, and
+        simplified.
+        Args:
+            road_map(ndarray): Map where white means roads
+            tolerance(float): Pixels that the polylines can be away from the
+                center lines
+        Returns:
+            RoadGraph: The graph
+        """
+        mask = roads.high_pass(road_map, 1).astype(bool)
+        points = []
+        segments = []
+        # Junctions and ends are shared by the polylines that meet there
+        point_ids = {}
+
+        def get_point_id(x, y):
+            if (x, y) not in point_ids:
+                point_ids[(x, y)] = len(points)
+                points.append((x, y))
+            return point_ids[(x, y)]
+
+        for polyline in trace_polylines(skeletonize(mask)):
+            pixels = np.array(polyline, dtype=float)
+            line = simplify(pixels[:, ::-1] + 0.5, tolerance)
+            if len(line) == 1:
+                line = np.repeat(line, 2, axis=0)
+            ids = [get_point_id(x, y) for x, y in line.tolist()]
+            segments += zip(ids[:-1], ids[1:])
+        return cls(
+            np.array(points, dtype=np.float32).reshape(-1, 2),
+            np.array(segments, dtype=np.uint32).reshape(-1, 2),
+            road_map.shape
+        )
+
+    def nearest(self, x, y):
+        """
+        Find the closest point of the roads.
+        Args:
+            x(float): Column of the point in pixels of the road map
+            y(float): Row of the point in pixels of the road map
+        Returns:
+            tuple: Index of the segment, distance and (x, y) of the closest
+                point, None if there are no roads
+        """
+        result = self.index.nearest(x, y)
+        if result is None:
+            return None
+        segment, distance, t = result
+        start, end = self.points[self.segments[segment]].astype(float)
+        return segment, distance, tuple(start + t * (end - start))
+
+    def get_tangent(self, segment):
+        """Get the direction of a segment in radians, counter clockwise from
+        the x axis with rows going up."""
+        start, end = self.points[self.segments[segment]].astype(float)
+        return math.atan2(-(end[1] - start[1]), end[0] - start[0])
+
+    def get_facing(self, x, y):
+        """
+        Get the rotation that faces the nearest road from a point, in the
+        convention of roads.create_orientation_map. Points on a road face
+        along it.
+        Args:
+            x(float): Column of the point in pixels of the road map
+            y(float): Row of the point in pixels of the road map
+        Returns:
+            float: Rotation in the up axis in radians, 0 without roads
+        """
+        result = self.nearest(x, y)
+        if result is None:
+            return 0.0
+        segment, distance, (road_x, road_y) = result
+        if distance < ON_ROAD_DISTANCE:
+            return self.get_tangent(segment)
+        return math.atan2(-(road_y - y), road_x - x)
+
+    def save(self, path, key=b""):
+        """
+        Write the graph compressed, with the digest of the road map it was
+        extracted from.
+        Args:
+            path(str): Path of the .npz file
+            key(bytes): Digest of the road map
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer, points=self.points, segments=self.segments,
+            shape=np.array(self.shape), key=np.frombuffer(key, dtype=np.uint8)
+        )
+        with open(path, 'wb') as f:
+            f.write(buffer.getvalue())
+
+    @classmethod
+    def load(cls, path, key=None):
+        """
+        Read a graph written by save.
+        Args:
+            path(str): Path of the .npz file
+            key(bytes): If given, digest of the road map it must come from
+        Returns:
+            RoadGraph: The graph, None if there is no file or it comes from
+                another road map
+        """
+        if not os.path.isfile(path):
+            return None
+        with np.load(path) as npz:
+            if key is not None and npz['key'].tobytes() != key:
+                return None
+            return cls(npz['points'], npz['segments'], npz['shape'])
@@ -1,9 +1,18 @@
 import numpy as np
-from PIL import Image
+
+# Local modules
+import memory
 
 MAX_COLOR = 255
 DEFAULT_COMPARISON_DISTANCE = 2
+# Orientation sample size
+ORIENT_SAMPLE_SIZE = 5
 RGB_CHANNELS = 3
+# Bytes of working arrays per pixel while computing the orientation map
+ORIENT_BYTES_PER_PIXEL = 40
+# Roads farther than this don't change the distance map, which stops at
+# MAX_COLOR
+DIST_MARGIN = MAX_COLOR
 
 
 def high_pass(arr, num):
@@ -69,18 +78,126 @@ def flood(img_arr):
     return new_arr
 
 
-def create_dist_map(road_map):
+def create_dist_map(road_map, flood_kernel=flood):
     """
-    Create a map where each pixel is the distance to the nearest road, up to 255
-    pixels.
+    Create a map where each pixel is the distance to the nearest road, up to
+    255 pixels.
     Args:
         road_map(ndarray): Map where white means roads and black is no roads.
             The map has to have a value for white equal to MAX_COLOR.
+        flood_kernel(function): Implementation of flood, see kernels.py
     Returns:
          ndarray: The map with the distances from the roads
     """
     final_arr = np.array(road_map, dtype=np.uint8)
     # transform array to binary
     final_arr = np.array(high_pass(final_arr, MAX_COLOR), dtype=np.uint8)
-    final_arr = flood(final_arr)
+    final_arr = flood_kernel(final_arr)
     return final_arr
+
+
+def crop_window(arr, box, window):
+    """Cut the pixels of a box out of a raster of a window that contains it."""
+    return arr[
+        box[0] - window[0]:box[2] - window[0],
+        box[1] - window[1]:box[3] - window[1]
+    ]
+
+
+def create_dist_store(road_store, dist_store, flood_kernel=flood):
+    """
+    Create the distance map of a chunked road map chunk by chunk. Each chunk
+    is flooded in a window with DIST_MARGIN pixels around it, which holds
+    every road that can be the nearest, so the distances are the same as the
+    ones of create_dist_map.
+    Args:
+        road_store(ChunkedRaster): Road map
+        dist_store(ChunkedRaster): Store with the same layout where the
+            distance map is written
+        flood_kernel(function): Implementation of flood, see kernels.py
+    Returns:
+        ChunkedRaster: dist_store
+    """
+    for box, window in road_store.windows(DIST_MARGIN):
+        dist_map = create_dist_map(road_store.read(window), flood_kernel)
+        dist_store.write(box[0], box[1], crop_window(dist_map, box, window))
+    dist_store.flush()
+    return dist_store
+
+
+def create_orientation_store(
+        dist_store, orientation_store, memory_budget=None
+):
+    """
+    Create the orientation map of a chunked distance map chunk by chunk,
+    with the pixels around each chunk that its sample windows reach.
+    Args:
+        dist_store(ChunkedRaster): Distance map
+        orientation_store(ChunkedRaster): Store of float32 with the same
+            layout where the orientation map is written
+        memory_budget(int): Memory budget of the build in bytes
+    Returns:
+        ChunkedRaster: orientation_store
+    """
+    for box, window in dist_store.windows(ORIENT_SAMPLE_SIZE // 2):
+        orientation_map = create_orientation_map(
+            dist_store.read(window), memory_budget
+        )
+        orientation_store.write(
+            box[0], box[1], crop_window(orientation_map, box, window)
+        )
+    orientation_store.flush()
+    return orientation_store
+
+
+def create_orientation_map(dist_map, memory_budget=None):
+    """
+    Create a map with the rotation that an asset in each pixel needs to face
+    the nearest road. The nearest road is the pixel with the lowest distance
+    inside a window of ORIENT_SAMPLE_SIZE around the pixel, breaking ties by
+    the euclidean distance to the center of the window.
+    Args:
+        dist_map(ndarray): Map with the distances from the roads
+        memory_budget(int): Memory budget of the build in bytes, the map is
+            computed in bands of rows that fit in it
+    Returns:
+        ndarray: Rotation in the up axis in radians for each pixel (float32)
+    """
+    h, w = dist_map.shape
+    half = ORIENT_SAMPLE_SIZE // 2
+    # Pixels outside the map are never chosen
+    padded = np.pad(
+        dist_map.astype(np.int16), half, constant_values=2 * MAX_COLOR
+    )
+    offsets = [
+        (b - half, a - half)
+        for b in range(ORIENT_SAMPLE_SIZE)
+        for a in range(ORIENT_SAMPLE_SIZE)
+    ]
+    # Visit offsets by euclidean distance so the first minimum found wins
+    offsets.sort(key=lambda offset: offset[0] ** 2 + offset[1] ** 2)
+    orientation_map = np.empty([h, w], dtype=np.float32)
+    band_rows = memory.get_band_rows(
+        h, w * ORIENT_BYTES_PER_PIXEL, memory_budget
+    )
+    for top in range(0, h, band_rows):
+        rows = min(band_rows, h - top)
+        min_dist = np.full([rows, w], MAX_COLOR + 1, dtype=np.int16)
+        dx = np.zeros([rows, w], dtype=np.int8)
+        dy = np.zeros([rows, w], dtype=np.int8)
+        for db, da in offsets:
+            current_dist = padded[
+                top + half + db:top + half + db + rows, half + da:half + da + w
+            ]
+            is_closer = current_dist < min_dist
+            min_dist[is_closer] = current_dist[is_closer]
+            dx[is_closer] = da
+            dy[is_closer] = -db
+        norm = np.hypot(dx, dy, dtype=float)
+        norm[norm == 0] = 1
+        # Get the angle of rotation in the Z axis
+        rotation = np.arccos(dx / norm)
+        # If y component of orient vector is negative, rotate negative angle
+        rotation[dy < 0] *= -1
+        orientation_map[top:top + rows] = rotation
+    return orientation_map
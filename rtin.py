@@ -0,0 +1,183 @@
+import math
+
+import numpy as np
+from PIL import Image
+
+# Maximum number of triangles processed at once when building the pyramid
+CHUNK_SIZE = 2 ** 20
+
+
+class RTIN:
+    def __init__(self, height_map):
+        """
+        Right-Triangulated Irregular Network over a height map. The error of
+        every triangle is computed once in an error pyramid so that meshes for
+        any error tolerance can be extracted in time linear to their size.
+        The height map is resampled to a grid of 2^k + 1 pixels per side when
+        it doesn't have that size.
+        Args:
+            height_map(ndarray): Map where each pixel represents a height
+        """
+        self.h, self.w = height_map.shape
+        tile_size = 2 ** math.ceil(math.log2(max(self.h, self.w) - 1))
+        self.grid_size = tile_size + 1
+        if height_map.shape != (self.grid_size, self.grid_size):
+            img = Image.fromarray(np.asarray(height_map, dtype=np.float32))
+            img = img.resize(
+                (self.grid_size, self.grid_size), Image.BILINEAR
+            )
+            height_map = np.asarray(img)
+        self.terrain = np.asarray(height_map, dtype=np.float32).ravel()
+        self.errors = create_error_pyramid(self.terrain, self.grid_size)
+
+    def get_mesh(self, max_error):
+        """
+        Get the mesh with the fewest triangles whose error is not greater than
+        max_error.
+        Args:
+            max_error(float): Maximum difference allowed between the mesh and
+                the height map, in height map units
+        Returns:
+            tuple: Vertices as (column, row, height) in height map pixels and
+                triangles as indices of the vertices
+        """
+        size = self.grid_size
+        tile_size = size - 1
+        # The two root triangles of the square, as (a, b, c) corners
+        triangles = np.array([
+            [0, 0, tile_size, tile_size, tile_size, 0],
+            [tile_size, tile_size, 0, 0, 0, tile_size]
+        ], dtype=np.int64)
+        leaves = []
+        while len(triangles):
+            ax, ay, bx, by, cx, cy = triangles.T
+            mx = (ax + bx) >> 1
+            my = (ay + by) >> 1
+            is_split = (
+                (np.abs(ax - cx) + np.abs(ay - cy) > 1) &
+                (self.errors[my * size + mx] > max_error)
+            )
+            leaves.append(triangles[~is_split])
+            s = is_split
+            # Split by the middle of the hypotenuse in two children
+            left = np.stack(
+                [cx[s], cy[s], ax[s], ay[s], mx[s], my[s]], axis=1
+            )
+            right = np.stack(
+                [bx[s], by[s], cx[s], cy[s], mx[s], my[s]], axis=1
+            )
+            triangles = np.concatenate([left, right])
+        leaves = np.concatenate(leaves)
+        # Index the corners of the leaves
+        corners = leaves.reshape(-1, 2)
+        grid_indices = corners[:, 1] * size + corners[:, 0]
+        unique_indices, inverse = np.unique(grid_indices, return_inverse=True)
+        triangles = inverse.reshape(-1, 3).astype(np.uint32)
+        cols = (unique_indices % size).astype(np.float32)
+        rows = (unique_indices // size).astype(np.float32)
+        heights = self.terrain[unique_indices]
+        # Go back to the coordinates of the original height map
+        cols *= (self.w - 1) / (size - 1)
+        rows *= (self.h - 1) / (size - 1)
+        vertices = np.stack([cols, rows, heights], axis=1)
+        return vertices, triangles
+
+
+def get_triangle_coords(ids, tile_size):
+    """
+    Get the corners of the triangles of a RTIN from their ids. The lowest bit
+    of an id chooses one of the two root triangles and each following bit,
+    up to the leading one, chooses a half of the previous triangle.
+    Args:
+        ids(ndarray): Ids of triangles with the same number of bits
+        tile_size(int): Length of a side of the grid minus one
+    Returns:
+        tuple: Coordinates ax, ay, bx, by of the hypotenuse of each triangle
+    """
+    is_bottom_left = (ids & 1).astype(bool)
+    ax = np.where(is_bottom_left, 0, tile_size)
+    ay = np.where(is_bottom_left, 0, tile_size)
+    bx = np.where(is_bottom_left, tile_size, 0)
+    by = np.where(is_bottom_left, tile_size, 0)
+    cx = np.where(is_bottom_left, tile_size, 0)
+    cy = np.where(is_bottom_left, 0, tile_size)
+    levels = int(ids[0]).bit_length() - 1
+    for level in range(1, levels):
+        mx = (ax + bx) >> 1
+        my = (ay + by) >> 1
+        is_left = ((ids >> level) & 1).astype(bool)
+        ax, ay, bx, by = (
+            np.where(is_left, cx, bx), np.where(is_left, cy, by),
+            np.where(is_left, ax, cx), np.where(is_left, ay, cy)
+        )
+        cx, cy = mx, my
+    return ax, ay, bx, by
+
+
+def create_error_pyramid(terrain, grid_size):
+    """
+    Compute for each vertex of the grid the maximum error of the triangles
+    that would be split by it, going from the smallest triangles up to the
+    two root triangles.
+    Args:
+        terrain(ndarray): Flattened heights of a grid of grid_size per side
+        grid_size(int): Length of a side of the grid, 2^k + 1
+    Returns:
+        ndarray: Error of each vertex of the grid
+    """
+    tile_size = grid_size - 1
+    errors = np.zeros(grid_size * grid_size, dtype=np.float32)
+    max_level = 2 * int(math.log2(tile_size))
+    for level in range(max_level, 0, -1):
+        # Triangles in this level have ids from 2^level to 2^(level+1) - 1 and
+        # only depend on the errors of the levels below
+        first_id = 2 ** level
+        for start in range(first_id, 2 * first_id, CHUNK_SIZE):
+            end = min(start + CHUNK_SIZE, 2 * first_id)
+            ids = np.arange(start, end, dtype=np.int64)
+            ax, ay, bx, by = get_triangle_coords(ids, tile_size)
+            mx = (ax + bx) >> 1
+            my = (ay + by) >> 1
+            cx = mx + my - ay
+            cy = my + ax - mx
+            interpolated_height = (
+                terrain[ay * grid_size + ax] + terrain[by * grid_size + bx]
+            ) / 2
+            middle_index = my * grid_size + mx
+            middle_error = np.abs(interpolated_height - terrain[middle_index])
+            if level < max_level:
+                # Propagate the errors of the children
+                left_child_index = (
+                    ((ay + cy) >> 1) * grid_size + ((ax + cx) >> 1)
+                )
+                right_child_index = (
+                    ((by + cy) >> 1) * grid_size + ((bx + cx) >> 1)
+                )
+                middle_error = np.maximum.reduce([
+                    middle_error,
+                    errors[left_child_index],
+                    errors[right_child_index]
+                ])
+            np.maximum.at(errors, middle_index, middle_error)
+    return errors
+
+
+def calculate_normals(positions, triangles):
+    """
+    Calculate the normal of each vertex of a height field mesh as the sum of
+    the normals of the triangles it belongs to, all of them facing up.
+    Args:
+        positions(ndarray): Position of each vertex (N x 3)
+        triangles(ndarray): Indices of the vertices of each triangle (M x 3)
+    Returns:
+        ndarray: Normalized normal of each vertex (N x 3)
+    """
+    a, b, c = (positions[triangles[:, k]] for k in range(3))
+    face_normals = np.cross(b - a, c - a)
+    face_normals[face_normals[:, 1] < 0] *= -1
+    normals = np.zeros_like(positions)
+    for k in range(3):
+        np.add.at(normals, triangles[:, k], face_normals)
+    norm = np.linalg.norm(normals, axis=1, keepdims=True)
+    norm[norm == 0] = 1
+    return normals / norm
@@ -58,7 +58,9 @@ def discretize_density(density_map):
 def procedurally_place(placement_map, ecotope):
     h, w = placement_map.shape
     # Sort ecotope array
-    sorted_ecotope = sorted(ecotope, key=lambda e: e['footprint'], reverse=True)
+    sorted_ecotope = sorted(
+        ecotope, key=lambda e: e['footprint'], reverse=True
+    )
     # Iterate placing assets
     placement_json = []
     # Iterate on pixels
@@ -75,9 +77,15 @@ def procedurally_place(placement_map, ecotope):
                         position_offset = (
                             (-0.5 + rng.random(2)) * MAX_POS_OFFSET
                         )
-                        x = (i - w // 2 + 0.5 + position_offset[0]) * pixel_size
+                        x = (
+                            (i - w // 2 + 0.5 + position_offset[0]) *
+                            pixel_size
+                        )
                         y = 0
-                        z = (j - h // 2 + 0.5 + position_offset[1]) * pixel_size
+                        z = (
+                            (j - h // 2 + 0.5 + position_offset[1]) *
+                            pixel_size
+                        )
                         # rotation = rng.choice(ROTATIONS)
                         rotation = 0
                         scale_offset = rng.random() * MAX_SCALE
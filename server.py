@@ -0,0 +1,416 @@
+import argparse
+import gzip
+import hashlib
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import os.path
+import queue
+import re
+import struct
+import tempfile
+import threading
+from email.utils import formatdate
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Local modules
+from constants import *
+import watch
+
+DEFAULT_PORT = 8000
+BUNDLE_PREFIX = "/bundle/"
+EVENTS_PREFIX = "/events/"
+# Seconds between messages that keep an event stream open
+KEEP_ALIVE_INTERVAL = 15
+# Files that are worth compressing
+COMPRESSIBLE_EXTENSIONS = {
+    ".json", ".js", ".html", ".css", ".glb", ".bin", ".glsl"
+}
+# The files in the folders of maps are rebuilt, and pages, scripts and
+# configs change with the project, so they are always revalidated with their
+# ETags. The models and textures shared by all maps can be kept for a while
+REVALIDATE_EXTENSIONS = {".json", ".html", ".js", ".bin"}
+REVALIDATE_CACHE_CONTROL = "no-cache"
+LONG_CACHE_CONTROL = "public, max-age=3600"
+GZIP_LEVEL = 9
+# Encodings in order of preference and the extension of their files
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+RANGE_REGEX = re.compile(r"bytes=(\d*)-(\d*)$")
+
+
+def compress_file(path, encoding):
+    """
+    Write the compressed version of a file next to it, like surface.json.gz.
+    Args:
+        path(str): Path of the file
+        encoding(str): "gzip" or "br"
+    Returns:
+        str: Path of the compressed file or None if the encoding is not
+            available
+    """
+    if encoding == "br" and brotli is None:
+        return None
+    extension = dict(ENCODINGS)[encoding]
+    with open(path, 'rb') as f:
+        data = f.read()
+    if encoding == "br":
+        compressed = brotli.compress(data)
+    else:
+        compressed = gzip.compress(data, GZIP_LEVEL, mtime=0)
+    compressed_path = path + extension
+    # Other requests may be serving the file, so the new one is written apart
+    # and then renamed over it
+    directory, filename = os.path.split(compressed_path)
+    fd, temp_path = tempfile.mkstemp(prefix=f".{filename}.", dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(compressed)
+        os.replace(temp_path, compressed_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return compressed_path
+
+
+def precompress_dir(dir_path):
+    """
+    Compress every compressible file inside a directory with all the
+    available encodings.
+    Args:
+        dir_path(str): Directory, for example the folder of a map
+    """
+    for root, _, filenames in os.walk(dir_path):
+        for filename in filenames:
+            if os.path.splitext(filename)[1] in COMPRESSIBLE_EXTENSIONS:
+                for encoding, _ in ENCODINGS:
+                    compress_file(os.path.join(root, filename), encoding)
+
+
+def get_bundle_paths(map_name):
+    """
+    Get the files that a viewer needs to show a map, relative to the root of
+    the project.
+    Args:
+        map_name(str): Name of the map
+    Returns:
+        list: Paths of the files that exist
+    """
+    with open(ASSETS_FILENAME, 'r') as f:
+        assets = json.load(f)
+    paths = [ASSETS_FILENAME]
+    # Asset paths are relative to the pages of the maps
+    paths += [os.path.normpath(f"{map_name}/{a['filepath']}") for a in assets]
+    map_dir = f"{ASSETS_DIR}/{map_name}"
+    map_files = [CONFIG_FILENAME, SURFACE_GLB_FILENAME]
+    paths += [f"{map_dir}/{filename}" for filename in map_files]
+    # The viewer only reads placement.json when there are no instance batches
+    instances_path = f"{map_dir}/{INSTANCES_FILENAME}"
+    if os.path.isfile(instances_path):
+        paths.append(instances_path)
+        with open(instances_path, 'r') as f:
+            paths += [f"{map_dir}/{b['file']}" for b in json.load(f)]
+    else:
+        paths.append(f"{map_dir}/{PLACEMENT_FILENAME}")
+    return [path for path in paths if os.path.isfile(path)]
+
+
+def is_map(map_name):
+    """Whether a name from a url is the folder of a map, and not a path."""
+    return (
+        map_name not in ('', os.curdir, os.pardir) and
+        '/' not in map_name and '\\' not in map_name and
+        os.path.isdir(f"{ASSETS_DIR}/{map_name}")
+    )
+
+
+def get_cache_control(path):
+    """
+    Get the Cache-Control header of a file.
+    Args:
+        path(str): Path of the file relative to the root of the project
+    Returns:
+        str: REVALIDATE_CACHE_CONTROL for the files of maps and the ones with
+            a REVALIDATE_EXTENSIONS extension, LONG_CACHE_CONTROL otherwise
+    """
+    parts = os.path.normpath(path).split(os.sep)
+    is_map_file = len(parts) > 2 and parts[0] == ASSETS_DIR
+    if is_map_file or os.path.splitext(path)[1] in REVALIDATE_EXTENSIONS:
+        return REVALIDATE_CACHE_CONTROL
+    return LONG_CACHE_CONTROL
+
+
+def get_bundle_key(paths):
+    """
+    Identify the version of the files of a bundle, which changes whenever one
+    of them is rebuilt.
+    Args:
+        paths(list): Paths of the files
+    Returns:
+        tuple: (path, size, mtime_ns) of every file
+    """
+    key = []
+    for path in paths:
+        stat = os.stat(path)
+        key.append((path, stat.st_size, stat.st_mtime_ns))
+    return tuple(key)
+
+
+def create_bundle(paths):
+    """
+    Pack files in a single payload: the length of a JSON index as a uint32,
+    the index with the offset and length of every file and then the files.
+    Args:
+        paths(list): Paths of the files
+    Returns:
+        bytes: The bundle
+    """
+    files = []
+    contents = []
+    offset = 0
+    for path in paths:
+        with open(path, 'rb') as f:
+            content = f.read()
+        files.append({"path": path, "offset": offset, "length": len(content)})
+        contents.append(content)
+        offset += len(content)
+    index = json.dumps({"files": files}).encode()
+    return b''.join([struct.pack('<I', len(index)), index] + contents)
+
+
+class MapRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Static file handler that adds ETags, Cache-Control, precompressed
+    payloads, byte ranges and a /bundle/<map> endpoint. When maps are
+    watched, /events/<map> streams the outputs that change after every
+    rebuild as server-sent events.
+    """
+    is_watching = False
+    watchers = {}
+    watchers_lock = threading.Lock()
+    # Last bundle of every map, with its key, ETag and payload per encoding
+    bundles = {}
+    bundles_lock = threading.Lock()
+
+    def do_GET(self):
+        self.serve(send_body=True)
+
+    def do_HEAD(self):
+        self.serve(send_body=False)
+
+    def serve(self, send_body):
+        path = self.path.split('?', 1)[0]
+        if path.startswith(BUNDLE_PREFIX):
+            self.serve_bundle(path[len(BUNDLE_PREFIX):].strip('/'), send_body)
+            return
+        if path.startswith(EVENTS_PREFIX) and self.is_watching:
+            self.serve_events(path[len(EVENTS_PREFIX):].strip('/'))
+            return
+        file_path = self.translate_path(path)
+        if not os.path.isfile(file_path):
+            # Directories and missing files are handled by the base class
+            if send_body:
+                super().do_GET()
+            else:
+                super().do_HEAD()
+            return
+        self.serve_file(file_path, send_body)
+
+    def get_encoding(self, file_path):
+        """Choose the compressed file to send for this request, if any."""
+        extension = os.path.splitext(file_path)[1]
+        if (
+            extension not in COMPRESSIBLE_EXTENSIONS or
+            'Range' in self.headers
+        ):
+            return None, file_path
+        accepted = self.headers.get('Accept-Encoding', '')
+        for encoding, encoding_extension in ENCODINGS:
+            if encoding not in accepted:
+                continue
+            compressed_path = file_path + encoding_extension
+            is_stale = (
+                not os.path.isfile(compressed_path) or
+                os.path.getmtime(compressed_path) < os.path.getmtime(file_path)
+            )
+            if is_stale:
+                compressed_path = compress_file(file_path, encoding)
+            if compressed_path is not None:
+                return encoding, compressed_path
+        return None, file_path
+
+    def serve_file(self, file_path, send_body):
+        encoding, payload_path = self.get_encoding(file_path)
+        stat = os.stat(payload_path)
+        etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+        if encoding is not None:
+            etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}-{encoding}"'
+        cache_control = get_cache_control(
+            os.path.relpath(file_path, self.directory)
+        )
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', cache_control)
+            self.end_headers()
+            return
+        size = stat.st_size
+        start, end = 0, size - 1
+        status = HTTPStatus.OK
+        range_header = self.headers.get('Range')
+        if range_header is not None:
+            match = RANGE_REGEX.match(range_header.strip())
+            if match is None or match.groups() == ('', ''):
+                self.send_error(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                return
+            first, last = match.groups()
+            if first == '':
+                # Suffix range with the last bytes of the file
+                start = max(size - int(last), 0)
+            else:
+                start = int(first)
+                if last != '':
+                    end = min(int(last), size - 1)
+            if start >= size or start > end:
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.end_headers()
+                return
+            status = HTTPStatus.PARTIAL_CONTENT
+        self.send_response(status)
+        self.send_header('Content-Type', self.guess_type(file_path))
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('ETag', etag)
+        self.send_header(
+            'Last-Modified', formatdate(stat.st_mtime, usegmt=True)
+        )
+        self.send_header('Cache-Control', cache_control)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Vary', 'Accept-Encoding')
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+        if status == HTTPStatus.PARTIAL_CONTENT:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+        if send_body:
+            with open(payload_path, 'rb') as f:
+                f.seek(start)
+                self.wfile.write(f.read(end - start + 1))
+
+    def serve_bundle(self, map_name, send_body):
+        if not is_map(map_name):
+            self.send_error(HTTPStatus.NOT_FOUND, "Map not found")
+            return
+        accepts_gzip = 'gzip' in self.headers.get('Accept-Encoding', '')
+        encoding = 'gzip' if accepts_gzip else None
+        etag, bundle = self.get_bundle(map_name, encoding)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', REVALIDATE_CACHE_CONTROL)
+            self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            return
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(bundle)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', REVALIDATE_CACHE_CONTROL)
+        self.send_header('Vary', 'Accept-Encoding')
+        if accepts_gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        if send_body:
+            self.wfile.write(bundle)
+
+    def get_bundle(self, map_name, encoding):
+        """
+        Get the bundle of a map, which is only created again when one of its
+        files changes.
+        Args:
+            map_name(str): Name of the map
+            encoding(str): "gzip" or None for the uncompressed bundle
+        Returns:
+            tuple: ETag and payload of the bundle
+        """
+        paths = get_bundle_paths(map_name)
+        key = get_bundle_key(paths)
+        with self.bundles_lock:
+            cached = self.bundles.get(map_name)
+        if cached is None or cached["key"] != key:
+            digest = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+            cached = {
+                "key": key, "etag": digest, None: create_bundle(paths)
+            }
+        if encoding not in cached:
+            cached[encoding] = gzip.compress(cached[None], GZIP_LEVEL, mtime=0)
+        # Requests that build the same bundle at once store equal ones
+        with self.bundles_lock:
+            self.bundles[map_name] = cached
+        etag = cached["etag"]
+        if encoding is not None:
+            etag = f"{etag}-{encoding}"
+        return f'"{etag}"', cached[encoding]
+
+    def get_watcher(self, map_name):
+        """Get the watcher of a map, starting it the first time."""
+        with self.watchers_lock:
+            if map_name not in self.watchers:
+                watcher = watch.MapWatcher(map_name)
+                watcher.start()
+                self.watchers[map_name] = watcher
+            return self.watchers[map_name]
+
+    def serve_events(self, map_name):
+        if not is_map(map_name):
+            self.send_error(HTTPStatus.NOT_FOUND, "Map not found")
+            return
+        subscriber = self.get_watcher(map_name).subscribe()
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        try:
+            while True:
+                try:
+                    message = subscriber.get(timeout=KEEP_ALIVE_INTERVAL)
+                    event = f"data: {json.dumps(message)}\n\n"
+                    self.wfile.write(event.encode())
+                except queue.Empty:
+                    self.wfile.write(b": keep-alive\n\n")
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.watchers[map_name].unsubscribe(subscriber)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve the Web App and the generated maps"
+    )
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument(
+        '--precompress', action='store_true',
+        help="compress the files of every map before serving"
+    )
+    parser.add_argument(
+        '--watch', action='store_true',
+        help="rebuild the maps that are open when their files change"
+    )
+    args = parser.parse_args()
+    MapRequestHandler.is_watching = args.watch
+    if args.precompress:
+        precompress_dir(ASSETS_DIR)
+        precompress_dir("js")
+    server = ThreadingHTTPServer(('', args.port), MapRequestHandler)
+    print(f"Serving in http://localhost:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -8,18 +8,43 @@ uniform WindowBlock
 } window;
 
 uniform float uv_scale;
-in vec3 position;
-in vec2 tex_coords;
-in vec3 normal;
+// Height texture mode, a flat grid is displaced with the height map
+uniform bool use_height_map;
+uniform sampler2D height_map;
+uniform vec2 cell_size;
+// Fixed locations so every draw mode program can share the vertex list
+layout(location = 0) in vec3 position;
+layout(location = 1) in vec2 tex_coords;
+layout(location = 2) in vec3 normal;
 
 out vec3 v_vert;
 out vec2 uv;
 out vec3 n;
 
+float get_height(ivec2 texel)
+{
+    ivec2 size = textureSize(height_map, 0);
+    return texelFetch(height_map, clamp(texel, ivec2(0), size - 1), 0).r;
+}
+
 void main()
 {
-    uv = tex_coords * uv_scale;
-    v_vert = position;
+    vec3 displaced = position;
     n = normal;
-    gl_Position = window.projection * window.view * vec4(position, 1.0);
-}
\ No newline at end of file
+    if (use_height_map) {
+        ivec2 size = textureSize(height_map, 0);
+        ivec2 texel = ivec2(round(tex_coords * vec2(size - 1)));
+        displaced.y = get_height(texel);
+        // Central differences, z decreases when the row of the texel grows
+        float dh_dx = (
+            get_height(texel + ivec2(1, 0)) - get_height(texel - ivec2(1, 0))
+        ) / (2.0 * cell_size.x);
+        float dh_dz = -(
+            get_height(texel + ivec2(0, 1)) - get_height(texel - ivec2(0, 1))
+        ) / (2.0 * cell_size.y);
+        n = normalize(vec3(-dh_dx, 1.0, -dh_dz));
+    }
+    uv = tex_coords * uv_scale;
+    v_vert = displaced;
+    gl_Position = window.projection * window.view * vec4(displaced, 1.0);
+}
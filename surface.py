@@ -3,8 +3,10 @@ from PIL import Image
 
 
 from constants import *
+import normals
+import occlusion
 import utils
-from utils import ProgressBar
+from view_utils import ProgressBar
 
 
 def create_surface_tex(app, is_2d=True):
@@ -27,14 +29,18 @@ def create_surface_tex(app, is_2d=True):
     if noise_img.width != texture_size:
         noise_img.resize([texture_size, texture_size])
     noise_arr = np.array(noise_img) / MAX_COLOR     # Note: this is from 0 to 1
-    height_arr = np.array(app.height_map)
+    height_arr = np.asarray(app.height_map)
     surface_tex = np.zeros(
         [texture_size, texture_size, COLOR_CHANNELS], dtype=np.uint8
     )
-    normal_map = np.array(app.normal_map, dtype=np.uint8)
-    water_normals_img = Image.open(f"{ASSETS_DIR}/waternormals.jpg")
-    water_normals = np.array(water_normals_img, dtype=np.uint8)
-    road_arr = np.array(app.road_map)
+    # The water pattern is only in the normals of the 2D texture
+    normal_map = np.asarray(app.normal_map, dtype=np.uint8)
+    if is_2d:
+        normal_map = normals.add_water(
+            normal_map, height_arr, normals.load_water_normals(),
+            app.config['maxHeight'], app.config['waterHeight']
+        )
+    road_arr = np.asarray(app.road_map)
     for j in range(texture_size):
         for i in range(texture_size):
             u = i / texture_size
@@ -44,7 +50,6 @@ def create_surface_tex(app, is_2d=True):
             if height <= app.config['waterHeight']:
                 # Case water
                 if is_2d:
-                    normal_map[i, j] = utils.blerp(u, v, water_normals)
                     color = np.array(app.config['waterColor'])
                 else:
                     sand_color = np.array(app.config['sandColor'])
@@ -66,4 +71,12 @@ def create_surface_tex(app, is_2d=True):
             surface_tex[i, j] = color.astype(np.uint8)
         bar.next()
     bar.finish()
+    strength = app.config.get('occlusionStrength', occlusion.DEFAULT_STRENGTH)
+    if strength > 0:
+        occlusion_map = occlusion.bake_occlusion_map(
+            height_arr, **occlusion.get_settings(app.config)
+        )
+        surface_tex = occlusion.apply_occlusion(
+            surface_tex, occlusion_map, strength
+        )
     return surface_tex, normal_map
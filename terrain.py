@@ -1,120 +1,289 @@
+import ctypes
+
+import numpy as np
 import pyglet
 from pyglet.gl import *
 from pyglet.graphics.shader import Shader, ShaderProgram
-from pyglet.graphics import ShaderGroup
-from pyglet.math import Vec2, Vec3
+
+# Local modules
+import normals
+import rtin
 
 
 DRAW_MODE_SURFACE = "surface"
 DRAW_MODE_NORMALS = "normals"
 DRAW_MODE_WIREFRAME = "wireframe"
+# Shaders
+SHADERS_DIR = "shaders"
+VERTEX_SHADER_FILENAME = "vertex_shader.glsl"
+FRAGMENT_SHADERS = {
+    DRAW_MODE_SURFACE: "fragment_shader.glsl",
+    DRAW_MODE_NORMALS: "normals.glsl",
+    DRAW_MODE_WIREFRAME: "wireframe.glsl"
+}
+# Texture unit used for the height map in height texture mode
+HEIGHT_MAP_TEXTURE_UNIT = 1
+# Compiled shaders and programs are shared by every terrain in the process
+shaders_cache = {}
+programs_cache = {}
+# Flat grids for height texture mode by (width, height, size)
+grids_cache = {}
+
+
+def get_shader(filename, shader_type):
+    if filename not in shaders_cache:
+        with open(f'{SHADERS_DIR}/{filename}', mode='r') as f:
+            shader_str = f.read()
+        shaders_cache[filename] = Shader(shader_str, shader_type)
+    return shaders_cache[filename]
+
+
+def get_program(draw_mode):
+    """
+    Get the shader program for a draw mode, compiling it only the first time
+    it is requested.
+    Args:
+        draw_mode(str): One of the DRAW_MODE constants
+    Returns:
+        ShaderProgram: The program that draws the terrain in that mode
+    """
+    if draw_mode not in programs_cache:
+        vert_shader = get_shader(VERTEX_SHADER_FILENAME, 'vertex')
+        frag_shader = get_shader(FRAGMENT_SHADERS[draw_mode], 'fragment')
+        programs_cache[draw_mode] = ShaderProgram(vert_shader, frag_shader)
+    return programs_cache[draw_mode]
+
+
+def create_grid_indices(w, h):
+    """
+    Create the indices of a triangle strip that covers a grid of vertices row
+    by row, with empty triangles to jump from one row to the next.
+    Args:
+        w(int): Number of vertices in a row
+        h(int): Number of rows
+    Returns:
+        ndarray: Indices of the strip
+    """
+    rows = np.arange(h - 1)[:, np.newaxis]
+    cols = np.arange(w)[np.newaxis, :]
+    # Interleave the bottom and top vertex of each column
+    strips = np.stack([rows * w + cols, (rows + 1) * w + cols], axis=2)
+    strips = strips.reshape(h - 1, 2 * w)
+    # Add last idx and next one to make an empty triangle
+    last_idx = (rows + 2) * w - 1
+    jumps = np.concatenate([last_idx, last_idx + 1, last_idx + 1], axis=1)
+    # Last row is repeated and closed with its last vertex
+    last_row = np.concatenate([strips[-1], np.full(3, h * w - 1)])
+    indices = np.concatenate([
+        np.concatenate([strips, jumps], axis=1).ravel(), last_row
+    ])
+    return indices
+
+
+def get_grid(w, h, size):
+    """
+    Get a flat grid with the same layout as the terrain vertices so that it
+    can be displaced in the vertex shader. Grids are shared between terrains.
+    Args:
+        w(int): Number of vertices in a row
+        h(int): Number of rows
+        size(float): Length of a side of the terrain
+    Returns:
+        tuple: Positions, texture coordinates and indices of the grid
+    """
+    key = (w, h, size)
+    if key not in grids_cache:
+        j, i = np.mgrid[0:h, 0:w]
+        positions = np.stack([
+            -size / 2 + (i / w) * size,
+            np.zeros([h, w]),
+            -(j / h) * size
+        ], axis=2)
+        tex_coords = np.stack([i / (w - 1), j / (h - 1)], axis=2)
+        grids_cache[key] = (
+            positions.ravel().tolist(),
+            tex_coords.ravel().tolist(),
+            create_grid_indices(w, h).tolist()
+        )
+    return grids_cache[key]
+
+
+def upload_height_map(texture, height_map):
+    """
+    Copy heights into a single channel float texture, the first row of the
+    texture is the last row of the height map.
+    Args:
+        texture(Texture): Texture created by create_height_texture
+        height_map(ndarray): Height in world units for each pixel
+    """
+    h, w = height_map.shape
+    data = np.ascontiguousarray(height_map[::-1], dtype=np.float32)
+    glBindTexture(texture.target, texture.id)
+    glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+    glTexSubImage2D(
+        texture.target, 0, 0, 0, w, h, GL_RED, GL_FLOAT,
+        data.ctypes.data_as(ctypes.POINTER(GLfloat))
+    )
+
+
+def create_height_texture(height_map):
+    h, w = height_map.shape
+    tex_id = GLuint()
+    glGenTextures(1, byref(tex_id))
+    glBindTexture(GL_TEXTURE_2D, tex_id.value)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+    glTexImage2D(
+        GL_TEXTURE_2D, 0, GL_R32F, w, h, 0, GL_RED, GL_FLOAT, None
+    )
+    texture = pyglet.image.Texture(w, h, GL_TEXTURE_2D, tex_id.value)
+    upload_height_map(texture, height_map)
+    return texture
 
 
 class RenderGroup(pyglet.graphics.Group):
-    def __init__(self, texture0, program):
+    def __init__(self, texture0, program, height_texture=None, cell_size=None):
         super().__init__()
         self.texture0 = texture0
         self.program = program
+        self.height_texture = height_texture
+        self.cell_size = cell_size
 
     def set_state(self):
         glActiveTexture(GL_TEXTURE0)
         glBindTexture(self.texture0.target, self.texture0.id)
         glEnable(GL_DEPTH_TEST)
         self.program.use()
+        # Uniforms of the vertex shader, shared by every draw mode program
+        if self.height_texture is not None:
+            glActiveTexture(GL_TEXTURE0 + HEIGHT_MAP_TEXTURE_UNIT)
+            glBindTexture(self.height_texture.target, self.height_texture.id)
+            glActiveTexture(GL_TEXTURE0)
+            self.program['height_map'] = HEIGHT_MAP_TEXTURE_UNIT
+            self.program['cell_size'] = self.cell_size
+        self.program['use_height_map'] = int(self.height_texture is not None)
 
     def unset_state(self):
         self.program.stop()
 
 
-class Vertex:
-    def __init__(self, position=Vec3(), normal=Vec3(), uv=Vec2()):
-        self.position = position
-        self.normal = normal
-        self.uv = uv
-
-
 class Terrain:
     def __init__(
-        self, size, max_height, height_map, diffuse_map, batch=None
+        self, size, max_height, height_map, diffuse_map, batch=None,
+        use_height_texture=False, max_error=None
     ):
         """
         Object for a 3D terrain.
+        Args:
+            size(float): Length of a side of the terrain
+            max_height(float): Maximum height of the terrain
+            height_map(ndarray): Height in world units for each pixel
+            diffuse_map(Texture): Texture for the surface
+            batch(Batch): Batch where the terrain is drawn
+            use_height_texture(bool): Upload the heights as a texture and
+                displace a flat grid in the vertex shader instead of building
+                the mesh in the CPU
+            max_error(float): If given, build an adaptive mesh (RTIN) whose
+                heights differ at most this value from the height map
         """
         if not batch:
-            self.batch = pyglet.graphics.Batch()
-        self._draw_mode = DRAW_MODE_NORMALS
+            batch = pyglet.graphics.Batch()
+        self.batch = batch
+        self._draw_mode = DRAW_MODE_SURFACE
         self.size = size
         self.max_height = max_height
-        self.height_map = height_map
-
-        # Create height map
-        self.h, self.w = self.height_map.shape
-
-        # Initialize vertices and indices
-        self.vertices = []
-        self.positions, self.tex_coords = self.init_vertices()
-        self.indices = self.init_indices()
-        self.normals = self.calculate_normals()
+        self.diffuse_map = diffuse_map
+        self.use_height_texture = use_height_texture
+        self.max_error = max_error
+        self.height_texture = None
         self._is_in_debug_mode = False
 
-        # Read terrain shader program
-        with open('shaders/vertex_shader.glsl', mode='r') as f:
-            vs_str = f.read()
-        vert_shader = Shader(vs_str, 'vertex')
-
-        with open('shaders/fragment_shader.glsl', mode='r') as f:
-            fs_str = f.read()
-        frag_shader = Shader(fs_str, 'fragment')
-
-        with open('shaders/normals.glsl', mode='r') as f:
-            normals_fs_str = f.read()
-        normals_frag_shader = Shader(normals_fs_str, 'fragment')
-
-        with open('shaders/wireframe.glsl', mode='r') as f:
-            wireframe_fs_str = f.read()
-        wireframe_frag_shader = Shader(wireframe_fs_str, 'fragment')
-
-        program = ShaderProgram(vert_shader, frag_shader)
+        # Read terrain shader program, debug programs are compiled the first
+        # time their draw mode is used
+        program = get_program(DRAW_MODE_SURFACE)
         program['light_pos'] = (0.0, 200.0, -150.0)
         program['uv_scale'] = 1
+        self.render_group = None
+        self.vertex_list = None
+        self.set_height_map(height_map)
+        self.polygon_mode = GL_FILL
 
-        # Set render group
-        self.render_group = RenderGroup(diffuse_map, program)
-        self.vertex_list = program.vertex_list_indexed(
-            len(self.vertices), GL_TRIANGLE_STRIP, self.indices,
-            batch=batch, group=self.render_group,
-            position=('f', self.positions),
-            tex_coords=('f', self.tex_coords),
-            normal=('f', self.normals)
+    def set_height_map(self, height_map):
+        """
+        Set the heights of the terrain. In height texture mode a height map of
+        the same shape only updates the texture, and one of another shape
+        replaces it.
+        Args:
+            height_map(ndarray): Height in world units for each pixel
+        """
+        same_shape = (
+            self.vertex_list is not None and
+            height_map.shape == self.height_map.shape
         )
-
-        # Draw normals
-        draw_normals_program = ShaderProgram(vert_shader, normals_frag_shader)
-        self.normals_group = ShaderGroup(draw_normals_program)
-        self.normals_vli = draw_normals_program.vertex_list_indexed(
-            len(self.vertices), GL_TRIANGLE_STRIP, self.indices,
-            batch=batch, group=self.normals_group,
-            position=('f', self.positions),
-            normal=('f', self.normals)
+        self.height_map = height_map
+        self.h, self.w = self.height_map.shape
+        if self.use_height_texture and same_shape:
+            upload_height_map(self.height_texture, height_map)
+            return
+        if self.vertex_list is not None:
+            self.vertex_list.delete()
+        self.gl_mode = GL_TRIANGLE_STRIP
+        if self.use_height_texture:
+            # Reuse a flat grid and displace it in the vertex shader
+            self.positions, self.tex_coords, self.indices = get_grid(
+                self.w, self.h, self.size
+            )
+            self.normals = None
+            # The texture of another shape can't be reused, free its memory
+            if self.height_texture is not None:
+                self.height_texture.delete()
+            self.height_texture = create_height_texture(height_map)
+        elif self.max_error is not None:
+            self.gl_mode = GL_TRIANGLES
+            self.init_adaptive_mesh()
+        else:
+            # Initialize vertices and indices
+            self.positions, self.tex_coords = self.init_vertices()
+            self.indices = self.init_indices()
+            self.normals = self.calculate_normals()
+
+        # Set render group, every draw mode uses the same vertex list and
+        # only swaps the program of the group
+        program = get_program(self._draw_mode)
+        cell_size = (self.size / self.w, self.size / self.h)
+        self.render_group = RenderGroup(
+            self.diffuse_map, program, self.height_texture, cell_size
         )
-        self.normals_group.visible = False
-
-        # Draw wireframe
-        wireframe_program = ShaderProgram(vert_shader, wireframe_frag_shader)
-        self.wireframe_group = ShaderGroup(wireframe_program)
-        self.wireframe_vli = wireframe_program.vertex_list_indexed(
-            len(self.vertices), GL_TRIANGLE_STRIP, self.indices,
-            batch=batch, group=self.wireframe_group,
-            position=('f', self.positions)
+        attributes = {
+            'position': ('f', self.positions),
+            'tex_coords': ('f', self.tex_coords)
+        }
+        if self.normals is not None:
+            attributes['normal'] = ('f', self.normals)
+        self.vertex_list = program.vertex_list_indexed(
+            len(self.positions) // 3, self.gl_mode, self.indices,
+            batch=self.batch, group=self.render_group, **attributes
         )
-        self.wireframe_group.visible = False
 
-        self.draw_groups = (
-            (DRAW_MODE_SURFACE, self.render_group),
-            (DRAW_MODE_NORMALS, self.normals_group),
-            (DRAW_MODE_WIREFRAME, self.wireframe_group)
-        )
-        self.polygon_mode = GL_FILL
+    def set_diffuse_map(self, diffuse_map):
+        """
+        Set the texture for the surface.
+        Args:
+            diffuse_map(Texture): Texture for the surface
+        """
+        self.diffuse_map = diffuse_map
+        self.render_group.texture0 = diffuse_map
+
+    @property
+    def vertex_count(self):
+        return len(self.positions) // 3
+
+    @property
+    def triangle_count(self):
+        """int: Triangles drawn, counting the empty ones between strip rows"""
+        if self.gl_mode == GL_TRIANGLE_STRIP:
+            return max(len(self.indices) - 2, 0)
+        return len(self.indices) // 3
 
     @property
     def draw_mode(self):
@@ -127,11 +296,26 @@ class Terrain:
             self.polygon_mode = GL_LINE
         else:
             self.polygon_mode = GL_FILL
-        for draw_mode, draw_group in self.draw_groups:
-            if draw_mode == value:
-                draw_group.visible = True
-            else:
-                draw_group.visible = False
+        self.render_group.program = get_program(value)
+
+    def init_adaptive_mesh(self):
+        vertices, triangles = rtin.RTIN(self.height_map).get_mesh(
+            self.max_error
+        )
+        cols, rows, heights = vertices.T
+        # Rows of the height map go from top to bottom
+        j = self.h - 1 - rows
+        positions = np.stack([
+            -self.size / 2 + (cols / self.w) * self.size,
+            heights,
+            -(j / self.h) * self.size
+        ], axis=1)
+        tex_coords = np.stack([cols / (self.w - 1), j / (self.h - 1)], axis=1)
+        vertex_normals = rtin.calculate_normals(positions, triangles)
+        self.positions = positions.ravel().tolist()
+        self.tex_coords = tex_coords.ravel().tolist()
+        self.indices = triangles.ravel().tolist()
+        self.normals = vertex_normals.ravel().tolist()
 
     def init_vertices(self):
         positions = []
@@ -147,72 +331,14 @@ class Terrain:
                 s = i / (self.w - 1)
                 t = j / (self.h - 1)
                 tex_coords += [s, t]
-
-                self.vertices.append(
-                    Vertex(position=Vec3(x, y, z), uv=Vec2(s, t))
-                )
         return positions, tex_coords
 
     def init_indices(self):
-        indices = []
-        for j in range(self.h - 1):
-            for i in range(self.w):
-                bottom_idx = j * self.w + i
-                top_idx = (j + 1) * self.w + i
-                # Maybe this could be reversed
-                indices.append(bottom_idx)
-                indices.append(top_idx)
-            # Add last idx and next one to make an empty triangle
-            last_idx = (j + 2) * self.w - 1
-            next_idx = last_idx + 1
-            indices.append(last_idx)
-            indices.append(next_idx)
-            indices.append(next_idx)
-        # Do last row
-        for i in range(self.w):
-            bottom_idx = (self.h - 2) * self.w + i
-            top_idx = (self.h - 1) * self.w + i
-            indices.append(bottom_idx)
-            indices.append(top_idx)
-        last_idx = self.h * self.w - 1
-        for _ in range(3):
-            indices.append(last_idx)
-        return indices
+        return create_grid_indices(self.w, self.h).tolist()
 
     def calculate_normals(self):
-        # Go row by row
-        vertices_per_row = 2 * self.w + 3
-        for j in range(self.h):
-            for i in range(0, 2 * self.w - 1, 4):
-                offset = j * vertices_per_row
-                idx0 = self.indices[i + offset]
-                idx1 = self.indices[i + 1 + offset]
-                idx2 = self.indices[i + 2 + offset]
-                idx3 = self.indices[i + 3 + offset]
-
-                v0 = self.vertices[idx2].position - self.vertices[idx0].position
-                v1 = self.vertices[idx1].position - self.vertices[idx0].position
-                normal = v0.cross(v1)
-                normal = normal.normalize()
-
-                # Add normal contribution of each triangle normal a vertex
-                # belongs to
-                self.vertices[idx0].normal += normal
-                self.vertices[idx1].normal += normal
-                self.vertices[idx2].normal += normal
-
-                v0 = self.vertices[idx3].position - self.vertices[idx2].position
-                v1 = self.vertices[idx1].position - self.vertices[idx2].position
-                normal = v0.cross(v1)
-                normal = normal.normalize()
-
-                self.vertices[idx1].normal += normal
-                self.vertices[idx2].normal += normal
-                self.vertices[idx3].normal += normal
-
-        # Normalize every normal
-        normals = []
-        for v in self.vertices:
-            normal = v.normal.normalize()
-            normals += [normal.x, normal.y, normal.z]
-        return normals
+        # Vertex j of a column is on row h - 1 - j of the height map
+        normals_arr = normals.get_vertex_normals(
+            self.height_map, self.size / self.w
+        )
+        return normals_arr[::-1].ravel().tolist()
@@ -0,0 +1,82 @@
+"""
+Check that the Numba kernels give the same outputs as the pure Python ones.
+Run them with `$ python -m unittest test_kernels` (or `$ python -m pytest
+test_kernels.py`), the tests of the Numba backend are skipped when it isn't
+installed.
+"""
+import unittest
+
+import numpy as np
+
+# Local modules
+import kernels
+import roads
+
+SEED = 7
+SIZE = 64
+
+
+@unittest.skipUnless(kernels.HAS_NUMBA, "numba is not installed")
+class NumbaKernelsTest(unittest.TestCase):
+    def setUp(self):
+        self.inputs = kernels.get_test_inputs(
+            np.random.default_rng(SEED), SIZE
+        )
+        self.reference = kernels.get_kernels(kernels.PYTHON_BACKEND)
+        self.numba = kernels.get_kernels(kernels.NUMBA_BACKEND)
+
+    def check_kernel(self, name):
+        for arr in self.inputs[name]:
+            with self.subTest(dtype=arr.dtype):
+                expected = self.reference[name](arr)
+                output = self.numba[name](arr)
+                self.assertEqual(output.dtype, expected.dtype)
+                np.testing.assert_array_equal(output, expected)
+
+    def test_dithering(self):
+        self.check_kernel(kernels.FLOYD_STEINBERG)
+
+    def test_flood(self):
+        self.check_kernel(kernels.FLOOD)
+
+
+class OrientationMapTest(unittest.TestCase):
+    def get_reference(self, dist_map):
+        """Search the window of every pixel one offset at a time."""
+        h, w = dist_map.shape
+        half = roads.ORIENT_SAMPLE_SIZE // 2
+        window = range(-half, roads.ORIENT_SAMPLE_SIZE - half)
+        offsets = sorted(
+            [(b, a) for b in window for a in window],
+            key=lambda offset: offset[0] ** 2 + offset[1] ** 2
+        )
+        orientation_map = np.empty([h, w], dtype=np.float32)
+        for j in range(h):
+            for i in range(w):
+                min_dist = roads.MAX_COLOR + 1
+                dx, dy = 0, 0
+                for db, da in offsets:
+                    if 0 <= j + db < h and 0 <= i + da < w and \
+                            dist_map[j + db, i + da] < min_dist:
+                        min_dist = dist_map[j + db, i + da]
+                        dx, dy = da, -db
+                rotation = np.arccos(dx / max(np.hypot(dx, dy), 1))
+                orientation_map[j, i] = -rotation if dy < 0 else rotation
+        return orientation_map
+
+    def test_min_dist(self):
+        road_map = kernels.get_test_inputs(
+            np.random.default_rng(SEED), SIZE
+        )[kernels.FLOOD][0]
+        dist_map = roads.flood(road_map)
+        expected = self.get_reference(dist_map)
+        for memory_budget in [None, SIZE * roads.ORIENT_BYTES_PER_PIXEL * 5]:
+            with self.subTest(memory_budget=memory_budget):
+                np.testing.assert_array_equal(
+                    roads.create_orientation_map(dist_map, memory_budget),
+                    expected
+                )
+
+
+if __name__ == '__main__':
+    unittest.main()
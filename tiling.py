@@ -0,0 +1,279 @@
+import json
+import math
+import os
+import sys
+
+import numpy as np
+from PIL import Image
+
+# Local modules
+from constants import *
+from map_context import MapContext
+from rasterstore import ChunkedRaster
+import utils
+
+TILES_DIR = "tiles"
+TILES_FILENAME = "tiles.json"
+TILE_HEIGHT_FILENAME = "height.png"
+TILE_TEXTURE_FILENAME = "surface.png"
+TILE_PLACEMENT_FILENAME = "placement.json"
+# Pixels of the height map in a side of a leaf tile
+DEFAULT_TILE_SIZE = 64
+# Pixels in a side of the texture of every tile
+DEFAULT_TILE_TEXTURE_SIZE = 256
+# Pixels read around the region of a tile in a chunked texture, so that it's
+# resampled like the whole texture
+TEXTURE_WINDOW_MARGIN = 1
+
+
+def get_map_size(ctx):
+    return ctx.config.get(
+        'mapSize', ctx.height_map_shape[1] * ctx.height_map_pixel_size
+    )
+
+
+def get_tile_height_map(height_map, row, col, tile_size, step):
+    """
+    Sample the height patch of a tile with one extra row and column so that
+    neighbor tiles share their borders.
+    Args:
+        height_map(ndarray): Height map of the whole map, or its
+            ChunkedRaster
+        row(int): First row of the tile in the height map
+        col(int): First column of the tile in the height map
+        tile_size(int): Number of samples in a side of the tile, minus one
+        step(int): Pixels of the height map between two samples
+    Returns:
+        ndarray: Height patch of (tile_size + 1) x (tile_size + 1) samples
+    """
+    extent = tile_size * step
+    patch = height_map[row:row + extent + 1:step, col:col + extent + 1:step]
+    # Tiles in the border of the map repeat the last pixels
+    pad = [
+        (0, tile_size + 1 - patch.shape[0]),
+        (0, tile_size + 1 - patch.shape[1])
+    ]
+    return np.pad(patch, pad, mode='edge')
+
+
+def read_texture_window(surface_store, box):
+    """
+    Read the region of a chunked texture around a box.
+    Args:
+        surface_store(ChunkedRaster): Texture of the whole map
+        box(tuple): (left, top, right, bottom) of the region in pixels
+    Returns:
+        tuple: The region as an Image and the box inside it
+    """
+    h, w = surface_store.shape[:2]
+    left = max(int(box[0]) - TEXTURE_WINDOW_MARGIN, 0)
+    top = max(int(box[1]) - TEXTURE_WINDOW_MARGIN, 0)
+    right = min(math.ceil(box[2]) + TEXTURE_WINDOW_MARGIN, w)
+    bottom = min(math.ceil(box[3]) + TEXTURE_WINDOW_MARGIN, h)
+    window = Image.fromarray(surface_store.read((top, left, bottom, right)))
+    return window, (box[0] - left, box[1] - top, box[2] - left, box[3] - top)
+
+
+def get_tile_texture(
+        surface_img, top, left, tile_height, tile_width, texture_size
+):
+    """
+    Resample the region of the surface texture covered by a tile. The part of
+    border tiles that falls outside the map is left black.
+    Args:
+        surface_img(Image): Texture of the whole map, or its ChunkedRaster
+        top(float): First row of the tile as a fraction of the map height
+        left(float): First column of the tile as a fraction of the map width
+        tile_height(float): Height of the tile as a fraction of the map
+        tile_width(float): Width of the tile as a fraction of the map
+        texture_size(int): Pixels in a side of the texture of the tile
+    Returns:
+        Image: Texture of the tile
+    """
+    if isinstance(surface_img, ChunkedRaster):
+        img_h, img_w = surface_img.shape[:2]
+    else:
+        img_w, img_h = surface_img.size
+    right = min(left + tile_width, 1)
+    bottom = min(top + tile_height, 1)
+    box = (left * img_w, top * img_h, right * img_w, bottom * img_h)
+    size = (
+        max(round(texture_size * (right - left) / tile_width), 1),
+        max(round(texture_size * (bottom - top) / tile_height), 1)
+    )
+    if isinstance(surface_img, ChunkedRaster):
+        surface_img, box = read_texture_window(surface_img, box)
+    tile_texture = Image.new('RGB', (texture_size, texture_size))
+    tile_texture.paste(surface_img.resize(size, Image.BOX, box=box))
+    return tile_texture
+
+
+def split_placement(placement_json, map_size, tile_length, num_tiles):
+    """
+    Group the placements by the leaf tile they fall in.
+    Args:
+        placement_json(list): Placement dicts like the ones in placement.json
+        map_size(float): Length of a side of the map in world units
+        tile_length(float): Length of a side of a leaf tile in world units
+        num_tiles(int): Number of leaf tiles in a side of the quadtree
+    Returns:
+        dict: List of placements for each (x, y) leaf tile
+    """
+    placement_by_tile = {}
+    for placement in placement_json:
+        position = placement['position']
+        x = int((position['x'] + map_size / 2) // tile_length)
+        y = int((position['z'] + map_size / 2) // tile_length)
+        x = min(max(x, 0), num_tiles - 1)
+        y = min(max(y, 0), num_tiles - 1)
+        placement_by_tile.setdefault((x, y), []).append(placement)
+    return placement_by_tile
+
+
+def create_tiles(
+        ctx, tile_size=DEFAULT_TILE_SIZE,
+        texture_size=DEFAULT_TILE_TEXTURE_SIZE, region=None
+):
+    """
+    Cut a generated map into a quadtree of tiles so that viewers can stream
+    only the tiles near the camera. Level 0 is a single tile with the whole
+    map and each level below splits every tile in four, until leaf tiles have
+    tile_size pixels of the height map per side. Every tile has its height
+    patch and its texture at the same resolution, so the level of a tile is
+    its level of detail. Placements are stored in the leaf tiles.
+    Args:
+        ctx(MapContext): The map to cut, with surface.png and placement.json
+        tile_size(int): Pixels of the height map in a side of a leaf tile
+        texture_size(int): Pixels in a side of the texture of every tile
+        region(tuple): Box (top, left, bottom, right) in height map pixels
+            that changed since the last time, the tiles outside it keep their
+            files. All the tiles are written if None
+    Returns:
+        dict: The manifest of the tiles
+    """
+    # Chunked rasters are read one tile at a time
+    height_map = ctx.raster_store(HEIGHT_MAP_FILENAME)
+    if height_map is None:
+        height_map = ctx.height_map
+    h, w = height_map.shape[:2]
+    map_size = get_map_size(ctx)
+    depth = max(math.ceil(math.log2(max(h, w) / tile_size)), 0)
+    num_leaves = 2 ** depth
+    # The quadtree can cover more than the map, with the map in its corner
+    pixel_length = map_size / w
+    leaf_length = tile_size * pixel_length
+    # The files may still be in the queue of the writer
+    ctx.writer.wait(ctx.path(SURFACE_TEXTURE))
+    ctx.writer.wait(ctx.path(PLACEMENT_FILENAME))
+    surface_img = ctx.raster_store(SURFACE_TEXTURE)
+    if surface_img is None:
+        surface_img = Image.open(ctx.path(SURFACE_TEXTURE)).convert('RGB')
+    placement_by_tile = {}
+    if ctx.has_file(PLACEMENT_FILENAME):
+        placement_by_tile = split_placement(
+            ctx.load_json(PLACEMENT_FILENAME), map_size, leaf_length,
+            num_leaves
+        )
+    tiles_dir = ctx.path(TILES_DIR)
+    tiles = []
+    for level in range(depth + 1):
+        num_tiles = 2 ** level
+        # Height map pixels between two samples of a tile in this level
+        step = 2 ** (depth - level)
+        tile_pixels = tile_size * step
+        tile_length = tile_pixels * pixel_length
+        for y in range(num_tiles):
+            for x in range(num_tiles):
+                row = y * tile_pixels
+                col = x * tile_pixels
+                if row >= h or col >= w:
+                    continue
+                tile_dir = f"{TILES_DIR}/{level}/{x}/{y}"
+                tile_height_map = get_tile_height_map(
+                    height_map, row, col, tile_size, step
+                )
+                is_outdated = (
+                    region is None or
+                    not ctx.has_file(f"{tile_dir}/{TILE_TEXTURE_FILENAME}") or
+                    (
+                        region[0] <= row + tile_pixels and
+                        row < region[2] and
+                        region[1] <= col + tile_pixels and
+                        col < region[3]
+                    )
+                )
+                if is_outdated:
+                    os.makedirs(ctx.path(tile_dir), exist_ok=True)
+                    ctx.writer.save_image(
+                        tile_height_map,
+                        ctx.path(f"{tile_dir}/{TILE_HEIGHT_FILENAME}"),
+                        log=False
+                    )
+                    tile_texture = get_tile_texture(
+                        surface_img, row / h, col / w, tile_pixels / h,
+                        tile_pixels / w, texture_size
+                    )
+                    ctx.writer.save_image(
+                        tile_texture,
+                        ctx.path(f"{tile_dir}/{TILE_TEXTURE_FILENAME}"),
+                        log=False
+                    )
+                tile = {
+                    "level": level,
+                    "x": x,
+                    "y": y,
+                    "bounds": [
+                        -map_size / 2 + x * tile_length,
+                        -map_size / 2 + y * tile_length,
+                        -map_size / 2 + (x + 1) * tile_length,
+                        -map_size / 2 + (y + 1) * tile_length
+                    ],
+                    "minHeight": float(
+                        tile_height_map.min() / MAX_COLOR * ctx.max_height
+                    ),
+                    "maxHeight": float(
+                        tile_height_map.max() / MAX_COLOR * ctx.max_height
+                    ),
+                    "height": f"{tile_dir}/{TILE_HEIGHT_FILENAME}",
+                    "texture": f"{tile_dir}/{TILE_TEXTURE_FILENAME}"
+                }
+                if level == depth:
+                    tile_placement = placement_by_tile.get((x, y), [])
+                    tile["placement"] = f"{tile_dir}/{TILE_PLACEMENT_FILENAME}"
+                    tile["count"] = len(tile_placement)
+                    if is_outdated:
+                        ctx.writer.save_json(
+                            tile_placement, ctx.path(tile["placement"]),
+                            log=False, indent=None
+                        )
+                tiles.append(tile)
+    manifest = {
+        "mapSize": map_size,
+        "maxHeight": ctx.max_height,
+        "tileSize": tile_size,
+        "textureSize": texture_size,
+        "depth": depth,
+        "tiles": tiles
+    }
+    ctx.writer.save_json(manifest, f"{tiles_dir}/{TILES_FILENAME}", log=False)
+    print(f"Finished writing {len(tiles)} tiles in {tiles_dir}")
+    return manifest
+
+
+def main():
+    # Load map names
+    with open(MAPS_FILENAME, 'r') as f:
+        cities = json.load(f)
+    option = int(input(utils.menu_str(cities))) - 1
+    if option == EXIT_CODE:
+        sys.exit("You selected to exit the program")
+    ctx = MapContext(cities[option].lower())
+    create_tiles(
+        ctx,
+        ctx.config.get('tileSize', DEFAULT_TILE_SIZE),
+        ctx.config.get('tileTextureSize', DEFAULT_TILE_TEXTURE_SIZE)
+    )
+
+
+if __name__ == '__main__':
+    main()
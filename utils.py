@@ -1,6 +1,4 @@
 from PIL import Image
-from progress.bar import Bar
-from pyglet.math import Mat4
 import numpy as np
 import os
 import os.path
@@ -9,6 +7,16 @@ import time
 COLOR_CHANNELS = 3
 MAX_COLOR = 255
 COLOR_BLACK = np.zeros(3)
+# Helpers of the viewers, in view_utils so that building a map doesn't import
+# pyglet or progress
+VIEWER_NAMES = ('ProgressBar', 'OrthographicView')
+
+
+def __getattr__(name):
+    if name in VIEWER_NAMES:
+        import view_utils
+        return getattr(view_utils, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def open_image(img_filename):
@@ -91,16 +99,16 @@ def sample_2d(x, y, img_arr):
             i -= width
         if j >= height:
             j -= height
-        return img_arr[j][i]
+        return img_arr[j, i]
     # t and s are interpolation parameters that go from 0 to 1
     t = x - i + 0.5
     s = y - j + 0.5
     # Bilinear interpolation
     color = (
-        img_arr[j - 1][i - 1] * (1 - t) * (1 - s)
-        + img_arr[j - 1][i] * t * (1 - s)
-        + img_arr[j][i - 1] * (1 - t) * s
-        + img_arr[j][i] * t * s
+        img_arr[j - 1, i - 1] * (1 - t) * (1 - s)
+        + img_arr[j - 1, i] * t * (1 - s)
+        + img_arr[j, i - 1] * (1 - t) * s
+        + img_arr[j, i] * t * s
     )
     return color
 
@@ -206,25 +214,3 @@ class Point:
     def dict_to_arr(point_dict):
         arr = np.array([point_dict['x'], point_dict['y'], point_dict['z']])
         return arr
-
-
-class ProgressBar(Bar):
-    suffix = '%(percent)d%% [%(elapsed_td)s / %(eta_td)s]'
-    check_tty = False
-
-
-class OrthographicView:
-    def __init__(self, window):
-        self.window = window
-
-    def __enter__(self):
-        self.view = self.window.view
-        self.projection = self.window.projection
-        self.window.view = Mat4()
-        self.window.projection = Mat4.orthogonal_projection(
-            0, self.window.width, 0, self.window.height, -255, 255
-        )
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.window.view = self.view
-        self.window.projection = self.projection
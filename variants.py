@@ -0,0 +1,133 @@
+import argparse
+import functools
+import json
+import sys
+
+# Local modules
+import artifacts
+from artifacts import ArtifactWriter
+from constants import *
+import main
+from map_context import MapContext
+import pipeline
+from pipeline import PROCESS, Stage
+import utils
+
+# Placement of each seed, next to placement.json
+VARIANT_FILENAME = "placement.{seed}.json"
+DEFAULT_VARIANTS = 4
+
+
+def place_variant(
+        map_name, assets_dir, config, seed, occupancy, normalized_height_map,
+        orientation_map, road_graph, *placement_maps
+):
+    """
+    Place the assets of every ecotope with a seed. It runs in a worker
+    process, so it gets the rasters that the placement reads instead of
+    computing them again.
+    Args:
+        map_name(str): Name of the map
+        assets_dir(str): Directory that contains the map folder
+        config(dict): Config of the map
+        seed(int): Seed of the variant
+        occupancy(OccupancyGrid): Grid with the landmarks, a copy of it is
+            filled
+        normalized_height_map(ndarray): Height map in [0, 1]
+        orientation_map(ndarray): Orientation map, None if there are no roads
+        road_graph(RoadGraph): Graph of the roads if the config uses it
+        placement_maps(list): Placement map of each ecotope, in order
+    Returns:
+        list: Placement dicts of all the ecotopes
+    """
+    ctx = MapContext(map_name, assets_dir=assets_dir, config=config, seed=seed)
+    ctx.normalized_height_map = normalized_height_map
+    ctx.orientation_map = orientation_map
+    ctx.road_graph = road_graph
+    placement_json = []
+    for ecotope, placement_map in zip(ctx.ecotopes, placement_maps):
+        placement_json += main.procedurally_place(
+            placement_map, ecotope, ctx, occupancy=occupancy
+        )
+    return placement_json
+
+
+def create_variants_pipeline(ctx, seeds):
+    """
+    Build the stages that don't depend on the seed once, like the distance
+    map, the density maps and their dithering, and then place the assets
+    with every seed at the same time. The placement of a seed is the same as
+    the one of a full build with that seed.
+    Args:
+        ctx(MapContext): The map
+        seeds(list): Seeds of the variants
+    Returns:
+        Pipeline: The pipeline
+    """
+    build = pipeline.Pipeline()
+    placement_maps = main.add_placement_map_stages(build, ctx)
+    for seed in seeds:
+        def save_variant(landmarks, placement_json, variant_seed=seed):
+            ctx.writer.save_json(
+                placement_json + landmarks,
+                ctx.path(VARIANT_FILENAME.format(seed=variant_seed))
+            )
+
+        # Each process gets its own copy of the occupancy grid
+        build.add(
+            Stage(
+                f"placements_{seed}",
+                functools.partial(
+                    place_variant, ctx.map_name, ctx.assets_dir, ctx.config,
+                    seed
+                ),
+                ["occupancy", "normalized_height_map", "orientation_map",
+                 "road_graph"] + placement_maps, PROCESS
+            )
+        )
+        build.add(
+            Stage(f"save_placement_{seed}", save_variant,
+                  ["landmarks", f"placements_{seed}"])
+        )
+    return build
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description="Write a placement.<seed>.json for several seeds of a "
+                    "map, computing the stages that don't use the seed only "
+                    "once"
+    )
+    parser.add_argument(
+        "seeds", nargs="*", type=int,
+        help="Seeds of the variants, the first ones from --start if empty"
+    )
+    parser.add_argument("--count", type=int, default=DEFAULT_VARIANTS)
+    parser.add_argument("--start", type=int, default=0)
+    args = parser.parse_args()
+    seeds = args.seeds or list(range(args.start, args.start + args.count))
+    # Load map names
+    with open(MAPS_FILENAME, 'r') as f:
+        cities = json.load(f)
+    option = int(input(utils.menu_str(cities))) - 1
+    if option == EXIT_CODE:
+        sys.exit("You selected to exit the program")
+    timer = utils.Timer()
+    timer.start()
+    ctx = MapContext(cities[option].lower())
+    ctx.writer = ArtifactWriter(
+        compress_level=ctx.config.get(
+            'pngCompressLevel', artifacts.DEFAULT_COMPRESS_LEVEL
+        ),
+        debug=ctx.config.get('debugArtifacts', True)
+    )
+    with ctx.writer:
+        build = create_variants_pipeline(ctx, seeds)
+        build.run()
+    timer.stop()
+    build.report()
+    print(f"Wrote {len(seeds)} variants, elapsed time was {timer}")
+
+
+if __name__ == '__main__':
+    run()
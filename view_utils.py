@@ -0,0 +1,24 @@
+from progress.bar import Bar
+from pyglet.math import Mat4
+
+
+class ProgressBar(Bar):
+    suffix = '%(percent)d%% [%(elapsed_td)s / %(eta_td)s]'
+    check_tty = False
+
+
+class OrthographicView:
+    def __init__(self, window):
+        self.window = window
+
+    def __enter__(self):
+        self.view = self.window.view
+        self.projection = self.window.projection
+        self.window.view = Mat4()
+        self.window.projection = Mat4.orthogonal_projection(
+            0, self.window.width, 0, self.window.height, -255, 255
+        )
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.window.view = self.view
+        self.window.projection = self.projection
@@ -1,6 +1,7 @@
+import argparse
+from contextlib import nullcontext
 import json
 import numpy as np
-from PIL import Image
 import pyglet
 from pyglet.gl import *
 from pyglet.window import key
@@ -10,19 +11,40 @@ import sys
 
 from camera import FPSCamera
 from constants import *
+from map_context import MapContext
+from profiler import DRAW_PHASE, OVERLAY_PHASE, CameraPath, FrameProfiler
 from terrain import Terrain
 import terrain
 import utils
+import view_utils
 
 
 batch = pyglet.graphics.Batch()
 draw_modes_map = {
     key.M: terrain.DRAW_MODE_WIREFRAME, key.N: terrain.DRAW_MODE_NORMALS
 }
+# Seconds between checks for a new height map
+RELOAD_INTERVAL = 0.5
 
 
 class Window(pyglet.window.Window):
-    def __init__(self, debug_mode=False):
+    def __init__(
+            self, debug_mode=False, use_height_texture=True, profile=False,
+            camera_path=None, csv_path=None
+    ):
+        """
+        Window that shows the terrain of a map.
+        Args:
+            debug_mode(bool): Whether to show the frame rate, or the profiler
+                overlay if profile is True
+            use_height_texture(bool): Displace a flat grid in the vertex
+                shader when the map has no adaptive mesh
+            profile(bool): Whether to measure every frame
+            camera_path(CameraPath): If given, the camera follows it and the
+                window closes when it ends
+            csv_path(str): File where the measured frames are written when
+                the window closes
+        """
         super().__init__(caption="Pictorial Map", vsync=False)
         # Load map names
         with open(MAPS_FILENAME, 'r') as f:
@@ -36,27 +58,73 @@ class Window(pyglet.window.Window):
         timer = utils.Timer()
         timer.start()
         # Load map config
-        config_path = f"assets/{chosen_option}/{CONFIG_FILENAME}"
-        with open(config_path, 'r') as f:
-            config = json.load(f)
+        self.ctx = MapContext(chosen_option)
+        config = self.ctx.config
         # Load height map
-        height_map_img = Image.open(
-            f'assets/{chosen_option}/{HEIGHT_MAP_FILENAME}'
-        ).convert('L')
-        height_map = np.asarray(height_map_img) / 255 * config['maxHeight']
-        # Load diffuse map
-        diffuse_map = pyglet.resource.texture(
-            f'assets/{chosen_option}/{SURFACE_TEXTURE}'
+        height_map = (
+            np.asarray(self.ctx.normalized_height_map) * config['maxHeight']
         )
-        # Create terrain
+        # Load diffuse map
+        diffuse_map = pyglet.resource.texture(self.ctx.path(SURFACE_TEXTURE))
+        # Create terrain, an adaptive mesh is used when the map defines its
+        # maximum error
+        max_error = config.get('meshMaxError')
         self.terrain = Terrain(
             config['mapSize'], config['maxHeight'], height_map,
-            diffuse_map, batch=batch
+            diffuse_map, batch=batch,
+            use_height_texture=use_height_texture and max_error is None,
+            max_error=max_error
         )
         timer.stop()
         print(f"Elapsed time generating terrain was {timer}")
         self.mode = DEBUG_MODE if debug_mode else NORMAL_MODE
-        self.orthographic_view = utils.OrthographicView(self)
+        self.orthographic_view = view_utils.OrthographicView(self)
+        # Hot reload the files of the map when they change in disk, for
+        # example when watch.py rebuilds it
+        self.reloaders = {
+            HEIGHT_MAP_FILENAME: self.reload_height_map,
+            SURFACE_TEXTURE: self.reload_surface_texture
+        }
+        self.mtimes = {
+            filename: self.ctx.get_mtime(filename)
+            for filename in self.reloaders
+        }
+        pyglet.clock.schedule_interval(self.reload_files, RELOAD_INTERVAL)
+        self.camera_path = camera_path
+        self.csv_path = csv_path
+        self.profiler = None
+        if profile or camera_path is not None:
+            self.profiler = FrameProfiler(
+                self, self.terrain, record=csv_path is not None
+            )
+        self.camera = None
+
+    def reload_files(self, dt):
+        for filename, reload_file in self.reloaders.items():
+            mtime = self.ctx.get_mtime(filename)
+            if mtime == self.mtimes[filename]:
+                continue
+            self.mtimes[filename] = mtime
+            timer = utils.Timer()
+            timer.start()
+            reload_file()
+            timer.stop()
+            print(
+                f"Reloaded {self.ctx.path(filename)} in "
+                f"{timer.elapsed_time:.3f}s"
+            )
+
+    def reload_height_map(self):
+        self.ctx.invalidate('height_map', 'normalized_height_map')
+        height_map = (
+            np.asarray(self.ctx.normalized_height_map) * self.ctx.max_height
+        )
+        self.terrain.set_height_map(height_map)
+
+    def reload_surface_texture(self):
+        # pyglet.resource caches textures by name, so load the file again
+        image = pyglet.image.load(self.ctx.path(SURFACE_TEXTURE))
+        self.terrain.set_diffuse_map(image.get_texture())
 
     def on_key_press(self, symbol, modifiers):
         if symbol in draw_modes_map:
@@ -68,24 +136,89 @@ class Window(pyglet.window.Window):
         super().on_key_press(symbol, modifiers)
 
     def on_draw(self, **kwargs):
-        glClearColor(135 / 255.0, 206 / 255.0, 235 / 255.0, 1.0)
-        self.clear()
-        glPolygonMode(GL_FRONT_AND_BACK, self.terrain.polygon_mode)
-        batch.draw()
-        if self.mode == DEBUG_MODE:
+        if self.profiler is None:
+            self.draw_frame()
+            return
+        # The pose of the path is set before the frame starts, so that the
+        # profile records it. The camera only updates the view in on_refresh,
+        # after the frame is drawn, so the view of the pose is computed now
+        if self.camera_path is not None:
+            if not self.camera_path.apply(self.camera, self.profiler.frame):
+                # Close the record of the last frame
+                self.profiler.start_frame()
+                self.finish_profile()
+                self.close()
+                return
+            self.camera.update(0)
+        self.profiler.start_frame()
+        self.draw_frame()
+
+    def draw_frame(self):
+        profiler = self.profiler
+        with profiler.measure(DRAW_PHASE) if profiler else nullcontext():
+            glClearColor(135 / 255.0, 206 / 255.0, 235 / 255.0, 1.0)
+            self.clear()
+            glPolygonMode(GL_FRONT_AND_BACK, self.terrain.polygon_mode)
+            with profiler.measure_gpu() if profiler else nullcontext():
+                batch.draw()
+        if self.mode != DEBUG_MODE:
+            return
+        with profiler.measure(OVERLAY_PHASE) if profiler else nullcontext():
             with self.orthographic_view:
                 glPolygonMode(GL_FRONT_AND_BACK, GL_FILL)
-                fps_display.draw()
+                if profiler is None:
+                    fps_display.draw()
+                else:
+                    profiler.draw()
+
+    def finish_profile(self):
+        """Write and print the profile of the frames, only once."""
+        if self.profiler is None:
+            return
+        if self.csv_path is not None:
+            self.profiler.dump_csv(self.csv_path)
+        self.profiler.print_summary()
+        if self.profiler.gpu_timer is not None:
+            self.profiler.gpu_timer.delete()
+        self.profiler = None
+
+    def on_close(self):
+        self.finish_profile()
+        super().on_close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Show the terrain of a map")
+    parser.add_argument(
+        "--profile", action="store_true",
+        help="Show the frame time of each phase, the GPU time and the mesh"
+    )
+    parser.add_argument(
+        "--camera-path",
+        help="JSON file with keyframes that the camera follows, the window "
+             "closes at the end"
+    )
+    parser.add_argument(
+        "--csv", help="Write the profile of every frame to this CSV file"
+    )
+    return parser.parse_args()
 
 
 if __name__ == '__main__':
-    window = Window(debug_mode=True)
+    args = parse_args()
+    window = Window(
+        debug_mode=True, profile=args.profile,
+        camera_path=args.camera_path and CameraPath.load(args.camera_path),
+        csv_path=args.csv
+    )
     cam_dist = 100 + window.terrain.size / 2
     camera = FPSCamera(
         window,
         position=Vec3(
             cam_dist, cam_dist, 0
-        )
+        ),
+        profiler=window.profiler
     )
+    window.camera = camera
     fps_display = pyglet.window.FPSDisplay(window=window)
     pyglet.app.run()
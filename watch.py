@@ -0,0 +1,161 @@
+import fnmatch
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+# Local modules
+from constants import *
+import incremental
+from map_context import MapContext
+import tiling
+import utils
+
+# Seconds between checks of the files of a map
+WATCH_INTERVAL = 0.25
+# Seconds without changes before a burst of saves is built
+DEBOUNCE_TIME = 0.5
+# Inputs of a build
+WATCHED_PATTERNS = [
+    CONFIG_FILENAME, ECOTOPES_FILENAME, HEIGHT_MAP_FILENAME, ROAD_MAP_FILENAME,
+    GROUND_TEXTURE, f"*_{DENSITY_FILENAME}"
+]
+# Outputs that viewers load
+OUTPUT_FILENAMES = [
+    PLACEMENT_FILENAME, INSTANCES_FILENAME, SURFACE_TEXTURE, SURFACE_FILENAME,
+    SURFACE_GLB_FILENAME, f"{tiling.TILES_DIR}/{tiling.TILES_FILENAME}"
+]
+
+
+class MapWatcher(threading.Thread):
+    def __init__(self, map_name):
+        """
+        Thread that builds a map incrementally every time its inputs change
+        and tells its subscribers which outputs changed.
+        Args:
+            map_name(str): Name of the map
+        """
+        super().__init__(daemon=True)
+        self.ctx = MapContext(map_name)
+        self.subscribers = []
+        self.lock = threading.Lock()
+
+    def subscribe(self):
+        """
+        Returns:
+            Queue: Queue that receives a dict with the changed outputs after
+                every build
+        """
+        subscriber = queue.Queue()
+        with self.lock:
+            self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.remove(subscriber)
+
+    def notify(self, message):
+        with self.lock:
+            for subscriber in self.subscribers:
+                subscriber.put(message)
+
+    def get_mtimes(self, filenames):
+        return {
+            filename: self.ctx.get_mtime(filename) for filename in filenames
+        }
+
+    def get_input_mtimes(self):
+        filenames = [
+            filename for filename in os.listdir(self.ctx.map_dir)
+            if any(fnmatch.fnmatch(filename, p) for p in WATCHED_PATTERNS)
+        ]
+        return self.get_mtimes(filenames)
+
+    def build(self, changed_inputs):
+        """
+        Build the changed regions of the map.
+        Args:
+            changed_inputs(list): Inputs that changed since the last build
+        Returns:
+            dict: Message for the subscribers
+        """
+        output_mtimes = self.get_mtimes(OUTPUT_FILENAMES)
+        start = time.perf_counter()
+        self.ctx.refresh()
+        incremental.build_map(self.ctx)
+        elapsed_time = time.perf_counter() - start
+        changed_outputs = [
+            filename
+            for filename, mtime in self.get_mtimes(OUTPUT_FILENAMES).items()
+            if mtime != output_mtimes[filename]
+        ]
+        print(
+            f"Built {self.ctx.map_name} in {elapsed_time:.3f}s after changes "
+            f"in {', '.join(changed_inputs)}"
+        )
+        return {
+            "map": self.ctx.map_name,
+            "inputs": changed_inputs,
+            "outputs": changed_outputs,
+            "time": elapsed_time
+        }
+
+    def run(self):
+        mtimes = self.get_input_mtimes()
+        # Bring the outputs up to date before watching
+        self.build([])
+        while True:
+            time.sleep(WATCH_INTERVAL)
+            new_mtimes = self.get_input_mtimes()
+            if new_mtimes == mtimes:
+                continue
+            # Wait until the editor finishes saving
+            last_mtimes = new_mtimes
+            while True:
+                time.sleep(DEBOUNCE_TIME)
+                new_mtimes = self.get_input_mtimes()
+                if new_mtimes == last_mtimes:
+                    break
+                last_mtimes = new_mtimes
+            changed_inputs = sorted(
+                filename for filename in set(mtimes) | set(new_mtimes)
+                if mtimes.get(filename) != new_mtimes.get(filename)
+            )
+            mtimes = new_mtimes
+            try:
+                message = self.build(changed_inputs)
+            except Exception as e:
+                # A half written image shouldn't stop the watcher
+                print(f"Build of {self.ctx.map_name} failed: {e!r}")
+                message = {
+                    "map": self.ctx.map_name,
+                    "inputs": changed_inputs,
+                    "error": repr(e)
+                }
+            self.notify(message)
+
+
+def main():
+    # Load map names
+    with open(MAPS_FILENAME, 'r') as f:
+        cities = json.load(f)
+    option = int(input(utils.menu_str(cities))) - 1
+    if option == EXIT_CODE:
+        sys.exit("You selected to exit the program")
+    watcher = MapWatcher(cities[option].lower())
+    subscriber = watcher.subscribe()
+    watcher.start()
+    print(f"Watching {watcher.ctx.map_dir}, press Ctrl+C to stop")
+    try:
+        while True:
+            message = subscriber.get()
+            print(f"Changed outputs: {message.get('outputs')}")
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()